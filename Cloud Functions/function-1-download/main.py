@@ -1,31 +1,658 @@
 import os
+import re
 import json
+import time
+import uuid
+import shutil
+import hashlib
 import tempfile
-import git
+import posixpath
+import threading
 import functions_framework
-
-from google.cloud import logging
-from google.cloud import storage
+from collections import Counter
+from contextlib import contextmanager
+from functools import lru_cache
 
 PROJECT_ID = "doxygen-gcp"
 LOCATION = "europe-west1"
 BUCKET = "doxygen-gcp-storage"
 LOG_NAME = "run_inference-cloudfunction-download-log"
 
-client = logging.Client(project=PROJECT_ID)
-client.setup_logging()
-logger = client.logger(LOG_NAME)
+# Clients are built on first use rather than at import, to keep cold starts short
+_logger = None
+_logger_lock = threading.Lock()
+
+
+def get_logger():
+    """Sets up Cloud Logging on the first call and returns the function's logger."""
+    global _logger
+    if _logger is None:
+        with _logger_lock:  # setup_logging() must run only once
+            if _logger is None:
+                from google.cloud import logging
+
+                client = logging.Client(project=PROJECT_ID)
+                client.setup_logging()
+                _logger = client.logger(LOG_NAME)
+    return _logger
+
+
+class LazyLogger:
+    """Forwards to the Cloud Logging logger, which is only created when something is logged."""
+
+    def __getattr__(self, name):
+        return getattr(get_logger(), name)
+
+
+logger = LazyLogger()
+
+
+@lru_cache(maxsize=None)
+def get_bucket():
+    from google.cloud import storage
+
+    return storage.Client().bucket(BUCKET)
+
+# Tracing: the Streamlit app sends one trace id per pipeline run in the X-Trace-Id header
+TRACE_HEADER = "X-Trace-Id"
+TRACE_SINK = os.environ.get("TRACE_SINK", "none")  # 'none', 'log' or 'file:<path>' (one JSON record per line)
+_trace_file_lock = threading.Lock()
+
+
+class Trace:
+    """
+    Spans and counters recorded while serving one request, exported as a single record.
+    """
+
+    def __init__(self, trace_id, service):
+        self.trace_id = trace_id or uuid.uuid4().hex
+        self.service = service
+        self.spans = []
+        self.counters = Counter()
+        self._lock = threading.Lock()
+        self._started_at = time.time()
+
+    @contextmanager
+    def span(self, name, **attributes):
+        started_at = time.time()
+        try:
+            yield attributes
+        except Exception as e:
+            attributes["error"] = str(e)
+            raise
+        finally:
+            with self._lock:
+                self.spans.append({"name": name, "start": started_at,
+                                   "duration_ms": round((time.time() - started_at) * 1000, 1), **attributes})
+
+    @contextmanager
+    def timed(self, counter):
+        """Adds the block's duration to a counter, for steps repeated per file."""
+        started_at = time.time()
+        try:
+            yield
+        finally:
+            self.count(**{counter: round((time.time() - started_at) * 1000, 1)})
+
+    def count(self, **increments):
+        with self._lock:
+            self.counters.update(increments)
+
+    def to_dict(self):
+        with self._lock:
+            return {"trace_id": self.trace_id, "service": self.service, "start": self._started_at,
+                    "duration_ms": round((time.time() - self._started_at) * 1000, 1),
+                    "spans": list(self.spans), "counters": dict(self.counters)}
+
+    def export(self):
+        if TRACE_SINK == "none":
+            return
+        record = self.to_dict()
+        if TRACE_SINK == "log":
+            logger.log_struct(record, severity="INFO")
+        elif TRACE_SINK.startswith("file:"):
+            with _trace_file_lock, open(TRACE_SINK[len("file:"):], "a") as file:
+                file.write(json.dumps(record) + "\n")
+
+
+def start_trace(request, service):
+    """Continues the caller's trace, or starts one for requests sent without the header."""
+    headers = getattr(request, "headers", None) or {}
+    return Trace(headers.get(TRACE_HEADER), service)
+
+# Upload policy: only the files the documentation pipeline uses are stored
+DEFAULT_UPLOAD_RULES = """
+# Version control and editor metadata
+.git/
+.svn/
+.hg/
+.idea/
+.vscode/
+# Build artifacts
+*.o
+*.obj
+*.a
+*.lib
+*.so
+*.so.*
+*.dylib
+*.dll
+*.exe
+*.out
+*.d
+*.gch
+*.pch
+build/
+cmake-build-*/
+# Archives, documents and media
+*.zip
+*.tar
+*.gz
+*.tgz
+*.bz2
+*.xz
+*.7z
+*.pdf
+*.png
+*.jpg
+*.jpeg
+*.gif
+*.mp3
+*.mp4
+*.wav
+# Test fixtures
+fixtures/
+testdata/
+test_data/
+"""
+MAX_FILE_BYTES = int(os.environ.get("MAX_FILE_BYTES", str(1024 * 1024)))  # Larger files are skipped
+MAX_REPO_BYTES = int(os.environ.get("MAX_REPO_BYTES", str(100 * 1024 * 1024)))  # Total uploaded per repository
+BINARY_SNIFF_BYTES = 8000  # Like git, a NUL byte in the first 8000 bytes means binary
+SOURCE_EXTENSIONS = (".c", ".h")  # Uploaded first, so the byte budget goes to what gets documented
+
+
+def glob_to_regex(pattern):
+    """Translates a .gitignore glob into a regular expression matching whole relative paths."""
+    regex = ""
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith("**/", i):
+            regex += "(?:.*/)?"
+            i += 3
+        elif pattern.startswith("/**", i) and i + 3 == len(pattern):
+            regex += "/.*"
+            i += 3
+        elif pattern.startswith("**", i):
+            regex += ".*"
+            i += 2
+        elif pattern[i] == "*":
+            regex += "[^/]*"
+            i += 1
+        elif pattern[i] == "?":
+            regex += "[^/]"
+            i += 1
+        elif pattern[i] == "[" and "]" in pattern[i + 1:]:
+            end = pattern.index("]", i + 1)
+            regex += "[" + pattern[i + 1:end].replace("!", "^", 1).replace("\\", "\\\\") + "]"
+            i = end + 1
+        else:
+            regex += re.escape(pattern[i])
+            i += 1
+    return regex
+
+
+class UploadRule:
+    """One .gitignore-style line: '!' re-includes, a trailing '/' only matches directories,
+    and a pattern containing a '/' is anchored at the repository root."""
+
+    def __init__(self, line):
+        self.negated = line.startswith("!")
+        pattern = line[1:] if self.negated else line
+        self.directory_only = pattern.endswith("/")
+        pattern = pattern.rstrip("/")
+        anchored = "/" in pattern  # A leading or middle slash
+        self.regex = re.compile(("" if anchored else "(?:.*/)?") + glob_to_regex(pattern.lstrip("/")))
+
+    def matches(self, relative_path, is_dir):
+        return (is_dir or not self.directory_only) and self.regex.fullmatch(relative_path) is not None
+
+
+class UploadPolicy:
+    """
+    Decides which files of the clone are uploaded: the rules first (the last matching rule
+    wins, and an excluded directory is not walked), then the size cap, binary detection and
+    the repository's byte budget. Counts the files and bytes skipped for each reason.
+    """
+
+    def __init__(self, rules, max_file_bytes=MAX_FILE_BYTES, max_repo_bytes=MAX_REPO_BYTES):
+        lines = [line.strip() for line in rules]
+        self.rules = [UploadRule(line) for line in lines if line and not line.startswith("#")]
+        self.max_file_bytes = max_file_bytes
+        self.max_repo_bytes = max_repo_bytes
+
+    @classmethod
+    def from_request(cls, request_json):
+        """
+        Default rules, then the request's 'upload_rules' lines (a list, or one string with a
+        rule per line); the request may also set the caps.
+        """
+        request_json = request_json or {}
+        request_rules = request_json.get("upload_rules", [])
+        if isinstance(request_rules, str):
+            request_rules = request_rules.splitlines()
+        rules = os.environ.get("UPLOAD_RULES", DEFAULT_UPLOAD_RULES).splitlines() + list(request_rules)
+        return cls(rules, int(request_json.get("max_file_bytes", MAX_FILE_BYTES)),
+                   int(request_json.get("max_repo_bytes", MAX_REPO_BYTES)))
+
+    def excluded(self, relative_path, is_dir=False):
+        excluded = False
+        for rule in self.rules:
+            if rule.matches(relative_path, is_dir):
+                excluded = not rule.negated
+        return excluded
+
+    def select(self, root):
+        """Returns the (local path, relative path, size) of the files to upload, and the skip stats."""
+        stats = {"uploaded": Counter(), "skipped": {}}
+
+        def skip(reason, size, files=1):
+            stats["skipped"].setdefault(reason, Counter()).update(files=files, bytes=size)
+
+        candidates = []
+        for directory, dirs, files in os.walk(root):
+            relative_dir = os.path.relpath(directory, root).replace(os.sep, "/")
+            relative_dir = "" if relative_dir == "." else relative_dir + "/"
+            for name in list(dirs):
+                if self.excluded(relative_dir + name, is_dir=True):
+                    dirs.remove(name)
+                    files_count, size = directory_size(os.path.join(directory, name))
+                    skip("rules", size, files_count)
+            for name in files:
+                local_path = os.path.join(directory, name)
+                relative_path = relative_dir + name
+                if os.path.islink(local_path):
+                    skip("symlink", 0)
+                    continue
+                size = os.path.getsize(local_path)
+                if self.excluded(relative_path):
+                    skip("rules", size)
+                elif size > self.max_file_bytes:
+                    skip("too_large", size)
+                elif is_binary(local_path):
+                    skip("binary", size)
+                else:
+                    candidates.append((local_path, relative_path, size))
+
+        selected = []
+        total = 0
+        candidates.sort(key=lambda candidate: (not candidate[1].endswith(SOURCE_EXTENSIONS), candidate[1]))
+        for local_path, relative_path, size in candidates:
+            if total + size > self.max_repo_bytes:
+                skip("repo_budget", size)
+                continue
+            total += size
+            selected.append((local_path, relative_path, size))
+            stats["uploaded"].update(files=1, bytes=size)
+        return selected, {"uploaded": dict(stats["uploaded"]),
+                          "skipped": {reason: dict(counts) for reason, counts in stats["skipped"].items()}}
+
+
+def is_binary(local_path):
+    with open(local_path, "rb") as file:
+        return b"\0" in file.read(BINARY_SNIFF_BYTES)
+
+
+def directory_size(path):
+    """Returns the number of files under path and their total size."""
+    sizes = [os.path.getsize(os.path.join(directory, name))
+             for directory, dirs, files in os.walk(path) for name in files
+             if not os.path.islink(os.path.join(directory, name))]
+    return len(sizes), sum(sizes)
+
+
+# Symbol index: the #include relations and top-level declarations of the C sources, built once
+# per snapshot so that the comment and README prompts only carry the declarations they need
+INDEX_PREFIX = "symbol_index/"
+C_KEYWORDS = frozenset("""
+    auto break case char const continue default do double else enum extern float for goto if inline int
+    long register restrict return short signed sizeof static struct switch typedef union unsigned void
+    volatile while""".split())
+COMMENT_OR_LITERAL = re.compile(r"/\*.*?\*/|//[^\n]*|\"(?:\\.|[^\"\\\n])*\"|'(?:\\.|[^'\\\n])*'", re.S)
+LITERAL_OR_BRACE = re.compile(r"\"(?:\\.|[^\"\\\n])*\"|'(?:\\.|[^'\\\n])*'|[{};]")
+INCLUDE_PATTERN = re.compile(r'#\s*include\s*"([^"]+)"')
+DEFINE_PATTERN = re.compile(r"#\s*define\s+(\w+)(.*)", re.S)
+IDENTIFIER_PATTERN = re.compile(r"[A-Za-z_]\w*")
+FUNCTION_NAME_PATTERN = re.compile(r"(\w+)\s*\(")
+POINTER_NAME_PATTERN = re.compile(r"\(\s*\*\s*(\w+)\s*\)")
+
+
+def strip_comments(text, keep_literals=True):
+    """Removes the comments of a C source, keeping its line breaks, and its literals unless told otherwise."""
+    def replace(match):
+        token = match.group()
+        if token.startswith("/"):
+            return "\n" * token.count("\n")
+        return token if keep_literals else '""'
+    return COMMENT_OR_LITERAL.sub(replace, text)
+
+
+def declarator_names(text):
+    """The names declared by 'type a, *b[3] = ...', ignoring the initializers."""
+    names = []
+    for part in text.split(","):
+        identifiers = [name for name in IDENTIFIER_PATTERN.findall(part.split("=")[0].split("[")[0])
+                       if name not in C_KEYWORDS]
+        if identifiers:
+            names.append(identifiers[-1])
+    return names
+
+
+def function_name(text):
+    for match in FUNCTION_NAME_PATTERN.finditer(text):
+        if match.group(1) not in C_KEYWORDS:
+            return match.group(1)
+    return None
+
+
+def classify_statement(text):
+    """Returns the (names, kind) declared by a top-level C statement, or None."""
+    head, brace, rest = text.partition("{")
+    if brace and "=" not in head:
+        # struct, union or enum definition, possibly in a typedef or with variables
+        inner, _, tail = rest.rpartition("}")
+        names = []
+        tag = re.search(r"\b(?:struct|union|enum)\s+(\w+)\s*$", head)
+        if tag:
+            names.append(tag.group(1))
+        if re.search(r"\benum\b", head):
+            names += [part.split("=")[0].strip() for part in inner.split(",") if part.split("=")[0].strip()]
+        names += declarator_names(tail)
+        return (names, "type") if names else None
+    if head.startswith("typedef"):
+        pointer = POINTER_NAME_PATTERN.search(head)
+        names = [pointer.group(1)] if pointer else declarator_names(head)[-1:]
+        return (names, "type") if names else None
+    if brace:
+        # Variables with a brace initializer
+        while re.search(r"\{[^{}]*\}", text):
+            text = re.sub(r"\{[^{}]*\}", "", text)
+        names = declarator_names(text)
+        return (names, "variable") if names else None
+    if "(" in head and "=" not in head.split("(")[0]:
+        name = function_name(head)
+        if name:
+            return [name], "function"
+        pointer = POINTER_NAME_PATTERN.search(head)
+        return ([pointer.group(1)], "variable") if pointer else None
+    if re.fullmatch(r"(?:struct|union|enum)\s+\w+", head.strip()):
+        return None  # Forward declaration
+    names = declarator_names(head.split("(")[0] if "=" in head else head)
+    return (names, "variable") if names else None
+
+
+def parse_c_source(text):
+    """
+    Returns the quoted #include targets of a C source, and its top-level declarations that
+    other files can use, as (names, kind, text): macros with a value, types, prototypes
+    (function definitions give their signature) and global variables. Static ones are left out.
+    """
+    includes, declarations, code_lines = [], [], []
+    lines = strip_comments(text).split("\n")
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        if line.lstrip().startswith("#"):
+            directive = line
+            while directive.endswith("\\") and i + 1 < len(lines):
+                i += 1
+                directive = directive[:-1] + "\n" + lines[i]
+            code_lines.append("")
+            include = INCLUDE_PATTERN.search(directive)
+            define = DEFINE_PATTERN.search(directive)
+            if include:
+                includes.append(include.group(1))
+            elif define and define.group(2).strip():  # Include guards and flags carry nothing
+                declarations.append(([define.group(1)], "macro", directive.strip()))
+        else:
+            code_lines.append(line)
+        i += 1
+
+    code = "\n".join(code_lines)
+    statements = []
+    depth = 0
+    start = 0
+    in_function = False
+    for match in LITERAL_OR_BRACE.finditer(code):
+        token = match.group()
+        if token == "{":
+            if depth == 0:
+                head = code[start:match.start()].strip()
+                if re.search(r'extern\s*"C"$', head):
+                    start = match.end()
+                    continue  # C++ linkage block: its contents are top-level
+                if head.endswith(")"):
+                    in_function = True
+                    statements.append(head)  # A function definition gives its signature
+            depth += 1
+        elif token == "}":
+            if depth == 0:
+                start = match.end()  # End of an extern "C" block
+                continue
+            depth -= 1
+            if depth == 0 and in_function:
+                in_function = False
+                start = match.end()
+        elif token == ";" and depth == 0:
+            statements.append(code[start:match.start()].strip())
+            start = match.end()
+
+    for statement in statements:
+        if not statement or re.match(r"static\b", statement):
+            continue
+        declared = classify_statement(statement)
+        if declared:
+            names, kind = declared
+            lines = [line.rstrip() for line in statement.split("\n") if line.strip()]
+            declarations.append((names, kind, "\n".join(lines) + ";"))
+    return includes, declarations
+
+
+def resolve_include(target, including_path, paths, by_basename):
+    """The repository file an #include "target" refers to: relative to the including file, to the
+    root, or else the file of that name with the closest path, as with -I flags."""
+    for candidate in (posixpath.normpath(posixpath.join(posixpath.dirname(including_path), target)),
+                      posixpath.normpath(target)):
+        if candidate in paths:
+            return candidate
+    matches = by_basename.get(posixpath.basename(target), [])
+    suffixed = [path for path in matches if path.endswith("/" + target)]
+    return min(suffixed or matches, key=len) if matches else None
+
+
+def include_resolver(paths):
+    """Returns resolve(target, including_path), which finds the file an #include refers to among paths."""
+    paths = set(paths)
+    by_basename = {}
+    for path in sorted(paths):
+        by_basename.setdefault(posixpath.basename(path), []).append(path)
+    return lambda target, including_path: resolve_include(target, including_path, paths, by_basename)
+
+
+def add_declarations(index, path, text, resolve):
+    """Adds a file's includes and declarations to the index, and returns the identifiers it uses."""
+    includes, declared = parse_c_source(text)
+    ids = []
+    for names, kind, declaration_text in declared:
+        ids.append(len(index["declarations"]))
+        index["declarations"].append({"names": names, "kind": kind, "file": path, "text": declaration_text})
+    resolved = [resolve(target, path) for target in includes]
+    index["files"][path] = {"includes": sorted({include for include in resolved if include and include != path}),
+                            "declares": ids}
+    return Counter(name for name in IDENTIFIER_PATTERN.findall(strip_comments(text, False)) if name not in C_KEYWORDS)
+
+
+def declarations_used(index, path, identifiers, by_name=None):
+    """The declarations of the indexed files that path includes, directly or not, that its
+    identifiers use, as [declaration id, uses] pairs, most used first. by_name maps each name
+    to the ids of its declarations, when the whole index is being built."""
+    files = index["files"]
+    visible = set()
+    pending = list(files[path]["includes"])
+    while pending:
+        include = pending.pop()
+        if include not in visible:
+            visible.add(include)
+            pending += files[include]["includes"] if include in files else []
+    declarations = index["declarations"]
+    own_names = {name for declaration_id in files[path]["declares"] for name in declarations[declaration_id]["names"]}
+    uses = Counter()
+    if by_name is not None:
+        for name, count in identifiers.items():
+            if name not in own_names:
+                for declaration_id in by_name.get(name, ()):
+                    if declarations[declaration_id]["file"] in visible:
+                        uses[declaration_id] += count
+    else:
+        for include in visible & set(files):
+            for declaration_id in files[include]["declares"]:
+                for name in declarations[declaration_id]["names"]:
+                    if name in identifiers and name not in own_names:
+                        uses[declaration_id] += identifiers[name]
+    return [[declaration_id, count] for declaration_id, count in sorted(uses.items(), key=lambda item: (-item[1], item[0]))]
+
+
+def build_symbol_index(sources, resolve=None):
+    """
+    Indexes {relative path: text} C sources: for each file, the files it includes, the
+    declarations it makes, and the declarations of the files it includes, directly or not,
+    that it uses, most used first. Declarations are listed once, with their file and text.
+    resolve finds included files among other paths than the sources' (see include_resolver).
+    """
+    resolve = resolve or include_resolver(sources)
+    index = {"files": {}, "declarations": []}
+    identifiers = {path: add_declarations(index, path, sources[path], resolve) for path in sorted(sources)}
+    by_name = {}
+    for declaration_id, declaration in enumerate(index["declarations"]):
+        for name in declaration["names"]:
+            by_name.setdefault(name, []).append(declaration_id)
+    for path, entry in index["files"].items():
+        entry["uses"] = declarations_used(index, path, identifiers[path], by_name)
+    return index
+
+
+def index_source(index, path, text, resolve):
+    """
+    Adds one more source to an index of the files it may include, such as the headers
+    indexed first, so the other sources can be indexed one at a time as they are read.
+    """
+    identifiers = add_declarations(index, path, text, resolve)
+    index["files"][path]["uses"] = declarations_used(index, path, identifiers)
+
+
+# Mirror cache: a git bundle of every repository already downloaded, so the next download
+# only fetches the objects pushed since
+MIRROR_CACHE = os.environ.get("MIRROR_CACHE", "gcs")  # 'gcs', 'none' or 'dir:<path>' (a local directory)
+MIRROR_PREFIX = "git_mirrors/"
+MIRROR_REFSPECS = ("+refs/heads/*:refs/heads/*", "+refs/tags/*:refs/tags/*")  # Not GitHub's refs/pull/*
+
+
+def mirror_bundle_name(url):
+    """The cached bundle of a repository, named after its URL without credentials or .git suffix."""
+    normalized = re.sub(r"//[^/@]*@", "//", url.strip()).rstrip("/").removesuffix(".git")
+    return f"{MIRROR_PREFIX}{hashlib.sha256(normalized.encode('utf-8')).hexdigest()[:32]}.bundle"
+
+
+def restore_mirror_bundle(name, local_path):
+    """Copies the cached bundle to local_path, and returns False if there is none."""
+    if MIRROR_CACHE == "none":
+        return False
+    if MIRROR_CACHE.startswith("dir:"):
+        cached_path = os.path.join(MIRROR_CACHE[len("dir:"):], name)
+        if not os.path.isfile(cached_path):
+            return False
+        shutil.copyfile(cached_path, local_path)
+        return True
+    blob = get_bucket().get_blob(name)
+    if blob is None:
+        return False
+    blob.download_to_filename(local_path)
+    return True
+
+
+def store_mirror_bundle(name, local_path):
+    if MIRROR_CACHE == "none":
+        return
+    if MIRROR_CACHE.startswith("dir:"):
+        cached_path = os.path.join(MIRROR_CACHE[len("dir:"):], name)
+        os.makedirs(os.path.dirname(cached_path), exist_ok=True)
+        shutil.copyfile(local_path, cached_path + ".tmp")
+        os.replace(cached_path + ".tmp", cached_path)  # Another download of the repository may read it
+        return
+    get_bucket().blob(name).upload_from_filename(local_path, content_type="application/octet-stream")
+
+
+def clone_with_mirror(url, destination, trace):
+    """
+    Clones url into destination through a bare repository of its branches and tags (not the
+    pull request refs of a mirror), restored from the cached bundle, so only the objects
+    pushed since the last download come over the network. Without a usable bundle they are
+    all fetched. The bundle is stored again when a ref changed.
+    """
+    import git  # Only needed once a request comes in
+
+    name = mirror_bundle_name(url)
+    with tempfile.TemporaryDirectory() as work_dir:
+        bundle_path = os.path.join(work_dir, "mirror.bundle")
+        mirror = git.Repo.init(os.path.join(work_dir, "mirror.git"), bare=True)
+        mirror.git.config("transfer.unpackLimit", "1")  # Packs kept as received are reused by the bundle
+        mirror.git.remote("add", "origin", url)
+        mirror.git.config("--replace-all", "remote.origin.fetch", MIRROR_REFSPECS[0])
+        mirror.git.config("--add", "remote.origin.fetch", MIRROR_REFSPECS[1])
+        with trace.span("restore_mirror") as attributes:
+            restored = False
+            if restore_mirror_bundle(name, bundle_path):
+                attributes.update(bundle_bytes=os.path.getsize(bundle_path))
+                try:
+                    mirror.git.fetch(bundle_path, *MIRROR_REFSPECS)
+                    restored = True
+                except git.GitCommandError as e:
+                    logger.log(f"Unusable mirror bundle {name}, fetching {url} in full: {e}")
+            attributes.update(restored=restored)
+
+        with trace.span("fetch", incremental=restored) as attributes:
+            refs_before = mirror.git.for_each_ref()
+            mirror.git.fetch("--prune", "origin")
+            changed = mirror.git.for_each_ref() != refs_before
+            # Neither a bundle nor a fetch tells which branch is the default one, so it is asked for
+            remote_head = mirror.git.ls_remote("--symref", "origin", "HEAD").split("\n")[0]
+            if remote_head.startswith("ref: "):
+                mirror.git.symbolic_ref("HEAD", remote_head[len("ref: "):].split("\t")[0])
+            attributes.update(changed=changed)
+
+        with trace.span("checkout"):
+            repo = git.Repo.clone_from(mirror.git_dir, destination)
+
+        if changed:
+            with trace.span("store_mirror") as attributes:
+                try:
+                    mirror.git.bundle("create", bundle_path, "--branches", "--tags")
+                except git.GitCommandError as e:  # An empty repository has nothing to bundle
+                    logger.log(f"No mirror bundle stored for {url}: {e}")
+                else:
+                    store_mirror_bundle(name, bundle_path)
+                    attributes.update(bundle_bytes=os.path.getsize(bundle_path))
+    return repo
 
-storage_client = storage.Client()
-bucket = storage_client.bucket(BUCKET)
 
 @functions_framework.http
 def run_inference(request):
     """HTTP Cloud Function.
     Args:
-        a GET HTTP request with 'url' query parameter 
+        a GET HTTP request with 'url' query parameter, and optionally extra 'upload_rules',
+        'max_file_bytes' and 'max_repo_bytes' for the upload policy
     Returns:
-        a HTTP response with the storage_uri
+        a HTTP response with the storage_uri and what the upload policy skipped; the
+        sources' symbol index is stored as symbol_index/<repository>.json
     """
 
     request_json = request.get_json(silent=True)
@@ -40,23 +667,50 @@ def run_inference(request):
 
     logger.log(f"URL request for prompt: {url}")
 
-    with tempfile.TemporaryDirectory() as tmpdirname:
-        # Cloner le répertoire Git
-        repo = git.Repo.clone_from(url, tmpdirname)
-        repo_name = os.path.basename(url).replace('.git', '')
-
-        # Référence au bucket
-        # Parcourir les fichiers du répertoire local et les télécharger dans GCS
-        for root, dirs, files in os.walk(tmpdirname):
-            for file in files:
-                local_file_path = os.path.join(root, file)
-                blob_path = os.path.join(repo_name, os.path.relpath(local_file_path, tmpdirname))
-                blob = bucket.blob(blob_path)
-                blob.upload_from_filename(local_file_path)
-                logger.log(f'Téléchargé {local_file_path} vers gs://{BUCKET}/{blob_path}')
+    trace = start_trace(request, "function-1-download")
+    bucket = get_bucket()
+    try:
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            # Cloner le répertoire Git, depuis le miroir en cache s'il existe
+            with trace.span("clone"):
+                clone_with_mirror(url, tmpdirname, trace)
+            repo_name = os.path.basename(url).replace('.git', '')
+
+            # Choisir les fichiers utiles à la documentation
+            with trace.span("select") as attributes:
+                selected, upload_stats = UploadPolicy.from_request(request_json).select(tmpdirname)
+                attributes.update(files=len(selected))
+            for reason, counts in upload_stats["skipped"].items():
+                trace.count(**{f"skipped_{reason}_files": counts["files"], f"skipped_{reason}_bytes": counts["bytes"]})
+
+            # Référence au bucket
+            # Télécharger les fichiers retenus dans GCS
+            with trace.span("upload"):
+                for local_file_path, relative_path, size in selected:
+                    blob_path = f"{repo_name}/{relative_path}"
+                    blob = bucket.blob(blob_path)
+                    blob.upload_from_filename(local_file_path)
+                    trace.count(files=1, gcs_rpcs=1, bytes_uploaded=size)
+                    logger.log(f'Téléchargé {local_file_path} vers gs://{BUCKET}/{blob_path}')
+
+            # Indexer les déclarations une fois pour toutes, à côté de l'instantané
+            with trace.span("index") as attributes:
+                sources = {}
+                for local_file_path, relative_path, size in selected:
+                    if relative_path.endswith(SOURCE_EXTENSIONS):
+                        with open(local_file_path, "r", encoding="utf-8", errors="replace") as file:
+                            sources[relative_path] = file.read()
+                index = build_symbol_index(sources)
+                index_json = json.dumps(index)
+                bucket.blob(f"{INDEX_PREFIX}{repo_name}.json").upload_from_string(
+                    index_json, content_type="application/json")
+                attributes.update(files=len(index["files"]), declarations=len(index["declarations"]))
+            trace.count(gcs_rpcs=1, bytes_uploaded=len(index_json))
+    finally:
+        trace.export()
 
     storage_uri = repo_name
 
-    logger.log(f"Git repository downloaded at : {storage_uri}")
+    logger.log(f"Git repository downloaded at : {storage_uri}, upload policy: {upload_stats}")
 
-    return json.dumps({"storage_uri": storage_uri})
+    return json.dumps({"storage_uri": storage_uri, "upload_stats": upload_stats, "trace_id": trace.trace_id})
@@ -1,33 +1,221 @@
 import os
 import json
+import uuid
+import threading
 import functions_framework
-import vertexai
 import time
-
-from google.cloud import logging, storage
-from vertexai.preview.generative_models import GenerativeModel
+from collections import Counter
+from contextlib import contextmanager
+from functools import lru_cache
 
 PROJECT_ID = "doxygen-gcp"
 LOCATION = "europe-west1"
 BUCKET = "doxygen-gcp-storage"
-
-client = logging.Client(project=PROJECT_ID)
-client.setup_logging()
+MODEL_NAME = "gemini-1.5-pro"
 
 LOG_NAME = "run_inference-cloudfunction-comment-log"
-logger = client.logger(LOG_NAME)
-storage_client = storage.Client()
 
+# Clients and the model are built on first use rather than at import, to keep cold starts short
+_logger = None
+_logger_lock = threading.Lock()
+
+
+def get_logger():
+    """Sets up Cloud Logging on the first call and returns the function's logger."""
+    global _logger
+    if _logger is None:
+        with _logger_lock:  # setup_logging() must run only once
+            if _logger is None:
+                from google.cloud import logging
+
+                client = logging.Client(project=PROJECT_ID)
+                client.setup_logging()
+                _logger = client.logger(LOG_NAME)
+    return _logger
+
+
+class LazyLogger:
+    """Forwards to the Cloud Logging logger, which is only created when something is logged."""
+
+    def __getattr__(self, name):
+        return getattr(get_logger(), name)
+
+
+logger = LazyLogger()
+
+
+@lru_cache(maxsize=None)
+def get_storage_client():
+    from google.cloud import storage
+
+    return storage.Client()
+
+
+@lru_cache(maxsize=None)
+def get_model(model_name=MODEL_NAME):
+    """Initializes Vertex AI and builds the model once per instance."""
+    import vertexai
+    from vertexai.preview.generative_models import GenerativeModel
 
-def generate_readme(file_analyses):
     vertexai.init(project=PROJECT_ID, location=LOCATION)
-    model = GenerativeModel("gemini-1.5-pro")
+    return GenerativeModel(model_name)
+
+# Tracing: the Streamlit app sends one trace id per pipeline run in the X-Trace-Id header
+TRACE_HEADER = "X-Trace-Id"
+TRACE_SINK = os.environ.get("TRACE_SINK", "none")  # 'none', 'log' or 'file:<path>' (one JSON record per line)
+CHARS_PER_TOKEN = 4  # Token estimate when the model response carries no usage metadata
+_trace_file_lock = threading.Lock()
+
+
+class Trace:
+    """
+    Spans and counters recorded while serving one request, exported as a single record.
+    """
+
+    def __init__(self, trace_id, service):
+        self.trace_id = trace_id or uuid.uuid4().hex
+        self.service = service
+        self.spans = []
+        self.counters = Counter()
+        self._lock = threading.Lock()
+        self._started_at = time.time()
+
+    @contextmanager
+    def span(self, name, **attributes):
+        started_at = time.time()
+        try:
+            yield attributes
+        except Exception as e:
+            attributes["error"] = str(e)
+            raise
+        finally:
+            with self._lock:
+                self.spans.append({"name": name, "start": started_at,
+                                   "duration_ms": round((time.time() - started_at) * 1000, 1), **attributes})
+
+    @contextmanager
+    def timed(self, counter):
+        """Adds the block's duration to a counter, for steps repeated per file."""
+        started_at = time.time()
+        try:
+            yield
+        finally:
+            self.count(**{counter: round((time.time() - started_at) * 1000, 1)})
+
+    def count(self, **increments):
+        with self._lock:
+            self.counters.update(increments)
+
+    def to_dict(self):
+        with self._lock:
+            return {"trace_id": self.trace_id, "service": self.service, "start": self._started_at,
+                    "duration_ms": round((time.time() - self._started_at) * 1000, 1),
+                    "spans": list(self.spans), "counters": dict(self.counters)}
+
+    def export(self):
+        if TRACE_SINK == "none":
+            return
+        record = self.to_dict()
+        if TRACE_SINK == "log":
+            logger.log_struct(record, severity="INFO")
+        elif TRACE_SINK.startswith("file:"):
+            with _trace_file_lock, open(TRACE_SINK[len("file:"):], "a") as file:
+                file.write(json.dumps(record) + "\n")
+
+
+def start_trace(request, service):
+    """Continues the caller's trace, or starts one for requests sent without the header."""
+    headers = getattr(request, "headers", None) or {}
+    return Trace(headers.get(TRACE_HEADER), service)
+
+
+def record_model_usage(trace, prompt, response):
+    """Counts a model call and its tokens, from the usage metadata when Vertex AI returns it."""
+    usage = getattr(response, "usage_metadata", None)
+    try:
+        text = response.text
+    except ValueError:
+        text = ""
+    trace.count(
+        model_calls=1,
+        model_input_tokens=getattr(usage, "prompt_token_count", 0) or len(prompt) // CHARS_PER_TOKEN,
+        model_output_tokens=getattr(usage, "candidates_token_count", 0) or len(text) // CHARS_PER_TOKEN,
+    )
+
+
+def build_readme_prompt(file_analyses, omitted=0):
+    """Builds the prompt asking Gemini for a README.md from (file name, content) pairs, and
+    the number of files left out of them."""
     readme_prompt = ""
     for file_name, analysis in file_analyses:
         readme_prompt += f"Fichier : {file_name}\n{analysis}\n\n"
+    if omitted:
+        readme_prompt += f"({omitted} autres fichiers sources du projet ne sont pas détaillés ici.)\n\n"
 
     readme_prompt += "Genere moi un fichier README.md pour expliquer ce projet. Je ne veux pas une analyse, pas besoin de donner des recommandations. Il faut qu'il soit bien structuré avec une table des matieres en premier, le titre du projet, une description, comment installer le necessaire si necessaire, comment l'utiliser, les fonctionnalites et un exemple d'utilisation. N'oublie pas de verifier s'il y a un makefile pour la partie utilisation. Si un fichier est necessaire en entree du programme qu'on veut lancer, verifie si ce genre de fichier est fourni dans le projet."
-    response = model.generate_content([readme_prompt])
+    return readme_prompt
+
+
+# Repository overview built from the symbol index function-1-download stores, instead of whole files
+INDEX_PREFIX = "symbol_index/"
+README_CONTEXT_MAX_CHARS = int(os.environ.get("README_CONTEXT_MAX_CHARS", "60000"))
+
+
+def load_symbol_index(repo_name):
+    """The repository's symbol index, or None for a snapshot stored without one."""
+    blob = get_storage_client().bucket(BUCKET).blob(f"{INDEX_PREFIX}{repo_name}.json")
+    if not blob.exists():
+        return None
+    return json.loads(blob.download_as_text())
+
+
+def entry_files(index):
+    """The files defining main(), whose whole source tells how the program is used."""
+    return sorted(index["declarations"][declaration_id]["file"]
+                  for entry in index["files"].values() for declaration_id in entry["declares"]
+                  if "main" in index["declarations"][declaration_id]["names"])
+
+
+def build_repository_overview(index, repo_name, entry_contents=None, max_chars=README_CONTEXT_MAX_CHARS):
+    """
+    Describes the repository from its symbol index within max_chars, so the README prompt
+    stays the same size however large the repository: the entry files in full (entry_contents),
+    then each file's includes and declarations, starting with the files whose declarations
+    the most other files use. Returns the (file name, analysis) pairs and the files left out.
+    """
+    entry_contents = entry_contents or {}
+    users = Counter()  # File -> uses of its declarations by other files
+    for entry in index["files"].values():
+        for declaration_id, count in entry["uses"]:
+            users[index["declarations"][declaration_id]["file"]] += 1
+    ranked = sorted(index["files"], key=lambda path: (path not in entry_contents, -users[path], path))
+
+    file_analyses = []
+    size = 0
+    omitted = 0
+    for path in ranked:
+        entry = index["files"][path]
+        if path in entry_contents:
+            analysis = entry_contents[path]
+        else:
+            lines = [f"Inclut : {', '.join(entry['includes'])}"] if entry["includes"] else []
+            lines += [index["declarations"][declaration_id]["text"] for declaration_id in entry["declares"]]
+            analysis = "\n".join(lines)
+        if size + len(analysis) > max_chars:
+            omitted += 1
+            continue
+        file_analyses.append((f"{repo_name}/{path}", analysis))
+        size += len(path) + len(analysis)
+    return file_analyses, omitted
+
+
+def generate_readme(file_analyses, trace=None, omitted=0):
+    trace = trace or Trace(None, "function-2-readme")
+    model = get_model()
+    prompt = build_readme_prompt(file_analyses, omitted)
+    with trace.timed("model_ms"):
+        response = model.generate_content([prompt])
+    record_model_usage(trace, prompt, response)
     return response
 
 
@@ -38,15 +226,14 @@ def read_file_to_variable(blob):
 
 
 def write_variable_to_file(path, content):
-    bucket = storage_client.bucket(BUCKET)
+    bucket = get_storage_client().bucket(BUCKET)
     blob = bucket.blob(path)
     with blob.open("w") as f:
         f.write(content)
 
 
 def list_all_file_paths(bucket_name, directory_path):
-    storage_client = storage.Client()
-    bucket = storage_client.bucket(bucket_name)
+    bucket = get_storage_client().bucket(bucket_name)
     file_paths = []
     queue = [directory_path]
     while queue:
@@ -84,23 +271,50 @@ def run_inference(request):
 
     logger.log(f"storage_uri for readme : {storage_uri}")
 
+    trace = start_trace(request, "function-2-readme")
     path_directory = storage_uri.removeprefix("gs://doxygen-gcp-storage/")
-    list_files = list_all_file_paths(BUCKET, path_directory)
-    file_contents = []
-    while len(list_files) > 0:
-        file_path = list_files.pop()
-        if file_path.endswith(".c") or file_path.endswith(".h"):
-            bucket = storage_client.bucket(BUCKET)
-            blob = bucket.blob(file_path)
-            content = read_file_to_variable(blob)
-            file_contents.append((file_path, content))
-
-    response = generate_readme(file_contents)
-    if response and hasattr(response, "text"):
-        write_variable_to_file(path_directory + "/README.md", response.text)
+    try:
+        with trace.span("load_index") as attributes:
+            repo_name = path_directory.split("/")[0]
+            index = load_symbol_index(repo_name)
+            attributes.update(found=index is not None)
+        trace.count(gcs_rpcs=2 if index is not None else 1)
+        file_contents = []
+        omitted = 0
+        if index is not None:
+            # Only the entry files are read, the other files are described by the index
+            with trace.span("read_files"):
+                entry_contents = {}
+                for relative_path in entry_files(index):
+                    blob = get_storage_client().bucket(BUCKET).blob(f"{repo_name}/{relative_path}")
+                    entry_contents[relative_path] = read_file_to_variable(blob)
+                    trace.count(files=1, gcs_rpcs=1, bytes_read=len(entry_contents[relative_path].encode("utf-8")))
+                file_contents, omitted = build_repository_overview(index, repo_name, entry_contents)
+        else:
+            with trace.span("list_files"):
+                list_files = list_all_file_paths(BUCKET, path_directory)
+            trace.count(gcs_rpcs=1)
+            with trace.span("read_files"):
+                while len(list_files) > 0:
+                    file_path = list_files.pop()
+                    if file_path.endswith(".c") or file_path.endswith(".h"):
+                        bucket = get_storage_client().bucket(BUCKET)
+                        blob = bucket.blob(file_path)
+                        content = read_file_to_variable(blob)
+                        file_contents.append((file_path, content))
+                        trace.count(files=1, gcs_rpcs=1, bytes_read=len(content.encode("utf-8")))
+
+        with trace.span("generate_readme"):
+            response = generate_readme(file_contents, trace=trace, omitted=omitted)
+        if response and hasattr(response, "text"):
+            with trace.span("write_readme"):
+                write_variable_to_file(path_directory + "/README.md", response.text)
+            trace.count(gcs_rpcs=1, bytes_written=len(response.text.encode("utf-8")))
+    finally:
+        trace.export()
 
     status_readme = "OK"
 
     logger.log(f"README.md created : {status_readme}")
 
-    return json.dumps({"status_readme": status_readme})
+    return json.dumps({"status_readme": status_readme, "trace_id": trace.trace_id})
\ No newline at end of file
@@ -1,22 +1,470 @@
 import os
 import json
+import uuid
+import heapq
+import base64
+import random
+import hashlib
+import itertools
+import threading
 import functions_framework
-import vertexai
 import time
-
-from google.cloud import logging, storage
-from vertexai.preview.generative_models import GenerativeModel
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, as_completed, wait, TimeoutError as ResultTimeout
+from contextlib import contextmanager
+from functools import lru_cache
 
 PROJECT_ID = "doxygen-gcp"
 LOCATION = "europe-west1"
 BUCKET = "doxygen-gcp-storage"
-
-client = logging.Client(project=PROJECT_ID)
-client.setup_logging()
+MODEL_NAME = "gemini-1.5-pro"
 
 LOG_NAME = "run_inference-cloudfunction-comment-log"
-logger = client.logger(LOG_NAME)
-storage_client = storage.Client()
+
+# Clients and the model are built on first use rather than at import, to keep cold starts short
+_logger = None
+_logger_lock = threading.Lock()
+
+
+def get_logger():
+    """Sets up Cloud Logging on the first call and returns the function's logger."""
+    global _logger
+    if _logger is None:
+        with _logger_lock:  # setup_logging() must run only once
+            if _logger is None:
+                from google.cloud import logging
+
+                client = logging.Client(project=PROJECT_ID)
+                client.setup_logging()
+                _logger = client.logger(LOG_NAME)
+    return _logger
+
+
+class LazyLogger:
+    """Forwards to the Cloud Logging logger, which is only created when something is logged."""
+
+    def __getattr__(self, name):
+        return getattr(get_logger(), name)
+
+
+logger = LazyLogger()
+
+
+@lru_cache(maxsize=None)
+def get_storage_client():
+    from google.cloud import storage
+
+    return storage.Client()
+
+
+@lru_cache(maxsize=None)
+def get_model(model_name=MODEL_NAME):
+    """Initializes Vertex AI and builds the model once per instance."""
+    import vertexai
+    from vertexai.preview.generative_models import GenerativeModel
+
+    vertexai.init(project=PROJECT_ID, location=LOCATION)
+    return GenerativeModel(model_name)
+
+# Tracing: the Streamlit app sends one trace id per pipeline run in the X-Trace-Id header
+TRACE_HEADER = "X-Trace-Id"
+TRACE_SINK = os.environ.get("TRACE_SINK", "none")  # 'none', 'log' or 'file:<path>' (one JSON record per line)
+CHARS_PER_TOKEN = 4  # Token estimate when the model response carries no usage metadata
+_trace_file_lock = threading.Lock()
+
+
+class Trace:
+    """
+    Spans and counters recorded while serving one request, exported as a single record.
+    """
+
+    def __init__(self, trace_id, service):
+        self.trace_id = trace_id or uuid.uuid4().hex
+        self.service = service
+        self.spans = []
+        self.counters = Counter()
+        self._lock = threading.Lock()
+        self._started_at = time.time()
+
+    @contextmanager
+    def span(self, name, **attributes):
+        started_at = time.time()
+        try:
+            yield attributes
+        except Exception as e:
+            attributes["error"] = str(e)
+            raise
+        finally:
+            with self._lock:
+                self.spans.append({"name": name, "start": started_at,
+                                   "duration_ms": round((time.time() - started_at) * 1000, 1), **attributes})
+
+    @contextmanager
+    def timed(self, counter):
+        """Adds the block's duration to a counter, for steps repeated per file."""
+        started_at = time.time()
+        try:
+            yield
+        finally:
+            self.count(**{counter: round((time.time() - started_at) * 1000, 1)})
+
+    def count(self, **increments):
+        with self._lock:
+            self.counters.update(increments)
+
+    def to_dict(self):
+        with self._lock:
+            return {"trace_id": self.trace_id, "service": self.service, "start": self._started_at,
+                    "duration_ms": round((time.time() - self._started_at) * 1000, 1),
+                    "spans": list(self.spans), "counters": dict(self.counters)}
+
+    def export(self):
+        if TRACE_SINK == "none":
+            return
+        record = self.to_dict()
+        if TRACE_SINK == "log":
+            logger.log_struct(record, severity="INFO")
+        elif TRACE_SINK.startswith("file:"):
+            with _trace_file_lock, open(TRACE_SINK[len("file:"):], "a") as file:
+                file.write(json.dumps(record) + "\n")
+
+
+def start_trace(request, service):
+    """Continues the caller's trace, or starts one for requests sent without the header."""
+    headers = getattr(request, "headers", None) or {}
+    return Trace(headers.get(TRACE_HEADER), service)
+
+
+def record_model_usage(trace, prompt, response):
+    """Counts a model call and its tokens, from the usage metadata when Vertex AI returns it."""
+    usage = getattr(response, "usage_metadata", None)
+    try:
+        text = response.text
+    except ValueError:
+        text = ""
+    trace.count(
+        model_calls=1,
+        model_input_tokens=getattr(usage, "prompt_token_count", 0) or len(prompt) // CHARS_PER_TOKEN,
+        model_output_tokens=getattr(usage, "candidates_token_count", 0) or len(text) // CHARS_PER_TOKEN,
+    )
+
+
+# Fair sharing of the Vertex AI quota between the requests served by this instance. Gemini 1.5
+# models have a dynamic shared quota, with no fixed requests per minute to pace calls to: by
+# default only the calls in flight are capped, and the 429s of a busy region are retried.
+# Set the per-minute limits to a quota of your own, e.g. provisioned throughput.
+MODEL_REQUESTS_PER_MINUTE = int(os.environ.get("MODEL_REQUESTS_PER_MINUTE", "0"))  # 0: no request limit
+MODEL_TOKENS_PER_MINUTE = int(os.environ.get("MODEL_TOKENS_PER_MINUTE", "0"))  # 0: no token limit
+MODEL_MAX_IN_FLIGHT = int(os.environ.get("MODEL_MAX_IN_FLIGHT", "4"))
+COMMENT_WORKERS = int(os.environ.get("COMMENT_WORKERS", "4"))  # Files of one request commented at once
+TENANT_HEADER = "X-Tenant-Id"
+TENANT_WEIGHTS = json.loads(os.environ.get("TENANT_WEIGHTS", "{}"))  # Tenant -> share of the quota, 1 by default
+MODEL_MAX_RETRIES = int(os.environ.get("MODEL_MAX_RETRIES", "5"))  # 429s retried per call
+MODEL_BACKOFF_SECONDS = float(os.environ.get("MODEL_BACKOFF_SECONDS", "2"))
+
+
+class MemoryQuotaBackend:
+    """
+    Requests and tokens per minute over a sliding 60 s window, kept in this instance's memory.
+    A backend shared between instances only needs the same reserve() method.
+    """
+
+    def __init__(self, requests_per_minute=0, tokens_per_minute=0):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._sent = deque()  # (time, tokens) of the calls of the last minute
+        self._tokens = 0
+        self._lock = threading.Lock()
+
+    def reserve(self, tokens):
+        """Records a call of this many tokens and returns 0, or returns how long to wait before it fits."""
+        with self._lock:
+            now = time.time()
+            while self._sent and now - self._sent[0][0] >= 60:
+                self._tokens -= self._sent.popleft()[1]
+            wait = 0
+            if self.requests_per_minute and len(self._sent) >= self.requests_per_minute:
+                wait = 60 - (now - self._sent[0][0])
+            if self.tokens_per_minute and self._sent and self._tokens + tokens > self.tokens_per_minute:
+                # Until enough of the window's calls expire; a call larger than the limit waits for an empty window
+                excess = self._tokens + tokens - self.tokens_per_minute
+                for sent_at, sent_tokens in self._sent:
+                    excess -= sent_tokens
+                    if excess <= 0:
+                        break
+                wait = max(wait, 60 - (now - sent_at))
+            if wait > 0:
+                return max(wait, 0.01)
+            self._sent.append((now, tokens))
+            self._tokens += tokens
+            return 0
+
+
+class FairScheduler:
+    """
+    Shares the model quota between tenants (users or repositories) with weighted fair
+    queueing. Each call is tagged with a virtual finish time: its start (the later of the
+    scheduler's virtual time and the tenant's previous finish tag) plus its estimated tokens
+    divided by the tenant's weight. The call with the smallest finish tag goes next, and the
+    virtual time moves to the start tag of each call sent, so a tenant
+    with a few files overtakes the backlog of a large repository instead of waiting behind
+    it, and busy tenants get tokens in proportion to their weights.
+    """
+
+    def __init__(self, backend, max_in_flight=4, weights=None):
+        self.backend = backend
+        self.max_in_flight = max_in_flight
+        self.weights = weights or {}
+        self._condition = threading.Condition()
+        self._queue = []  # Heap of (finish tag, sequence, tenant, start tag)
+        self._sequence = itertools.count()
+        self._finish_tags = {}  # Tenant -> finish tag of its last queued call
+        self._virtual_time = 0.0
+        self._in_flight = 0
+        self._stats = {}  # Tenant -> Counter of queued, calls, tokens, wait_ms, max_wait_ms
+
+    @contextmanager
+    def slot(self, tenant, tokens):
+        """Blocks until the tenant's call may be sent, and yields the seconds it waited."""
+        started_at = time.time()
+        with self._condition:
+            start = max(self._virtual_time, self._finish_tags.get(tenant, 0.0))
+            self._finish_tags[tenant] = start + max(tokens, 1) / self.weights.get(tenant, 1.0)
+            entry = (self._finish_tags[tenant], next(self._sequence), tenant, start)
+            heapq.heappush(self._queue, entry)
+            stats = self._stats.setdefault(tenant, Counter())
+            stats["queued"] += 1
+            while True:
+                if self._queue[0] is entry and self._in_flight < self.max_in_flight:
+                    wait = self.backend.reserve(tokens)
+                    if not wait:
+                        break
+                    self._condition.wait(wait)
+                else:
+                    self._condition.wait()
+            heapq.heappop(self._queue)
+            self._virtual_time = max(self._virtual_time, start)
+            self._in_flight += 1
+            waited = time.time() - started_at
+            stats.update(queued=-1, calls=1, tokens=tokens, wait_ms=waited * 1000)
+            stats["max_wait_ms"] = max(stats["max_wait_ms"], waited * 1000)
+            self._condition.notify_all()  # The next call in line may go now
+        try:
+            yield waited
+        finally:
+            with self._condition:
+                self._in_flight -= 1
+                if not self._stats[tenant]["queued"] and self._finish_tags.get(tenant, 0.0) <= self._virtual_time:
+                    del self._finish_tags[tenant]  # Idle tenants start again from the virtual time
+                self._condition.notify_all()
+
+    def has_capacity(self):
+        """Whether a new call would be sent right away, as far as the queue and the calls in flight go."""
+        with self._condition:
+            return not self._queue and self._in_flight < self.max_in_flight
+
+    def metrics(self):
+        """Queue depth, calls in flight, and each tenant's calls, tokens and time spent waiting."""
+        with self._condition:
+            return {
+                "queue_depth": len(self._queue),
+                "in_flight": self._in_flight,
+                "tenants": {
+                    tenant: {
+                        "queued": stats["queued"],
+                        "calls": stats["calls"],
+                        "tokens": stats["tokens"],
+                        "mean_wait_ms": round(stats["wait_ms"] / stats["calls"], 1) if stats["calls"] else 0,
+                        "max_wait_ms": round(stats["max_wait_ms"], 1),
+                    }
+                    for tenant, stats in self._stats.items()
+                },
+            }
+
+
+scheduler = FairScheduler(MemoryQuotaBackend(MODEL_REQUESTS_PER_MINUTE, MODEL_TOKENS_PER_MINUTE),
+                          MODEL_MAX_IN_FLIGHT, TENANT_WEIGHTS)
+
+
+def resolve_tenant(request, request_json, path_directory):
+    """The caller's tenant: the 'tenant' field, the X-Tenant-Id header, or else the repository."""
+    headers = getattr(request, "headers", None) or {}
+    return (request_json or {}).get("tenant") or headers.get(TENANT_HEADER) or path_directory.split("/")[0]
+
+
+# Hedged model calls: a call slower than most recent ones is sent a second time, and the first answer wins
+HEDGE_PERCENTILE = float(os.environ.get("HEDGE_PERCENTILE", "0"))  # e.g. 95; 0 disables hedging
+HEDGE_BUDGET = float(os.environ.get("HEDGE_BUDGET", "0.1"))  # Duplicates per run, as a share of its model calls
+HEDGE_MIN_SAMPLES = 20  # Latencies measured before the percentile is trusted
+
+
+class Hedging:
+    """
+    Latencies of this instance's last model calls, from which the hedging threshold is
+    taken online, and the outcome of the hedges sent.
+    """
+
+    def __init__(self, percentile=HEDGE_PERCENTILE, window=200, min_samples=HEDGE_MIN_SAMPLES):
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self._latencies = deque(maxlen=window)
+        self._stats = Counter()
+        self._lock = threading.Lock()
+
+    def record_latency(self, seconds):
+        with self._lock:
+            self._latencies.append(seconds)
+
+    def record(self, **increments):
+        with self._lock:
+            self._stats.update(increments)
+
+    def threshold(self):
+        """Seconds after which a call is hedged, or None while hedging is off or still measuring."""
+        with self._lock:
+            if not self.percentile or len(self._latencies) < self.min_samples:
+                return None
+            ordered = sorted(self._latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * self.percentile / 100))]
+
+    def metrics(self):
+        threshold = self.threshold()
+        with self._lock:
+            stats = dict(self._stats)
+        calls, hedges, wins = stats.get("calls", 0), stats.get("hedges", 0), stats.get("hedge_wins", 0)
+        return {
+            "percentile": self.percentile,
+            "threshold_ms": round(threshold * 1000, 1) if threshold is not None else None,
+            "calls": calls,
+            "hedges": hedges,
+            "hedge_rate": round(hedges / calls, 4) if calls else 0,
+            "hedge_wins": wins,
+            "latency_saved_ms": round(stats.get("saved_ms", 0), 1),
+            "mean_saved_ms": round(stats.get("saved_ms", 0) / wins, 1) if wins else 0,
+        }
+
+
+class HedgeBudget:
+    """Caps the duplicate calls of one run at a share of its model calls."""
+
+    def __init__(self, ratio=HEDGE_BUDGET):
+        self.ratio = ratio
+        self.calls = 0
+        self.hedges = 0
+        self._lock = threading.Lock()
+
+    def add_call(self):
+        with self._lock:
+            self.calls += 1
+
+    def spend(self):
+        with self._lock:
+            if self.hedges + 1 > self.ratio * self.calls:
+                return False
+            self.hedges += 1
+            return True
+
+
+hedging = Hedging()
+
+
+@lru_cache(maxsize=None)
+def get_hedge_executor():
+    # Roomy, so that calls wait in the scheduler's fair queue rather than for a thread
+    return ThreadPoolExecutor(max_workers=64, thread_name_prefix="model-call")
+
+
+def generate_content(model, prompt):
+    """
+    Calls the model, retrying calls rejected with a 429 after an exponential backoff. The
+    call keeps its slot meanwhile, so the instance sends fewer calls while the quota is short.
+    """
+    attempt = 0
+    while True:
+        try:
+            return model.generate_content(prompt)
+        except Exception as e:
+            if getattr(e, "code", None) != 429 or attempt >= MODEL_MAX_RETRIES:
+                raise
+        delay = MODEL_BACKOFF_SECONDS * (2 ** attempt) * (1 + random.random())
+        logger.log(f"Gemini quota exceeded, retrying in {delay:.1f}s")
+        time.sleep(delay)
+        attempt += 1
+
+
+def send_model_call(model, prompt, tenant, tokens, answered=None, sent=None):
+    """
+    One model call within the tenant's share of the quota; sent is set once it leaves the
+    queue. Returns (response, latency), or (None, 0) for a duplicate whose original was
+    answered while it was queued.
+    """
+    with scheduler.slot(tenant, tokens):
+        if answered is not None and answered.done():
+            return None, 0
+        if sent is not None:
+            sent.set()
+        started_at = time.time()
+        response = generate_content(model, prompt)
+    latency = time.time() - started_at
+    hedging.record_latency(latency)
+    return response, latency
+
+
+def generate_hedged(model, prompt, trace, tenant, hedge_budget=None):
+    """
+    Sends the prompt to the model. With hedging on and a hedge_budget, a call still running
+    after the hedging threshold is sent a second time, if the run's budget and the quota
+    allow, and the first answer wins; the slower call is left to finish in the background.
+    """
+    tokens = len(prompt) // CHARS_PER_TOKEN
+    threshold = hedging.threshold() if hedge_budget is not None else None
+    hedging.record(calls=1)
+    if hedge_budget is not None:
+        hedge_budget.add_call()
+    if threshold is None:
+        with scheduler.slot(tenant, tokens) as waited:
+            trace.count(queue_wait_ms=round(waited * 1000, 1))
+            started_at = time.time()
+            with trace.timed("model_ms"):
+                response = generate_content(model, prompt)
+        hedging.record_latency(time.time() - started_at)
+        return response
+
+    submitted_at = time.time()
+    sent = threading.Event()
+    primary = get_hedge_executor().submit(send_model_call, model, prompt, tenant, tokens, None, sent)
+    primary.add_done_callback(lambda future: sent.set())  # Also when it fails in the queue
+    sent.wait()  # The threshold counts from when the call is sent, not queued
+    sent_at = time.time()
+    trace.count(queue_wait_ms=round((sent_at - submitted_at) * 1000, 1))
+    try:
+        response, latency = primary.result(timeout=threshold)
+        trace.count(model_ms=round(latency * 1000, 1))
+        return response
+    except ResultTimeout:
+        pass
+
+    if not hedge_budget.spend() or not scheduler.has_capacity():
+        trace.count(hedges_skipped=1)
+        response, latency = primary.result()
+        trace.count(model_ms=round(latency * 1000, 1))
+        return response
+    trace.count(hedges=1)
+    hedging.record(hedges=1)
+    hedge = get_hedge_executor().submit(send_model_call, model, prompt, tenant, tokens, primary)
+    winner = primary  # Its error is raised if both calls fail
+    for future in as_completed([primary, hedge]):
+        if future.exception() is None and future.result()[0] is not None:
+            winner = future
+            break
+    response = winner.result()[0]
+    answered_at = time.time()
+    trace.count(model_ms=round((answered_at - sent_at) * 1000, 1))
+    if winner is hedge:
+        trace.count(hedge_wins=1)
+        hedging.record(hedge_wins=1)
+        primary.add_done_callback(lambda future: hedging.record(saved_ms=(time.time() - answered_at) * 1000))
+    return response
 
 
 def read_file_to_variable_intern(file_path):
@@ -33,17 +481,25 @@ def read_file_to_variable_intern(file_path):
         return None
 
 
-# Assuming 'test.c' and 'test2.c' are in the same directory as this script
-INPUT_1 = read_file_to_variable_intern("test.c")
-OUTPUT_1 = read_file_to_variable_intern("test2.c")
-INPUT_2 = read_file_to_variable_intern("user_manager.h")
-OUTPUT_2 = read_file_to_variable_intern("user_manager2.h")
-INPUT_3 = read_file_to_variable_intern("ft_atoi.c")
-OUTPUT_3 = read_file_to_variable_intern("ft_atoi2.c")
-INPUT_4 = read_file_to_variable_intern("philo_one.h")
-OUTPUT_4 = read_file_to_variable_intern("philo_one2.h")
-INPUT_5 = read_file_to_variable_intern("struct.c")
-OUTPUT_5 = read_file_to_variable_intern("struct2.c")
+# The example files live in the same directory as this script, as (input, commented output) pairs
+EXAMPLES_DIR = os.path.dirname(os.path.abspath(__file__))
+EXAMPLE_FILES = [
+    ("test.c", "test2.c"),
+    ("user_manager.h", "user_manager2.h"),
+    ("ft_atoi.c", "ft_atoi2.c"),
+    ("philo_one.h", "philo_one2.h"),
+    ("struct.c", "struct2.c"),
+]
+
+
+@lru_cache(maxsize=None)
+def load_examples():
+    """Reads the few-shot examples once per instance, on the first prompt."""
+    return tuple(
+        (read_file_to_variable_intern(os.path.join(EXAMPLES_DIR, input_name)),
+         read_file_to_variable_intern(os.path.join(EXAMPLES_DIR, output_name)))
+        for input_name, output_name in EXAMPLE_FILES
+    )
 
 
 def read_file_to_variable(blob):
@@ -52,12 +508,44 @@ def read_file_to_variable(blob):
         return file_content
 
 
-def useGemini(file_content, delay=2):
-    vertexai.init(project=PROJECT_ID, location=LOCATION)
-    model = GenerativeModel("gemini-1.5-pro")
-    try:
-        response = model.generate_content(
-            f"""
+# Declarations of other files given with each file, from the symbol index function-1-download stores
+INDEX_PREFIX = "symbol_index/"
+CONTEXT_MAX_CHARS = int(os.environ.get("CONTEXT_MAX_CHARS", "3000"))
+CONTEXT_HEADER = "Déclarations d'autres fichiers du projet utilisées par ce fichier, pour contexte seulement (ne pas les recopier) :"
+
+
+def load_symbol_index(repo_name):
+    """The repository's symbol index, or None for a snapshot stored without one."""
+    blob = get_storage_client().bucket(BUCKET).blob(f"{INDEX_PREFIX}{repo_name}.json")
+    if not blob.exists():
+        return None
+    return json.loads(blob.download_as_text())
+
+
+def declarations_context(index, relative_path, max_chars=CONTEXT_MAX_CHARS):
+    """
+    The declarations from included files that a file uses, most used first, within max_chars,
+    so the prompt stays the same size however large the repository.
+    """
+    if not index or relative_path not in index["files"]:
+        return ""
+    parts = []
+    size = 0
+    for declaration_id, count in index["files"][relative_path]["uses"]:
+        declaration = index["declarations"][declaration_id]
+        text = f"// {declaration['file']}\n{declaration['text']}"
+        if size + len(text) <= max_chars:  # A larger one is skipped, smaller ones may still fit
+            parts.append(text)
+            size += len(text) + 1
+    return "\n".join(parts)
+
+
+def build_comment_prompt(file_content, context=""):
+    """Builds the prompt asking Gemini to add Doxygen comments to a source file, with the
+    declarations it uses from other files as context."""
+    examples = "\n            ".join(f"INPUT {example} OUTPUT {commented}" for example, commented in load_examples())
+    context_section = f"{CONTEXT_HEADER}\n            {context}\n            " if context else ""
+    return f"""
             Voici un fichier contenant du code source. Analyse le code pour identifier les signatures des structures, fonctions, typedef, définitions et énumérations.
             Ton objectif est simplement d'ajouter des commentaires explicatifs au-dessus de ces signatures pour les documenter, en utilisant un format compatible avec Doxygen. Ne modifie pas le code source lui-même.
             Instructions pour les commentaires :
@@ -70,14 +558,18 @@ def useGemini(file_content, delay=2):
             - quand tu écrit ne rajoute pas de ```cpp ``` ou ```c``` devant le code source car aprés je réécris tous dans un fichier .c ou .h
             Code source à analyser :
             {file_content}
-            Je te donne des exemples:
-            INPUT {INPUT_1} OUTPUT {OUTPUT_1}
-            INPUT {INPUT_2} OUTPUT {OUTPUT_2}
-            INPUT {INPUT_3} OUTPUT {OUTPUT_3}
-            INPUT {INPUT_4} OUTPUT {OUTPUT_4}
-            INPUT {INPUT_5} OUTPUT {OUTPUT_5}
+            {context_section}Je te donne des exemples:
+            {examples}
             """
-        )
+
+
+def useGemini(file_content, delay=0, trace=None, tenant="default", hedge_budget=None, context=""):
+    trace = trace or Trace(None, "function-3-comment")
+    model = get_model()
+    prompt = build_comment_prompt(file_content, context)
+    try:
+        response = generate_hedged(model, prompt, trace, tenant, hedge_budget)
+        record_model_usage(trace, prompt, response)
         time.sleep(delay)
         return response.text
     except ValueError as e:
@@ -87,51 +579,238 @@ def useGemini(file_content, delay=2):
 
 
 def write_file_to_variable(path, content):
-    bucket = storage_client.bucket(BUCKET)
+    bucket = get_storage_client().bucket(BUCKET)
     blob = bucket.blob(path)
     with blob.open("w") as f:
         f.write(content)
 
 
 def delete_file_from_bucket(path):
-    bucket = storage_client.bucket(BUCKET)
+    bucket = get_storage_client().bucket(BUCKET)
     blob = bucket.blob(path)
     blob.delete()
     print(f"File {path} deleted from bucket {BUCKET}")
 
 
-def list_all_file_paths(bucket_name, directory_path):
-    storage_client = storage.Client()
-    bucket = storage_client.bucket(bucket_name)
-    file_paths = []
-    queue = [directory_path]
-    while queue:
-        current_path = queue.pop(0)
-        # List blobs within the current path
-        blobs = bucket.list_blobs(prefix=current_path)
-        for blob in blobs:
-            # If it's a file (doesn't end with a slash)
-            if not blob.name.endswith("/"):
-                file_paths.append(blob.name)
-            # If it's a "directory" (ends with a slash)
-            else:
-                queue.append(blob.name)
-    return file_paths
+def list_source_files(bucket_name, directory_path):
+    """Returns {path: md5 hash} of the C sources and headers stored under directory_path."""
+    return {blob.name: blob.md5_hash for blob in get_storage_client().bucket(bucket_name).list_blobs(prefix=directory_path)
+            if blob.name.endswith(".c") or blob.name.endswith(".h")}
+
+
+def content_md5(text):
+    """The md5 hash of a text as Cloud Storage reports it for the stored object."""
+    return base64.b64encode(hashlib.md5(text.encode("utf-8")).digest()).decode("ascii")
+
+
+# Checkpoints: one manifest per repository records the state of each file, so a run cut short
+# by the timeout, or several runs at once, only comment the files that are left
+CHECKPOINT_PREFIX = "comment_runs/"
+LEASE_SECONDS = int(os.environ.get("COMMENT_LEASE_SECONDS", "600"))  # A claimed file goes back to others after this
+CLAIM_BATCH = int(os.environ.get("COMMENT_CLAIM_BATCH", "16"))  # Files claimed per manifest update
+CHECKPOINT_SECONDS = int(os.environ.get("COMMENT_CHECKPOINT_SECONDS", "30"))  # Longest wait to record finished files
+COMMENT_RUN_SECONDS = int(os.environ.get("COMMENT_RUN_SECONDS", "0"))  # No new file claimed after this; 0: no limit
+MAX_COMMENT_ATTEMPTS = 3  # Files the model gives no answer for are then left as they are
+
+
+class CheckpointManifest:
+    """
+    The comment state of each source file of a repository, kept as one JSON object in the
+    bucket: pending, in_progress (leased to a worker until lease_until), done (with the md5
+    of the commented file) or failed. Every update is a compare-and-swap on the object's
+    generation, so workers of several instances can share the files of one run.
+    """
+
+    def __init__(self, bucket, repo_name, lease_seconds=LEASE_SECONDS):
+        self.bucket = bucket
+        self.blob_name = f"{CHECKPOINT_PREFIX}{repo_name}.json"
+        self.lease_seconds = lease_seconds
+        self.worker_id = uuid.uuid4().hex
+        self.counts = Counter()  # Files per state, as of the last update
+        self.updates = 0
+        self.conflicts = 0
+
+    def _update(self, change):
+        """Applies change(files) to the latest manifest and writes it back, again on a conflict."""
+        while True:
+            blob = self.bucket.get_blob(self.blob_name)
+            manifest = json.loads(blob.download_as_text()) if blob else {"files": {}}
+            result = change(manifest["files"])
+            try:
+                self.bucket.blob(self.blob_name).upload_from_string(
+                    json.dumps(manifest), content_type="application/json",
+                    if_generation_match=blob.generation if blob else 0)
+            except Exception as e:
+                if getattr(e, "code", None) != 412:  # Precondition failed: another worker wrote first
+                    raise
+                self.conflicts += 1
+                time.sleep(random.uniform(0.05, 0.5))
+                continue
+            self.updates += 1
+            self.counts = Counter(record["state"] for record in manifest["files"].values())
+            return result
+
+    def sync(self, hashes):
+        """
+        Reconciles the manifest with the stored files' md5 hashes: new or re-uploaded files
+        become pending, and a file rewritten by a worker stopped before recording it is done.
+        """
+        def change(files):
+            for path in set(files) - set(hashes):
+                del files[path]
+            for path, md5 in hashes.items():
+                record = files.get(path)
+                if record is None:
+                    files[path] = {"state": "pending", "input_md5": md5}
+                elif record["state"] == "in_progress":
+                    if md5 != record["input_md5"]:
+                        files[path] = {"state": "done", "input_md5": record["input_md5"], "output_md5": md5}
+                elif record["state"] == "done":
+                    if md5 != record["output_md5"]:
+                        files[path] = {"state": "pending", "input_md5": md5}
+                elif md5 != record["input_md5"]:
+                    files[path] = {"state": "pending", "input_md5": md5}
+        self._update(change)
+        return dict(self.counts)
+
+    def checkpoint(self, finished=None, claim=0, release=()):
+        """
+        Records the finished files ({path: md5 of the commented file, None when the model gave
+        no answer, or the exception commenting it raised}), gives back the released ones, and
+        claims up to claim files: pending, or in progress with an expired lease. Returns the
+        claimed (path, input md5) pairs.
+        """
+        finished = finished or {}
+        if not finished and not claim and not release:
+            return []
+
+        def change(files):
+            now = time.time()
+            for path, output_md5 in finished.items():
+                record = files.get(path)
+                if record is None:
+                    continue
+                if isinstance(output_md5, Exception):
+                    files[path] = {"state": "failed", "input_md5": record["input_md5"], "error": str(output_md5)}
+                elif output_md5 is not None:
+                    files[path] = {"state": "done", "input_md5": record["input_md5"], "output_md5": output_md5}
+                else:
+                    attempts = record.get("attempts", 0) + 1
+                    files[path] = {"state": "failed" if attempts >= MAX_COMMENT_ATTEMPTS else "pending",
+                                   "input_md5": record["input_md5"], "attempts": attempts}
+            for path in release:
+                record = files.get(path)
+                if record and record["state"] == "in_progress" and record.get("owner") == self.worker_id:
+                    record["state"] = "pending"
+                    del record["owner"], record["lease_until"]
+            claimed = []
+            for path, record in sorted(files.items()):
+                if len(claimed) >= claim:
+                    break
+                if record["state"] == "pending" or (record["state"] == "in_progress" and record["lease_until"] < now):
+                    record.update(state="in_progress", owner=self.worker_id, lease_until=now + self.lease_seconds)
+                    claimed.append((path, record["input_md5"]))
+            return claimed
+        return self._update(change)
+
+
+def comment_with_checkpoints(manifest, trace, tenant, hedge_budget=None, index=None, deadline=None):
+    """
+    Comments the files the manifest has left, COMMENT_WORKERS at a time. Files are claimed
+    CLAIM_BATCH at a time, and finished ones are recorded with the next claim or at least
+    every CHECKPOINT_SECONDS, so a run cut short only redoes the files it was working on.
+    Past the deadline, no new file is started and the unstarted claims are given back. A file
+    whose comment raises is marked failed while the others go on. Returns the failed paths.
+    """
+    claimed = deque()
+    running = {}
+    finished = {}
+    errors = []
+
+    def record(future, path):
+        try:
+            finished[path] = future.result()
+        except Exception as e:
+            logger.log(f"Commenting {path} failed: {e}")
+            finished[path] = e
+            errors.append(path)
+
+    last_checkpoint = time.time()
+    more = True
+    try:
+        with ThreadPoolExecutor(max_workers=COMMENT_WORKERS) as executor:
+            while True:
+                if deadline is not None and time.time() > deadline:
+                    more = False
+                if more and not claimed and len(running) < COMMENT_WORKERS:
+                    batch = manifest.checkpoint(finished, CLAIM_BATCH)
+                    finished, last_checkpoint = {}, time.time()
+                    claimed.extend(batch)
+                    more = bool(batch)
+                elif finished and time.time() - last_checkpoint >= CHECKPOINT_SECONDS:
+                    manifest.checkpoint(finished)
+                    finished, last_checkpoint = {}, time.time()
+                while more and claimed and len(running) < COMMENT_WORKERS:
+                    path, input_md5 = claimed.popleft()
+                    running[executor.submit(comment_file, path, trace, tenant, hedge_budget, index, input_md5)] = path
+                if not running:
+                    break
+                done, _ = wait(running, timeout=CHECKPOINT_SECONDS, return_when=FIRST_COMPLETED)
+                for future in done:
+                    record(future, running.pop(future))
+    finally:
+        # The executor has waited for the files in flight when a manifest update stopped the loop
+        for future, path in running.items():
+            record(future, path)
+        manifest.checkpoint(finished, release=[path for path, input_md5 in claimed])
+        trace.count(checkpoint_updates=manifest.updates, checkpoint_conflicts=manifest.conflicts,
+                    files_failed=len(errors))
+    return errors
+
+
+def comment_file(file_path, trace, tenant, hedge_budget=None, index=None, input_md5=None):
+    """
+    Replaces one stored source file with its commented version, and returns the md5 of the
+    stored file, or None if the model gave no answer. A file whose content no longer has
+    input_md5 was already commented, and is left as is.
+    """
+    bucket = get_storage_client().bucket(BUCKET)
+    blob = bucket.blob(file_path)
+    with trace.timed("gcs_ms"):
+        file_content = read_file_to_variable(blob)
+    trace.count(files=1, gcs_rpcs=1, bytes_read=len(file_content.encode("utf-8")))
+    if input_md5 is not None and content_md5(file_content) != input_md5:
+        trace.count(files_already_commented=1)
+        return content_md5(file_content)
+    context = declarations_context(index, file_path.split("/", 1)[-1])
+    trace.count(context_chars=len(context))
+    response = useGemini(file_content, trace=trace, tenant=tenant, hedge_budget=hedge_budget, context=context)
+    if response is not None:
+        with trace.timed("gcs_ms"):
+            delete_file_from_bucket(file_path)
+            write_file_to_variable(file_path, response)
+        trace.count(files_commented=1, gcs_rpcs=2, bytes_written=len(response.encode("utf-8")))
+        return content_md5(response)
+    return None
 
 
 @functions_framework.http
 def run_inference(request):
     """HTTP Cloud Function.
     Args:
-        a GET HTTP request with 'storage_uri' query parameter
+        a GET HTTP request with 'storage_uri' query parameter, and optionally the 'tenant'
+        whose share of the model quota it uses; 'metrics' returns the scheduler's queues and
+        the hedging statistics instead
     Returns:
         a HTTP response with the status response
-        lala
     """
 
     request_json = request.get_json(silent=True)
     request_args = request.args
 
+    if request_args and "metrics" in request_args:
+        return json.dumps({**scheduler.metrics(), "hedging": hedging.metrics()})
+
     if request_json and "storage_uri" in request_json:
         storage_uri = request_json["storage_uri"]
     elif request_args and "storage_uri" in request_args:
@@ -141,22 +820,35 @@ def run_inference(request):
 
     logger.log(f"storage_uri for comment : {storage_uri}")
 
-    status_comment = "to do"
+    trace = start_trace(request, "function-3-comment")
 
     path_directory = storage_uri.removeprefix("gs://doxygen-gcp-storage/")
+    tenant = resolve_tenant(request, request_json, path_directory)
 
-    list_files = list_all_file_paths(BUCKET, path_directory)
-    while len(list_files) > 0:
-        file_path = list_files.pop()
-        if file_path.endswith(".c") or file_path.endswith(".h"):
-            bucket = storage_client.bucket(BUCKET)
-            blob = bucket.blob(file_path)
-            file_content = read_file_to_variable(blob)
-            response = useGemini(file_content)
-            if response is not None:
-                delete_file_from_bucket(file_path)
-                write_file_to_variable(file_path, response)
+    deadline = time.time() + COMMENT_RUN_SECONDS if COMMENT_RUN_SECONDS else None
+    repo_name = path_directory.split("/")[0]
+
+    try:
+        with trace.span("list_files"):
+            hashes = list_source_files(BUCKET, path_directory)
+        trace.count(gcs_rpcs=1)
+        with trace.span("load_index") as attributes:
+            index = load_symbol_index(repo_name)
+            attributes.update(found=index is not None)
+        trace.count(gcs_rpcs=2 if index is not None else 1)
+        # Only the files not commented yet by an earlier, interrupted run or by a parallel one
+        manifest = CheckpointManifest(get_storage_client().bucket(BUCKET), repo_name)
+        with trace.span("sync_checkpoint") as attributes:
+            attributes.update(manifest.sync(hashes))
+        # The scheduler paces the model calls, and shares them fairly with other requests
+        hedge_budget = HedgeBudget()
+        with trace.span("comment_files", tenant=tenant):
+            errors = comment_with_checkpoints(manifest, trace, tenant, hedge_budget, index, deadline)
+    finally:
+        trace.export()
     # logger.log(f"Comments created : {response.text}")
-    status_comment = "ok"
+    # Partial: files are left for another call, still leased to a parallel one, or failed in this one
+    files = {state: manifest.counts[state] for state in ("pending", "in_progress", "done", "failed")}
+    status_comment = "partial" if files["pending"] or files["in_progress"] or errors else "ok"
 
-    return json.dumps({"status_comment": status_comment})
+    return json.dumps({"status_comment": status_comment, "files": files, "trace_id": trace.trace_id, "tenant": tenant})
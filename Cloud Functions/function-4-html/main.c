@@ -1,21 +1,103 @@
 import os
-import subprocess
-import uuid
+import re
+import time
 import shutil
+import signal
+import subprocess
+import threading
 import json
+import zipfile
+import base64
+import hashlib
+import mimetypes
 import logging
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from dataclasses import dataclass, field
 from datetime import timedelta
-from typing import List
+from functools import lru_cache
+from typing import TYPE_CHECKING, BinaryIO, Dict, List, TextIO
 
-from google.cloud import storage
 from flask import Request, jsonify
 import functions_framework
 
+if TYPE_CHECKING:  # Imported on first use, to keep cold starts short
+    from google.cloud import storage
+
 # Initialize logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Tracing: the Streamlit app sends one trace id per pipeline run in the X-Trace-Id header
+TRACE_HEADER = "X-Trace-Id"
+TRACE_SINK = os.environ.get("TRACE_SINK", "none")  # 'none', 'log' or 'file:<path>' (one JSON record per line)
+_trace_file_lock = threading.Lock()
+
+
+class Trace:
+    """
+    Spans and counters recorded while serving one request, exported as a single record.
+    """
+
+    def __init__(self, trace_id, service):
+        self.trace_id = trace_id or uuid.uuid4().hex
+        self.service = service
+        self.spans = []
+        self.counters = Counter()
+        self._lock = threading.Lock()
+        self._started_at = time.time()
+
+    @contextmanager
+    def span(self, name, **attributes):
+        started_at = time.time()
+        try:
+            yield attributes
+        except Exception as e:
+            attributes["error"] = str(e)
+            raise
+        finally:
+            with self._lock:
+                self.spans.append({"name": name, "start": started_at,
+                                   "duration_ms": round((time.time() - started_at) * 1000, 1), **attributes})
+
+    @contextmanager
+    def timed(self, counter):
+        """Adds the block's duration to a counter, for steps repeated per file."""
+        started_at = time.time()
+        try:
+            yield
+        finally:
+            self.count(**{counter: round((time.time() - started_at) * 1000, 1)})
+
+    def count(self, **increments):
+        with self._lock:
+            self.counters.update(increments)
+
+    def to_dict(self):
+        with self._lock:
+            return {"trace_id": self.trace_id, "service": self.service, "start": self._started_at,
+                    "duration_ms": round((time.time() - self._started_at) * 1000, 1),
+                    "spans": list(self.spans), "counters": dict(self.counters)}
+
+    def export(self):
+        if TRACE_SINK == "none":
+            return
+        record = self.to_dict()
+        if TRACE_SINK == "log":
+            logger.info(json.dumps(record))
+        elif TRACE_SINK.startswith("file:"):
+            with _trace_file_lock, open(TRACE_SINK[len("file:"):], "a") as file:
+                file.write(json.dumps(record) + "\n")
+
+
+def start_trace(request, service):
+    """Continues the caller's trace, or starts one for requests sent without the header."""
+    headers = getattr(request, "headers", None) or {}
+    return Trace(headers.get(TRACE_HEADER), service)
+
+
 @dataclass
 class Config:
     project_id: str
@@ -28,8 +110,21 @@ class Config:
     signed_url_expiration_seconds: int = 3600
     doxygen_binary_blob_name: str = 'doxygen'
     docs_output_dir: str = '/tmp/docs'  # Directory where Doxygen outputs documentation
-    zip_output_path: str = '/tmp/docs.zip'  # Path to store the zipped documentation
+    zip_compress_level: int = 1  # Deflate level for the streamed archive (1 = fastest)
+    upload_chunk_size: int = 8 * 1024 * 1024  # Resumable upload chunk size, multiple of 256 KiB
     gcs_docs_prefix: str = 'generated_docs/'  # GCS prefix for uploaded documentation
+    publish_mode: str = 'zip'  # 'zip' uploads one archive, 'site' syncs the unpacked HTML tree
+    site_name: str = ''  # Stable per-repo name used in 'site' mode, defaults to the last GCS prefix
+    gcs_sites_prefix: str = 'sites/'  # GCS prefix under which unpacked sites are published
+    site_base_url: str = ''  # Public or CDN-fronted URL of the bucket's root, required in 'site' mode (the bucket is private)
+    sync_workers: int = 16  # Parallel uploads/deletes when syncing a site
+    use_build_cache: bool = True  # Reuse the previous artifact when the build inputs are unchanged
+    doxygen_timeout_seconds: int = 3000  # Wall-clock limit for the Doxygen run
+    gcs_logs_prefix: str = 'doxygen_logs/'  # GCS prefix for full Doxygen output logs
+    warning_summary_max_files: int = 20  # Files listed in the response's warning summary
+    shard_threshold_files: int = 2000  # Source trees with at least this many files are built in shards (0 disables)
+    shard_workers: int = field(default_factory=lambda: os.cpu_count() or 2)  # Parallel Doxygen processes for sharded builds
+    shard_work_dir: str = '/tmp/shards'  # Scratch space for per-shard Doxyfiles, tag files and outputs
     service_account_key_blob_name: str = 'doxygen-gcp-cc505b0f3449.json'
 
 def generate_signed_url_with_key(bucket_name: str, blob_name: str, key_file_path: str, expiration: int = 3600) -> str:
@@ -37,6 +132,8 @@ def generate_signed_url_with_key(bucket_name: str, blob_name: str, key_file_path
     Generates a signed URL using the provided service account key.
     """
     try:
+        from google.cloud import storage
+
         storage_client = storage.Client.from_service_account_json(key_file_path)
         bucket = storage_client.bucket(bucket_name)
         blob = bucket.blob(blob_name)
@@ -45,7 +142,7 @@ def generate_signed_url_with_key(bucket_name: str, blob_name: str, key_file_path
     except Exception as e:
         raise RuntimeError(f"Error generating signed URL for {blob_name}: {str(e)}")
 
-def download_service_account_key(storage_client: storage.Client, bucket_name: str, blob_name: str, local_path: str) -> None:
+def download_service_account_key(storage_client: "storage.Client", bucket_name: str, blob_name: str, local_path: str) -> None:
     """
     Downloads the specified JSON service account key file from GCS.
     """
@@ -57,7 +154,7 @@ def download_service_account_key(storage_client: storage.Client, bucket_name: st
     except Exception as e:
         raise RuntimeError(f"Error downloading service account key {blob_name}: {str(e)}")
 
-def download_blob(storage_client: storage.Client, bucket_name: str, blob_name: str, local_path: str) -> None:
+def download_blob(storage_client: "storage.Client", bucket_name: str, blob_name: str, local_path: str) -> None:
     try:
         bucket = storage_client.bucket(bucket_name)
         blob = bucket.blob(blob_name)
@@ -65,10 +162,22 @@ def download_blob(storage_client: storage.Client, bucket_name: str, blob_name: s
     except Exception as e:
         raise RuntimeError(f"Error downloading blob {blob_name}: {str(e)}")
 
-def download_directory(storage_client: storage.Client, bucket_name: str, gcs_prefix: str, local_destination: str) -> None:
+def empty_directory(path: str) -> None:
+    """
+    Removes what an earlier request left in path, so a warm instance never mixes two builds.
+    """
+    if os.path.normpath(path) in ('/', '/tmp'):
+        raise EnvironmentError(f"Refusing to empty {path}")
+    shutil.rmtree(path, ignore_errors=True)
+
+def download_directory(storage_client: "storage.Client", bucket_name: str, gcs_prefix: str, local_destination: str) -> tuple:
+    """
+    Downloads every object under gcs_prefix and returns the number of files and bytes downloaded.
+    """
     try:
         bucket = storage_client.bucket(bucket_name)
         blobs = bucket.list_blobs(prefix=gcs_prefix)
+        files = downloaded_bytes = 0
 
         for blob in blobs:
             if blob.name.endswith('/'):
@@ -78,10 +187,13 @@ def download_directory(storage_client: storage.Client, bucket_name: str, gcs_pre
             local_dir = os.path.dirname(local_path)
             os.makedirs(local_dir, exist_ok=True)
             blob.download_to_filename(local_path)
+            files += 1
+            downloaded_bytes += os.path.getsize(local_path)
+        return files, downloaded_bytes
     except Exception as e:
         raise RuntimeError(f"Error downloading directory with prefix {gcs_prefix}: {str(e)}")
 
-def download_doxygen_binary(storage_client: storage.Client, bucket_name: str, blob_name: str, local_path: str) -> None:
+def download_doxygen_binary(storage_client: "storage.Client", bucket_name: str, blob_name: str, local_path: str) -> None:
     """
     Downloads the Doxygen binary from GCS and saves it to /tmp, setting execute permissions.
     """
@@ -95,7 +207,67 @@ def download_doxygen_binary(storage_client: storage.Client, bucket_name: str, bl
     except Exception as e:
         raise RuntimeError(f"Error downloading Doxygen binary: {str(e)}")
 
-def preprocess_doxyfile(storage_client: storage.Client, bucket_name: str, doxyfile_blob_name: str, local_path: str) -> str:
+def rewrite_doxyfile_paths(doxyfile_contents: List[str], base_dir: str = '/tmp') -> List[str]:
+    """Makes the relative paths of the Doxyfile lines absolute under base_dir."""
+    updated_contents = []
+    for line in doxyfile_contents:
+        # Skip comments and empty lines
+        stripped_line = line.strip()
+        if stripped_line.startswith('#') or stripped_line == '':
+            updated_contents.append(line)
+            continue
+        
+        # Split the line into key and value
+        if '=' in line:
+            key, value = line.split('=', 1)
+            operator = '+=' if key.rstrip().endswith('+') else '='
+            key = key.strip().rstrip('+').strip()
+            value = value.strip()
+            
+            # List of Doxygen tags that may contain paths
+            path_tags = [
+                'INPUT',
+                'OUTPUT_DIRECTORY',
+                'HTML_HEADER',
+                'HTML_FOOTER',
+                'LAYOUT_FILE',
+                'IMAGE_PATH',
+                'EXAMPLE_PATH',
+                'INCLUDE_PATH',
+                'STRIP_FROM_PATH',
+                'STRIP_FROM_INC_PATH',
+                'DOT_FONTNAME',
+                'MSCGEN_PATH',
+                'PLANTUML_JAR_PATH',
+                'FILTER_PATTERNS',
+                'FILTER_SOURCE_FILES',
+                'SOURCE_BROWSER',
+                'HTML_EXTRA_STYLESHEET',
+                'HTML_EXTRA_FILES'
+            ]
+            
+            if key in path_tags:
+                # Handle multiple paths separated by spaces, quoted when they contain one
+                paths = split_doxyfile_list(value)
+                new_paths = []
+                for path in paths:
+                    # If path is not absolute, prepend the base directory
+                    if not os.path.isabs(path):
+                        new_path = os.path.join(base_dir, path)
+                        new_paths.append(new_path)
+                    else:
+                        new_paths.append(path)
+                # Reconstruct the line with updated paths
+                new_value = ' '.join(f'"{path}"' if ' ' in path else path for path in new_paths)
+                new_line = f'{key} {operator} {new_value}\n'
+                updated_contents.append(new_line)
+            else:
+                updated_contents.append(line)
+        else:
+            updated_contents.append(line)
+    return updated_contents
+
+def preprocess_doxyfile(storage_client: "storage.Client", bucket_name: str, doxyfile_blob_name: str, local_path: str) -> str:
     try:
         # Download the Doxyfile from GCS
         bucket = storage_client.bucket(bucket_name)
@@ -106,62 +278,7 @@ def preprocess_doxyfile(storage_client: storage.Client, bucket_name: str, doxyfi
         with open(local_path, 'r') as file:
             doxyfile_contents = file.readlines()
         
-        # Modify paths in the Doxyfile
-        updated_contents = []
-        for line in doxyfile_contents:
-            # Skip comments and empty lines
-            stripped_line = line.strip()
-            if stripped_line.startswith('#') or stripped_line == '':
-                updated_contents.append(line)
-                continue
-            
-            # Split the line into key and value
-            if '=' in line:
-                key, value = line.split('=', 1)
-                key = key.strip()
-                value = value.strip()
-                
-                # List of Doxygen tags that may contain paths
-                path_tags = [
-                    'INPUT',
-                    'OUTPUT_DIRECTORY',
-                    'HTML_HEADER',
-                    'HTML_FOOTER',
-                    'LAYOUT_FILE',
-                    'IMAGE_PATH',
-                    'EXAMPLE_PATH',
-                    'INCLUDE_PATH',
-                    'STRIP_FROM_PATH',
-                    'STRIP_FROM_INC_PATH',
-                    'DOT_FONTNAME',
-                    'MSCGEN_PATH',
-                    'PLANTUML_JAR_PATH',
-                    'FILTER_PATTERNS',
-                    'FILTER_SOURCE_FILES',
-                    'SOURCE_BROWSER',
-                    'HTML_EXTRA_STYLESHEET',
-                    'HTML_EXTRA_FILES'
-                ]
-                
-                if key in path_tags:
-                    # Handle multiple paths separated by spaces
-                    paths = value.split()
-                    new_paths = []
-                    for path in paths:
-                        # If path is not absolute, prepend '/tmp/'
-                        if not os.path.isabs(path):
-                            new_path = os.path.join('/tmp', path)
-                            new_paths.append(new_path)
-                        else:
-                            new_paths.append(path)
-                    # Reconstruct the line with updated paths
-                    new_value = ' '.join(new_paths)
-                    new_line = f'{key} = {new_value}\n'
-                    updated_contents.append(new_line)
-                else:
-                    updated_contents.append(line)
-            else:
-                updated_contents.append(line)
+        updated_contents = rewrite_doxyfile_paths(doxyfile_contents)
         
         # Write the modified Doxyfile back to local_path
         with open(local_path, 'w') as file:
@@ -177,82 +294,570 @@ def validate_environment(doxygen_cmd: str) -> None:
         raise EnvironmentError(f"{doxygen_cmd} is not installed or not executable.")
     logger.info(f"Doxygen executable found at {doxygen_cmd}.")
 
-def run_doxygen_command(doxygen_cmd: str, doxyfile_path: str) -> subprocess.CompletedProcess:
-    process = subprocess.run(
+# Doxygen diagnostics look like "<file>:<line>: warning: <message>"
+DIAGNOSTIC_PATTERN = re.compile(r'^(?P<file>.+?):(?P<line>\d+): (?P<level>warning|error): (?P<message>.*)$')
+# First matching pattern wins, so more specific categories come first
+WARNING_CATEGORIES = [
+    ('parameters', re.compile(r'parameter|argument', re.IGNORECASE)),
+    ('undocumented', re.compile(r'is not documented', re.IGNORECASE)),
+    ('unresolved_reference', re.compile(r'unable to resolve|explicit link request', re.IGNORECASE)),
+    ('unknown_command', re.compile(r'unknown command', re.IGNORECASE)),
+    ('markup', re.compile(r'unexpected|unterminated|unsupported|end of comment|html', re.IGNORECASE)),
+]
+
+@dataclass
+class WarningSummary:
+    total: int = 0
+    errors: int = 0
+    by_category: Dict[str, int] = field(default_factory=dict)
+    by_file: Dict[str, int] = field(default_factory=dict)
+
+    def record(self, line: str) -> None:
+        match = DIAGNOSTIC_PATTERN.match(line.strip())
+        if not match:
+            return
+        self.total += 1
+        if match.group('level') == 'error':
+            self.errors += 1
+        category = next((name for name, pattern in WARNING_CATEGORIES if pattern.search(match.group('message'))), 'other')
+        self.by_category[category] = self.by_category.get(category, 0) + 1
+        self.by_file[match.group('file')] = self.by_file.get(match.group('file'), 0) + 1
+
+    def merge(self, other: 'WarningSummary') -> None:
+        self.total += other.total
+        self.errors += other.errors
+        for category, count in other.by_category.items():
+            self.by_category[category] = self.by_category.get(category, 0) + count
+        for file_name, count in other.by_file.items():
+            self.by_file[file_name] = self.by_file.get(file_name, 0) + count
+
+    def to_dict(self, max_files: int = 20) -> dict:
+        top_files = sorted(self.by_file.items(), key=lambda item: item[1], reverse=True)[:max_files]
+        return {
+            "total": self.total,
+            "errors": self.errors,
+            "by_category": self.by_category,
+            "files_with_warnings": len(self.by_file),
+            "top_files": dict(top_files)
+        }
+
+@dataclass
+class DoxygenRunResult:
+    returncode: int
+    timed_out: bool
+    summary: WarningSummary
+
+def run_doxygen_command(doxygen_cmd: str, doxyfile_path: str, log_stream: TextIO, timeout_seconds: int) -> DoxygenRunResult:
+    """
+    Runs Doxygen, streaming its combined output line by line into log_stream while tallying
+    warnings. The process is killed if it exceeds timeout_seconds of wall-clock time.
+    """
+    process = subprocess.Popen(
         [doxygen_cmd, doxyfile_path],
         stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        text=True
+        stderr=subprocess.STDOUT,
+        text=True,
+        errors='replace',
+        start_new_session=True  # Own process group, so dot children are killed with Doxygen
     )
-    return process
+    timed_out = threading.Event()
+
+    def kill_on_timeout():
+        timed_out.set()
+        os.killpg(process.pid, signal.SIGKILL)
 
-def zip_directory(source_dir: str, zip_path: str) -> None:
+    timer = threading.Timer(timeout_seconds, kill_on_timeout)
+    timer.start()
+    summary = WarningSummary()
     try:
-        if os.path.exists(zip_path):
-            os.remove(zip_path)  # Remove existing zip if any
-        shutil.make_archive(base_name=zip_path.replace('.zip', ''), format='zip', root_dir=source_dir)
-        logger.info(f"Directory {source_dir} zipped to {zip_path}.")
-    except Exception as e:
-        raise RuntimeError(f"Error zipping directory {source_dir}: {str(e)}")
+        for line in process.stdout:
+            log_stream.write(line)
+            summary.record(line)
+        returncode = process.wait()
+    finally:
+        timer.cancel()
+    return DoxygenRunResult(returncode=returncode, timed_out=timed_out.is_set(), summary=summary)
+
+def read_doxyfile_tags(doxyfile_path: str) -> Dict[str, str]:
+    """
+    Reads the KEY = VALUE assignments of a Doxyfile, joining lines continued with a backslash.
+    Later assignments win and KEY += VALUE appends, as in Doxygen.
+    """
+    tags = {}
+    with open(doxyfile_path, 'r') as file:
+        statement = ''
+        for line in file:
+            stripped_line = line.strip()
+            if stripped_line.endswith('\\'):
+                statement += stripped_line[:-1] + ' '
+                continue
+            statement, stripped_line = '', (statement + stripped_line).strip()
+            if stripped_line.startswith('#') or '=' not in stripped_line:
+                continue
+            key, value = stripped_line.split('=', 1)
+            key, value = key.strip(), value.strip()
+            if key.endswith('+'):
+                key = key[:-1].strip()
+                value = f"{tags.get(key, '')} {value}".strip()
+            tags[key] = value
+    return tags
+
+def split_doxyfile_list(value: str) -> List[str]:
+    """
+    Splits a Doxyfile list value on whitespace, keeping "quoted items" with spaces whole.
+    """
+    return [quoted or bare for quoted, bare in re.findall(r'"([^"]*)"|(\S+)', value)]
+
+def doxyfile_paths(tags: Dict[str, str], base_dir: str) -> tuple:
+    """
+    Returns the Doxyfile's (INPUT paths, OUTPUT_DIRECTORY) made absolute. Doxygen resolves
+    relative paths against, and defaults both to, the directory it runs from: base_dir.
+    """
+    inputs = [os.path.join(base_dir, path) for path in split_doxyfile_list(tags.get('INPUT', ''))] or [base_dir]
+    output_dir = split_doxyfile_list(tags.get('OUTPUT_DIRECTORY', ''))
+    return inputs, os.path.join(base_dir, output_dir[0]) if output_dir else base_dir
+
+def write_doxyfile_overrides(base_doxyfile: str, path: str, overrides: Dict[str, str]) -> str:
+    """
+    Writes a Doxyfile that includes base_doxyfile and overrides the given tags.
+    """
+    with open(path, 'w') as file:
+        file.write(f'@INCLUDE = {base_doxyfile}\n')
+        for key, value in overrides.items():
+            file.write(f'{key} = {value}\n')
+    return path
 
-def upload_blob(storage_client: storage.Client, bucket_name: str, source_file: str, destination_blob_name: str) -> None:
+def plan_shards(inputs: List[str]) -> tuple:
+    """
+    Splits the INPUT paths by top-level directory: each directory directly under an input
+    directory is a shard, named after it (with a suffix when two inputs share a name).
+    Returns (shards as (name, path) pairs, files left for the root project, total file count).
+    """
+    shards, root_files = [], []
+    names = set()
+    file_count = 0
+    for input_path in inputs:
+        if os.path.isfile(input_path):
+            root_files.append(input_path)
+            file_count += 1
+            continue
+        if not os.path.isdir(input_path):
+            logger.warning(f"Doxyfile INPUT {input_path} does not exist.")
+            continue
+        for entry in sorted(os.scandir(input_path), key=lambda e: e.name):
+            if entry.name.startswith('.'):
+                continue
+            if entry.is_dir():
+                name, suffix = entry.name, 1
+                while name in names:
+                    suffix += 1
+                    name = f'{entry.name}_{suffix}'
+                names.add(name)
+                shards.append((name, entry.path))
+                file_count += sum(len(files) for _, _, files in os.walk(entry.path))
+            else:
+                root_files.append(entry.path)
+                file_count += 1
+    return shards, root_files, file_count
+
+class ShardLogWriter:
+    """
+    Serializes writes from concurrent shard runs into one log, prefixing each line with its shard.
+    """
+    def __init__(self, log_stream: TextIO, lock: threading.Lock, shard_name: str):
+        self.log_stream = log_stream
+        self.lock = lock
+        self.shard_name = shard_name
+
+    def write(self, line: str) -> None:
+        with self.lock:
+            self.log_stream.write(f'[{self.shard_name}] {line}')
+
+def run_sharded_doxygen(doxygen_cmd: str, doxyfile_path: str, log_stream: TextIO,
+                        timeout_seconds: int, workers: int, work_dir: str) -> DoxygenRunResult:
+    """
+    Builds each top-level directory of the Doxyfile's INPUT as its own Doxygen project in parallel,
+    each exporting a tag file. A final linking pass over the root-level files imports every tag file
+    so the root site cross-references the shard sites, which live in subdirectories of its HTML output.
+    """
+    tags = read_doxyfile_tags(doxyfile_path)
+    inputs, output_dir = doxyfile_paths(tags, os.getcwd())  # Doxygen runs from this process's directory
+    html_output = split_doxyfile_list(tags.get('HTML_OUTPUT', '')) or ['html']
+    html_root = os.path.join(output_dir, html_output[0])
+    shards, root_files, _ = plan_shards(inputs)
+    os.makedirs(work_dir, exist_ok=True)
+
+    deadline = time.monotonic() + timeout_seconds
+    lock = threading.Lock()
+
+    def build_shard(shard: tuple) -> DoxygenRunResult:
+        shard_name, shard_path = shard
+        shard_doxyfile = write_doxyfile_overrides(doxyfile_path, os.path.join(work_dir, f'{shard_name}.Doxyfile'), {
+            'INPUT': f'"{shard_path}"',
+            'RECURSIVE': 'YES',
+            'OUTPUT_DIRECTORY': f'"{os.path.join(work_dir, shard_name)}"',
+            'HTML_OUTPUT': f'"{os.path.join(html_root, shard_name)}"',
+            'GENERATE_LATEX': 'NO',
+            'GENERATE_TAGFILE': f'"{os.path.join(work_dir, shard_name)}.tag"'
+        })
+        remaining = max(1, int(deadline - time.monotonic()))
+        return run_doxygen_command(doxygen_cmd, shard_doxyfile, ShardLogWriter(log_stream, lock, shard_name), remaining)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        shard_results = list(executor.map(build_shard, shards))
+
+    # Linking pass: the root project lists the shards and resolves references through their tag files
+    shard_index = os.path.join(work_dir, 'shards.dox')
+    with open(shard_index, 'w') as file:
+        file.write('/** @page shard_index Source directories\n')
+        for shard_name, _ in shards:
+            file.write(f' - <a href="{shard_name}/index.html">{shard_name}</a>\n')
+        file.write(' */\n')
+    tag_files = [f'"{os.path.join(work_dir, shard_name)}.tag={shard_name}"' for shard_name, _ in shards
+                 if os.path.isfile(os.path.join(work_dir, f'{shard_name}.tag'))]
+    root_doxyfile = write_doxyfile_overrides(doxyfile_path, os.path.join(work_dir, 'root.Doxyfile'), {
+        'INPUT': ' '.join(f'"{path}"' for path in root_files + [shard_index]),
+        'RECURSIVE': 'NO',
+        'TAGFILES': ' '.join(tag_files)
+    })
+    remaining = max(1, int(deadline - time.monotonic()))
+    root_result = run_doxygen_command(doxygen_cmd, root_doxyfile, ShardLogWriter(log_stream, lock, 'root'), remaining)
+
+    summary = WarningSummary()
+    for result in shard_results + [root_result]:
+        summary.merge(result.summary)
+    all_results = shard_results + [root_result]
+    return DoxygenRunResult(
+        returncode=next((r.returncode for r in all_results if r.returncode != 0), 0),
+        timed_out=any(r.timed_out for r in all_results),
+        summary=summary
+    )
+
+# Already-compressed assets are stored as-is: deflating them again costs CPU for no gain
+STORED_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.webp', '.ico', '.woff', '.woff2', '.eot', '.zip', '.gz', '.svgz')
+
+def write_zip_directory(stream: BinaryIO, source_dir: str, compress_level: int = 1) -> None:
+    """
+    Writes source_dir as a zip archive into stream, in a stable order, deflating every file
+    but the already-compressed ones.
+    """
+    with zipfile.ZipFile(stream, mode='w', compression=zipfile.ZIP_DEFLATED, compresslevel=compress_level) as archive:
+        for root, dirs, files in os.walk(source_dir):
+            dirs.sort()
+            for file_name in sorted(files):
+                local_path = os.path.join(root, file_name)
+                arcname = os.path.relpath(local_path, source_dir)
+                if file_name.lower().endswith(STORED_EXTENSIONS):
+                    archive.write(local_path, arcname, compress_type=zipfile.ZIP_STORED)
+                else:
+                    archive.write(local_path, arcname)
+
+def stream_zip_directory(storage_client: "storage.Client", bucket_name: str, source_dir: str, destination_blob_name: str,
+                         compress_level: int = 1, chunk_size: int = 8 * 1024 * 1024) -> None:
+    """
+    Zips source_dir straight into a resumable GCS upload, one entry at a time.
+    Only one upload chunk is buffered in memory; no archive is written to /tmp.
+    """
     try:
         bucket = storage_client.bucket(bucket_name)
         blob = bucket.blob(destination_blob_name)
-        blob.upload_from_filename(source_file)
-        logger.info(f"File {source_file} uploaded to {destination_blob_name}.")
+        # zipfile flushes the stream when closing the archive, which BlobWriter only tolerates with ignore_flush
+        with blob.open('wb', chunk_size=chunk_size, ignore_flush=True, content_type='application/zip') as gcs_stream:
+            write_zip_directory(gcs_stream, source_dir, compress_level)
+        logger.info(f"Directory {source_dir} streamed as zip to {destination_blob_name}.")
     except Exception as e:
-        raise RuntimeError(f"Error uploading {source_file} to {destination_blob_name}: {str(e)}")
+        raise RuntimeError(f"Error streaming zip of {source_dir} to {destination_blob_name}: {str(e)}")
 
-def run_doxygen(config: Config) -> dict:
+def local_md5_base64(file_path: str, chunk_size: int = 1024 * 1024) -> str:
+    """
+    Returns the base64 MD5 digest of a local file, in the format GCS reports as blob.md5_hash.
+    """
+    digest = hashlib.md5()
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            digest.update(chunk)
+    return base64.b64encode(digest.digest()).decode('ascii')
+
+def sync_directory_to_gcs(storage_client: "storage.Client", bucket_name: str, source_dir: str, gcs_prefix: str, workers: int = 16,
+                          keep: tuple = ()) -> dict:
+    """
+    Mirrors source_dir under gcs_prefix: uploads new or changed files, skips files whose
+    MD5 already matches the remote object and deletes remote objects with no local counterpart,
+    except the names in keep (relative to gcs_prefix). Returns upload/skip/delete counts.
+    """
     try:
-        # Initialize the storage client with the project ID
-        storage_client = storage.Client(project=config.project_id)
+        bucket = storage_client.bucket(bucket_name)
+        remote_hashes = {blob.name: blob.md5_hash for blob in bucket.list_blobs(prefix=gcs_prefix)
+                         if blob.name[len(gcs_prefix):] not in keep}
+
+        to_upload = []
+        skipped = 0
+        for root, dirs, files in os.walk(source_dir):
+            for file_name in files:
+                local_path = os.path.join(root, file_name)
+                blob_name = gcs_prefix + os.path.relpath(local_path, source_dir).replace(os.sep, '/')
+                remote_hash = remote_hashes.pop(blob_name, None)
+                if remote_hash is not None and remote_hash == local_md5_base64(local_path):
+                    skipped += 1
+                else:
+                    to_upload.append((local_path, blob_name))
+        stale = list(remote_hashes)
 
-        # Download the Doxygen binary
-        doxygen_local_path = '/tmp/doxygen'
-        download_doxygen_binary(storage_client, config.bucket_name, config.doxygen_binary_blob_name, doxygen_local_path)
-        config.doxygen_command = doxygen_local_path  # Update the command to use the binary in /tmp
+        def upload(item):
+            local_path, blob_name = item
+            content_type = mimetypes.guess_type(local_path)[0] or 'application/octet-stream'
+            bucket.blob(blob_name).upload_from_filename(local_path, content_type=content_type)
 
-        key_local_path = '/tmp/doxygen-gcp-cc505b0f3449.json'
-        download_service_account_key(
-            storage_client,
-            config.bucket_name,
-            'doxygen-gcp-cc505b0f3449.json',
-            key_local_path
-        )
+        def delete(blob_name):
+            bucket.blob(blob_name).delete()
 
-        # Validate environment
-        validate_environment(config.doxygen_command)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(upload, to_upload))
+            list(executor.map(delete, stale))
 
-        # Download specified directories
-        for gcs_prefix, local_destination in zip(config.gcs_prefixes, config.local_destinations):
-            download_directory(storage_client, config.bucket_name, gcs_prefix, local_destination)
+        stats = {"uploaded": len(to_upload), "skipped": skipped, "deleted": len(stale)}
+        logger.info(f"Synced {source_dir} to gs://{bucket_name}/{gcs_prefix}: {stats}")
+        return stats
+    except Exception as e:
+        raise RuntimeError(f"Error syncing {source_dir} to {gcs_prefix}: {str(e)}")
 
-        # Preprocess the Doxyfile
-        local_doxyfile_path = preprocess_doxyfile(
-            storage_client,
-            config.bucket_name,
-            config.doxyfile_name,
-            config.local_doxyfile_path
-        )
+def site_prefix(config: Config) -> str:
+    """
+    Returns the stable GCS prefix a repository's unpacked site is published under.
+    """
+    site_name = config.site_name or config.gcs_prefixes[-1].strip('/')
+    return f"{config.gcs_sites_prefix}{site_name}/"
 
-        # Run the Doxygen command
-        process = run_doxygen_command(config.doxygen_command, local_doxyfile_path)
+# Bump when preprocessing or publishing changes in a way that alters the generated artifact
+BUILD_CACHE_VERSION = '1'
+BUILD_DIGEST_MARKER = '.build-digest'  # Written next to a published site, holds the digest it was built from
 
-        # Check for command success
-        if process.returncode != 0:
-            raise subprocess.CalledProcessError(process.returncode, config.doxygen_command, output=process.stdout, stderr=process.stderr)
+def compute_build_digest(storage_client: "storage.Client", config: Config) -> str:
+    """
+    Computes a digest over everything that determines the generated docs: the hashes of the
+    input trees (sources and theme), the Doxyfile contents and the Doxygen binary generation.
+    Only object metadata and the Doxyfile are fetched, so this is cheap compared to a build.
+    """
+    try:
+        bucket = storage_client.bucket(config.bucket_name)
+        digest = hashlib.sha256()
+        digest.update(json.dumps({
+            "version": BUILD_CACHE_VERSION,
+            "local_destinations": config.local_destinations,
+            "publish_mode": config.publish_mode,
+            "zip_compress_level": config.zip_compress_level,
+            "shard_threshold_files": config.shard_threshold_files
+        }, sort_keys=True).encode())
+
+        for gcs_prefix in config.gcs_prefixes:
+            for blob in sorted(bucket.list_blobs(prefix=gcs_prefix), key=lambda b: b.name):
+                digest.update(f"{blob.name}\0{blob.md5_hash or blob.crc32c}\n".encode())
+
+        digest.update(bucket.blob(config.doxyfile_name).download_as_bytes())
+
+        doxygen_blob = bucket.get_blob(config.doxygen_binary_blob_name)
+        if doxygen_blob is None:
+            raise RuntimeError(f"Doxygen binary {config.doxygen_binary_blob_name} not found")
+        digest.update(f"doxygen\0{doxygen_blob.generation}".encode())
+
+        return digest.hexdigest()
+    except Exception as e:
+        raise RuntimeError(f"Error computing build digest: {str(e)}")
+
+def zip_blob_name(config: Config, build_digest: str) -> str:
+    """
+    Returns the content-addressed GCS name of the zip built from the given inputs.
+    """
+    return f"{config.gcs_docs_prefix}{build_digest}.zip"
+
+def find_cached_build(storage_client: "storage.Client", config: Config, build_digest: str) -> bool:
+    """
+    Checks whether an artifact built from the same inputs has already been published.
+    """
+    bucket = storage_client.bucket(config.bucket_name)
+    if config.publish_mode == 'site':
+        marker = bucket.get_blob(site_prefix(config) + BUILD_DIGEST_MARKER)
+        return marker is not None and marker.download_as_text().strip() == build_digest
+    return bucket.blob(zip_blob_name(config, build_digest)).exists()
+
+def site_index_url(storage_client: "storage.Client", config: Config) -> str:
+    """
+    Returns the URL of the published site's entry page, under site_base_url.
+    """
+    prefix = site_prefix(config)
+    index_page = 'html/index.html' if storage_client.bucket(config.bucket_name).blob(prefix + 'html/index.html').exists() else 'index.html'
+    return f"{config.site_base_url.rstrip('/')}/{prefix}{index_page}"
 
-        # Zip the generated documentation
-        zip_directory(config.docs_output_dir, config.zip_output_path)
+@lru_cache(maxsize=None)
+def get_storage_client(project_id: str = None) -> "storage.Client":
+    """Builds one storage client per project (the environment's by default) and reuses it across requests."""
+    from google.cloud import storage
 
-        # Generate a unique name for the zip file in GCS
-        unique_id = str(uuid.uuid4())
-        gcs_blob_name = f"{config.gcs_docs_prefix}{unique_id}.zip"
+    return storage.Client(project=project_id)
 
-        # Upload the zip file to GCS
-        upload_blob(storage_client, config.bucket_name, config.zip_output_path, gcs_blob_name)
+def run_doxygen(config: Config, trace: Trace = None) -> dict:
+    trace = trace or Trace(None, 'function-4-html')
+    try:
+        storage_client = get_storage_client(config.project_id)
+
+        key_local_path = '/tmp/doxygen-gcp-cc505b0f3449.json'
+
+        # Skip the whole build when an artifact from identical inputs already exists
+        with trace.span('build_digest'):
+            build_digest = compute_build_digest(storage_client, config)
+            cache_hit = config.use_build_cache and find_cached_build(storage_client, config, build_digest)
+        trace.count(gcs_rpcs=len(config.gcs_prefixes) + 3)
+        if cache_hit:
+            trace.count(cache_hits=1)
+            logger.info(f"Build cache hit for digest {build_digest}.")
+            if config.publish_mode == 'site':
+                return {
+                    "status": "success",
+                    "cache_hit": True,
+                    "build_digest": build_digest,
+                    "docs_index_url": site_index_url(storage_client, config)
+                }
+            download_service_account_key(
+                storage_client,
+                config.bucket_name,
+                'doxygen-gcp-cc505b0f3449.json',
+                key_local_path
+            )
+            return {
+                "status": "success",
+                "cache_hit": True,
+                "build_digest": build_digest,
+                "docs_signed_url": generate_signed_url_with_key(
+                    bucket_name=config.bucket_name,
+                    blob_name=zip_blob_name(config, build_digest),
+                    key_file_path=key_local_path,
+                    expiration=config.signed_url_expiration_seconds
+                )
+            }
+
+        with trace.span('download_inputs'):
+            # Download the Doxygen binary
+            doxygen_local_path = '/tmp/doxygen'
+            download_doxygen_binary(storage_client, config.bucket_name, config.doxygen_binary_blob_name, doxygen_local_path)
+            config.doxygen_command = doxygen_local_path  # Update the command to use the binary in /tmp
+
+            download_service_account_key(
+                storage_client,
+                config.bucket_name,
+                'doxygen-gcp-cc505b0f3449.json',
+                key_local_path
+            )
+
+            # Validate environment
+            validate_environment(config.doxygen_command)
+
+            # Download specified directories
+            for gcs_prefix, local_destination in zip(config.gcs_prefixes, config.local_destinations):
+                empty_directory(local_destination)
+                files, downloaded_bytes = download_directory(storage_client, config.bucket_name, gcs_prefix, local_destination)
+                trace.count(gcs_rpcs=files + 1, bytes_downloaded=downloaded_bytes)
+
+            # Preprocess the Doxyfile
+            local_doxyfile_path = preprocess_doxyfile(
+                storage_client,
+                config.bucket_name,
+                config.doxyfile_name,
+                config.local_doxyfile_path
+            )
+            trace.count(gcs_rpcs=3)
+
+        # Run the Doxygen command, streaming its output to a log object in GCS
+        log_blob_name = f"{config.gcs_logs_prefix}{build_digest}-{int(time.time())}.log"
+        log_blob = storage_client.bucket(config.bucket_name).blob(log_blob_name)
+        inputs, _ = doxyfile_paths(read_doxyfile_tags(local_doxyfile_path), os.getcwd())
+        shards, _, file_count = plan_shards(inputs)
+        if not config.shard_threshold_files:
+            shard_skipped = "sharding is disabled"
+        elif file_count < config.shard_threshold_files:
+            shard_skipped = f"under the threshold of {config.shard_threshold_files} files"
+        elif len(shards) < 2:
+            shard_skipped = f"INPUT has {len(shards)} top-level director{'y' if len(shards) == 1 else 'ies'} to split"
+        else:
+            shard_skipped = None
+        empty_directory(config.docs_output_dir)  # Pages of an earlier build would be published with this one
+        with trace.span('doxygen', files=file_count) as span:
+            with log_blob.open('w', chunk_size=config.upload_chunk_size, content_type='text/plain') as log_stream:
+                if shard_skipped is None:
+                    span['shards'] = len(shards)
+                    logger.info(f"Building {file_count} files in {len(shards)} shards with {config.shard_workers} workers.")
+                    run_result = run_sharded_doxygen(
+                        config.doxygen_command,
+                        local_doxyfile_path,
+                        log_stream,
+                        config.doxygen_timeout_seconds,
+                        config.shard_workers,
+                        config.shard_work_dir
+                    )
+                else:
+                    logger.info(f"Building {file_count} files in one Doxygen run: {shard_skipped}.")
+                    run_result = run_doxygen_command(config.doxygen_command, local_doxyfile_path, log_stream, config.doxygen_timeout_seconds)
+        trace.count(files=file_count, warnings=run_result.summary.total, gcs_rpcs=1)
+
+        log_url = generate_signed_url_with_key(
+            bucket_name=config.bucket_name,
+            blob_name=log_blob_name,
+            key_file_path=key_local_path,
+            expiration=config.signed_url_expiration_seconds
+        )
+        warnings = run_result.summary.to_dict(config.warning_summary_max_files)
+
+        # Check for command success
+        if run_result.timed_out or run_result.returncode != 0:
+            if run_result.timed_out:
+                message = f"Doxygen timed out after {config.doxygen_timeout_seconds} seconds"
+            else:
+                message = f"Doxygen failed with return code {run_result.returncode}"
+            return {
+                "status": "error",
+                "message": message,
+                "warnings": warnings,
+                "log_url": log_url
+            }
+
+        if config.publish_mode == 'site':
+            # Sync the unpacked HTML tree to the stable per-repo prefix
+            prefix = site_prefix(config)
+            with trace.span('publish', mode='site'):
+                sync_stats = sync_directory_to_gcs(
+                    storage_client,
+                    config.bucket_name,
+                    config.docs_output_dir,
+                    prefix,
+                    workers=config.sync_workers,
+                    keep=(BUILD_DIGEST_MARKER,)  # Rewritten below; deleting it first would leave no marker for a while
+                )
+                # Record which inputs the published site was built from
+                storage_client.bucket(config.bucket_name).blob(prefix + BUILD_DIGEST_MARKER).upload_from_string(build_digest)
+            trace.count(gcs_rpcs=2 + sync_stats["uploaded"] + sync_stats["deleted"])
+            return {
+                "status": "success",
+                "cache_hit": False,
+                "build_digest": build_digest,
+                "warnings": warnings,
+                "log_url": log_url,
+                "docs_index_url": site_index_url(storage_client, config),
+                "sync_stats": sync_stats
+            }
+
+        # Name the zip after its inputs so identical rebuilds can reuse it
+        gcs_blob_name = zip_blob_name(config, build_digest)
+
+        # Stream the generated documentation as a zip straight into GCS
+        with trace.span('publish', mode='zip'):
+            stream_zip_directory(
+                storage_client,
+                config.bucket_name,
+                config.docs_output_dir,
+                gcs_blob_name,
+                compress_level=config.zip_compress_level,
+                chunk_size=config.upload_chunk_size
+            )
+        trace.count(gcs_rpcs=1)
 
         # Generate a signed URL for the uploaded zip file
         signed_url = generate_signed_url_with_key(
@@ -264,18 +869,13 @@ def run_doxygen(config: Config) -> dict:
 
         return {
             "status": "success",
-            "stdout": process.stdout,
-            "stderr": process.stderr,
+            "cache_hit": False,
+            "build_digest": build_digest,
+            "warnings": warnings,
+            "log_url": log_url,
             "docs_signed_url": signed_url
         }
 
-    except subprocess.CalledProcessError as e:
-        return {
-            "status": "error",
-            "message": f"Doxygen failed with return code {e.returncode}",
-            "stdout": e.output,
-            "stderr": e.stderr
-        }
     except EnvironmentError as e:
         return {
             "status": "error",
@@ -305,36 +905,49 @@ def run_doxygen_function(request: Request):
             signed_url_expiration_seconds=int(request_json.get('signed_url_expiration_seconds')) if request_json and 'signed_url_expiration_seconds' in request_json else int(os.environ.get('SIGNED_URL_EXPIRATION_SECONDS', '3600')),
             doxygen_binary_blob_name=request_json.get('doxygen_binary_blob_name') if request_json and 'doxygen_binary_blob_name' in request_json else os.environ.get('DOXYGEN_BINARY_BLOB_NAME'),
             docs_output_dir=os.environ.get('DOCS_OUTPUT_DIR', '/tmp/docs'),
-            zip_output_path=os.environ.get('ZIP_OUTPUT_PATH', '/tmp/docs.zip'),
-            gcs_docs_prefix=os.environ.get('GCS_DOCS_PREFIX', 'generated_docs/')
+            zip_compress_level=int(os.environ.get('ZIP_COMPRESS_LEVEL', '1')),
+            upload_chunk_size=int(os.environ.get('UPLOAD_CHUNK_SIZE', str(8 * 1024 * 1024))),
+            gcs_docs_prefix=os.environ.get('GCS_DOCS_PREFIX', 'generated_docs/'),
+            publish_mode=request_json.get('publish_mode') if request_json and 'publish_mode' in request_json else os.environ.get('PUBLISH_MODE', 'zip'),
+            site_name=request_json.get('site_name') if request_json and 'site_name' in request_json else os.environ.get('SITE_NAME', ''),
+            gcs_sites_prefix=os.environ.get('GCS_SITES_PREFIX', 'sites/'),
+            site_base_url=os.environ.get('SITE_BASE_URL', ''),
+            sync_workers=int(os.environ.get('SYNC_WORKERS', '16')),
+            use_build_cache=bool(request_json.get('use_build_cache')) if request_json and 'use_build_cache' in request_json else os.environ.get('USE_BUILD_CACHE', 'true').lower() == 'true',
+            doxygen_timeout_seconds=int(request_json.get('doxygen_timeout_seconds')) if request_json and 'doxygen_timeout_seconds' in request_json else int(os.environ.get('DOXYGEN_TIMEOUT_SECONDS', '3000')),
+            gcs_logs_prefix=os.environ.get('GCS_LOGS_PREFIX', 'doxygen_logs/'),
+            shard_threshold_files=int(request_json.get('shard_threshold_files')) if request_json and 'shard_threshold_files' in request_json else int(os.environ.get('SHARD_THRESHOLD_FILES', '2000')),
+            shard_workers=int(os.environ.get('SHARD_WORKERS', str(os.cpu_count() or 2)))
         )
 
         # Validate required parameters
         if not config.project_id or not config.bucket_name or not config.doxygen_binary_blob_name or not config.service_account_key_blob_name:
             return jsonify({"status": "error", "message": "Missing required parameters: project_id, bucket_name, doxygen_binary_blob_name, and service_account_key_blob_name"}), 400
+        if config.publish_mode not in ('zip', 'site'):
+            return jsonify({"status": "error", "message": f"Unknown publish_mode: {config.publish_mode}"}), 400
+        if config.publish_mode == 'site' and not config.site_base_url:
+            # The bucket is private: an unsigned storage.googleapis.com URL of the site would answer 403
+            return jsonify({"status": "error", "message": "publish_mode 'site' needs SITE_BASE_URL, a public or CDN-fronted URL serving the bucket's sites/ prefix"}), 400
 
 
         logger.info(f"Starting Doxygen process with config: {config}")
 
-        result = run_doxygen(config)
+        trace = start_trace(request, 'function-4-html')
+        try:
+            result = run_doxygen(config, trace)
+        finally:
+            trace.export()
+        result["trace_id"] = trace.trace_id
 
         if result["status"] == "success":
             logger.info("Doxygen ran successfully.")
             return jsonify({
-                "status": "success",
-                "message": "Doxygen ran successfully.",
-                "stdout": result["stdout"],
-                "stderr": result["stderr"],
-                "docs_signed_url": result["docs_signed_url"]
+                **result,
+                "message": "Doxygen ran successfully."
             }), 200
         else:
             logger.error(f"Doxygen error: {result.get('message')}")
-            return jsonify({
-                "status": "error",
-                "message": result.get("message"),
-                "stdout": result.get("stdout"),
-                "stderr": result.get("stderr")
-            }), 500
+            return jsonify(result), 500
 
     except Exception as e:
         logger.exception("Unhandled error occurred.")
@@ -1,14 +1,25 @@
 import os
 import time
-import tempfile
 import re
-import jwt  # PyJWT
-from datetime import datetime
-from flask import jsonify, request
-from github import Github, GithubException, GithubIntegration  # Added GithubIntegration
-from google.cloud import logging, storage
+import base64
+import hashlib
+import random
+import threading
+import json
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from functools import lru_cache
+from typing import TYPE_CHECKING
+from flask import jsonify
+from github import Auth, Github, GithubException, GithubIntegration, InputGitTreeElement
 from functions_framework import http
 
+if TYPE_CHECKING:  # Imported on first use, to keep cold starts short
+    from google.cloud import storage
+
 # Constants
 PROJECT_ID = "doxygen-gcp"
 LOG_NAME = "run_inference-cloudfunction-log"
@@ -17,11 +28,115 @@ GITHUB_PRIVATE_KEY = (
     "code-documenter.2024-11-17.private-key.pem"  # GitHub App Private Key
 )
 GCS_BUCKET_NAME = "doxygen-gcp-storage"  # GCS Bucket name
+TOKEN_REFRESH_MARGIN_SECONDS = 5 * 60  # Fetch a new installation token this long before expiry
+MAX_CONCURRENT_BLOBS = 8  # Objects downloaded from GCS and pushed as GitHub blobs at once
+GITHUB_API_URL = os.environ.get("GITHUB_API_URL", "https://api.github.com")
+GITHUB_MAX_RETRIES = 6  # Retries of a single call throttled by a rate limit
+GITHUB_MAX_WAIT_SECONDS = 120  # Give up instead of waiting longer than this for a rate limit reset
+GITHUB_BACKOFF_BASE_SECONDS = 1.0  # First backoff step for secondary rate limits without Retry-After
+
+# Clients are built on first use rather than at import, to keep cold starts short
+_logger = None
+_logger_lock = threading.Lock()
+
+
+def get_logger():
+    """Sets up Cloud Logging on the first call and returns the function's logger."""
+    global _logger
+    if _logger is None:
+        with _logger_lock:  # setup_logging() must run only once
+            if _logger is None:
+                from google.cloud import logging
+
+                client = logging.Client(project=PROJECT_ID)
+                client.setup_logging()
+                _logger = client.logger(LOG_NAME)
+    return _logger
+
+
+class LazyLogger:
+    """Forwards to the Cloud Logging logger, which is only created when something is logged."""
+
+    def __getattr__(self, name):
+        return getattr(get_logger(), name)
+
+
+logger = LazyLogger()
+
+
+@lru_cache(maxsize=None)
+def get_storage_client():
+    from google.cloud import storage
+
+    return storage.Client()
+
+# Tracing: the Streamlit app sends one trace id per pipeline run in the X-Trace-Id header
+TRACE_HEADER = "X-Trace-Id"
+TRACE_SINK = os.environ.get("TRACE_SINK", "none")  # 'none', 'log' or 'file:<path>' (one JSON record per line)
+_trace_file_lock = threading.Lock()
+
+
+class Trace:
+    """
+    Spans and counters recorded while serving one request, exported as a single record.
+    """
+
+    def __init__(self, trace_id, service):
+        self.trace_id = trace_id or uuid.uuid4().hex
+        self.service = service
+        self.spans = []
+        self.counters = Counter()
+        self._lock = threading.Lock()
+        self._started_at = time.time()
+
+    @contextmanager
+    def span(self, name, **attributes):
+        started_at = time.time()
+        try:
+            yield attributes
+        except Exception as e:
+            attributes["error"] = str(e)
+            raise
+        finally:
+            with self._lock:
+                self.spans.append({"name": name, "start": started_at,
+                                   "duration_ms": round((time.time() - started_at) * 1000, 1), **attributes})
+
+    @contextmanager
+    def timed(self, counter):
+        """Adds the block's duration to a counter, for steps repeated per file."""
+        started_at = time.time()
+        try:
+            yield
+        finally:
+            self.count(**{counter: round((time.time() - started_at) * 1000, 1)})
+
+    def count(self, **increments):
+        with self._lock:
+            self.counters.update(increments)
+
+    def to_dict(self):
+        with self._lock:
+            return {"trace_id": self.trace_id, "service": self.service, "start": self._started_at,
+                    "duration_ms": round((time.time() - self._started_at) * 1000, 1),
+                    "spans": list(self.spans), "counters": dict(self.counters)}
+
+    def export(self):
+        if TRACE_SINK == "none":
+            return
+        record = self.to_dict()
+        if TRACE_SINK == "log":
+            logger.log_struct(record, severity="INFO")
+        elif TRACE_SINK.startswith("file:"):
+            with _trace_file_lock, open(TRACE_SINK[len("file:"):], "a") as file:
+                file.write(json.dumps(record) + "\n")
+
+
+def start_trace(request, service):
+    """Continues the caller's trace, or starts one for requests sent without the header."""
+    headers = getattr(request, "headers", None) or {}
+    return Trace(headers.get(TRACE_HEADER), service)
 
-# Set up logging
-client = logging.Client(project=PROJECT_ID)
-client.setup_logging()
-logger = client.logger(LOG_NAME)
 
 
 @http
@@ -35,6 +150,8 @@ def run_inference(request):
         JSON response with a status and PR URL if successful.
     """
     logger.log_text("Received request for run_inference.", severity="INFO")
+    repo_owner = repo_name = None
+    trace = start_trace(request, "function-5-git-pr")
 
     try:
         # Step 1: Extract and parse the storage URI
@@ -76,72 +193,65 @@ def run_inference(request):
             severity="INFO",
         )
 
-        # Step 3: Generate JWT and retrieve private key
-        logger.log_text(
-            "Generating JWT token and retrieving private key.", severity="INFO"
-        )
-        jwt_token, private_key = generate_jwt_token(return_private_key=True)
-        logger.log_text(
-            "JWT token and private key retrieved successfully.", severity="INFO"
-        )
-
-        # Step 4: Initialize GitHub Integration
-        logger.log_text("Initializing GitHub Integration.", severity="INFO")
-        integration = GithubIntegration(GITHUB_APP_ID, private_key)
-
-        # Step 5: Get installation ID
+        # Step 3: Get an installation access token, reusing cached credentials
         logger.log_text(
             f"Authenticating GitHub App for repository {repo_owner}/{repo_name}.",
             severity="INFO",
         )
-        installation_id = get_installation_id(integration, repo_owner, repo_name)
-        logger.log_text(f"Installation ID fetched: {installation_id}", severity="INFO")
-
-        # Step 6: Fetch installation access token
-        logger.log_text(
-            "Fetching installation access token using installation ID.", severity="INFO"
-        )
-        installation_token = get_installation_access_token(integration, installation_id)
+        with trace.span("credentials"):
+            installation_token = credential_cache.installation_token(repo_owner, repo_name)
         logger.log_text(
             "Installation access token retrieved successfully.", severity="INFO"
         )
 
-        # Step 7: Reinitialize GitHub client with installation token
+        # Step 4: Initialize GitHub client with installation token
         logger.log_text(
-            "Reinitializing GitHub client with the installation token.", severity="INFO"
+            "Initializing GitHub client with the installation token.", severity="INFO"
         )
-        github = Github(installation_token)
+        github_client = build_github_client(installation_token)
 
-        # Step 8: Download files from GCS directory
-        with tempfile.TemporaryDirectory() as temp_dir:
-            logger.log_text(
-                f"Preparing to download files from GCS. Directory: {directory_path}, Temporary Path: {temp_dir}",
-                severity="INFO",
-            )
-            download_directory(storage.Client(), bucket_name, directory_path, temp_dir)
-            logger.log_text(
-                f"Files successfully downloaded to temporary directory: {temp_dir}",
-                severity="INFO",
-            )
-
-            # Step 9: Create a GitHub Pull Request
-            branch_name = f"update-{datetime.utcnow().strftime('%Y%m%d%H%M%S')}"
+        # Step 5: Create a GitHub Pull Request straight from the GCS objects
+        branch_name = f"update-{datetime.now(timezone.utc).strftime('%Y%m%d%H%M%S')}"
+        logger.log_text(
+            f"Creating a new branch and generating pull request. Branch name: {branch_name}",
+            severity="INFO",
+        )
+        pr_url = create_git_pull_request(
+            github_client, get_storage_client(), bucket_name, directory_path, repo_owner, repo_name, branch_name, trace
+        )
+        github_metrics = github_client.metrics()
+        trace.count(github_rpcs=github_metrics["calls"], github_retries=github_metrics["retries"])
+        logger.log_text(f"GitHub API usage: {github_metrics}", severity="INFO")
+        if pr_url is None:
             logger.log_text(
-                f"Creating a new branch and generating pull request. Branch name: {branch_name}",
+                "No changes compared to the default branch, no Pull Request created.",
                 severity="INFO",
             )
-            pr_url = create_git_pull_request(
-                github, repo_owner, repo_name, temp_dir, branch_name
-            )
-            logger.log_text(
-                f"Pull Request created successfully. PR URL: {pr_url}", severity="INFO"
+            return jsonify(
+                {
+                    "status": "success",
+                    "pull_request_url": None,
+                    "message": "No changes to commit.",
+                    "github_metrics": github_metrics,
+                    "trace_id": trace.trace_id,
+                }
             )
+        logger.log_text(
+            f"Pull Request created successfully. PR URL: {pr_url}", severity="INFO"
+        )
 
-        # Step 10: Return the Pull Request URL
+        # Step 6: Return the Pull Request URL
         logger.log_text(
             "Run inference process completed successfully.", severity="INFO"
         )
-        return jsonify({"status": "success", "pull_request_url": pr_url})
+        return jsonify(
+            {
+                "status": "success",
+                "pull_request_url": pr_url,
+                "github_metrics": github_metrics,
+                "trace_id": trace.trace_id,
+            }
+        )
 
     except ValueError as ve:
         logger.log_text(f"Validation error: {str(ve)}", severity="ERROR")
@@ -150,89 +260,256 @@ def run_inference(request):
         logger.log_text(
             f"Unexpected error in run_inference: {str(e)}", severity="ERROR"
         )
+        # The cached token may have been revoked, fetch a fresh one next time
+        if repo_owner and repo_name:
+            credential_cache.invalidate(repo_owner, repo_name)
         return jsonify({"status": "error", "message": str(e)}), 500
+    finally:
+        trace.export()
 
 
-def generate_jwt_token(return_private_key=False):
+class GitHubCredentialCache:
     """
-    Generates a JWT for the GitHub App and optionally returns the private key.
-    Args:
-        return_private_key (bool): Whether to return the private key along with the JWT.
-    Returns:
-        str: JWT token.
-        (Optional) str: Private key if return_private_key is True.
+    Keeps GitHub App credentials for the lifetime of the instance: the private key and
+    the GithubIntegration, which signs its own JWTs, the installation ID of each
+    repository and each installation's access token until its expires_at.
+    Lookups of different repositories and installations go to GitHub concurrently; only
+    the requests for the same one wait for each other.
     """
-    try:
-        logger.log_text("Starting JWT token generation process.", severity="INFO")
 
-        with tempfile.NamedTemporaryFile(suffix=".pem", delete=True) as temp_key_file:
-            logger.log_text(
-                "Temporary file created for storing the GitHub private key.",
-                severity="INFO",
-            )
-
-            # Download GitHub private key from GCS
-            logger.log_text(
-                f"Downloading private key from GCS bucket: {GCS_BUCKET_NAME}, blob: {GITHUB_PRIVATE_KEY}.",
-                severity="INFO",
-            )
-            download_github_private_key(
-                storage_client=storage.Client(),
-                bucket_name=GCS_BUCKET_NAME,
-                blob_name=GITHUB_PRIVATE_KEY,
-                local_path=temp_key_file.name,
-            )
-            logger.log_text(
-                f"Private key successfully downloaded to temporary file: {temp_key_file.name}.",
-                severity="INFO",
-            )
+    def __init__(self):
+        self._lock = threading.RLock()  # Guards the dicts and the one-time setup
+        self._private_key = None
+        self._integration = None
+        self._installation_ids = {}
+        self._access_tokens = {}
+        self._key_locks = {}
+
+    def _key_lock(self, key):
+        with self._lock:
+            return self._key_locks.setdefault(key, threading.Lock())
+
+    def private_key(self):
+        with self._lock:
+            if self._private_key is None:
+                self._private_key = load_github_private_key(
+                    storage_client=get_storage_client(),
+                    bucket_name=GCS_BUCKET_NAME,
+                    blob_name=GITHUB_PRIVATE_KEY,
+                )
+            return self._private_key
 
-            # Read the private key
-            with open(temp_key_file.name, "r") as key_file:
-                logger.log_text(
-                    "Reading private key from temporary file.", severity="INFO"
+    def integration(self):
+        with self._lock:
+            if self._integration is None:
+                self._integration = GithubIntegration(
+                    GITHUB_APP_ID, self.private_key(), base_url=GITHUB_API_URL
                 )
-                private_key = key_file.read()
+            return self._integration
+
+    def installation_id(self, repo_owner, repo_name):
+        key = (repo_owner, repo_name)
+        with self._key_lock(("repository", key)):
+            with self._lock:
+                installation_id = self._installation_ids.get(key)
+            if installation_id is None:
+                installation_id = get_installation_id(self.integration(), repo_owner, repo_name)
+                logger.log_text(f"Installation ID fetched: {installation_id}", severity="INFO")
+                with self._lock:
+                    self._installation_ids[key] = installation_id
+            return installation_id
+
+    def installation_token(self, repo_owner, repo_name):
+        installation_id = self.installation_id(repo_owner, repo_name)
+        with self._key_lock(("installation", installation_id)):
+            with self._lock:
+                token, expires_at = self._access_tokens.get(installation_id, (None, 0))
+            if token is None or time.time() >= expires_at - TOKEN_REFRESH_MARGIN_SECONDS:
+                token, expires_at = get_installation_access_token(self.integration(), installation_id)
+                with self._lock:
+                    self._access_tokens[installation_id] = (token, expires_at)
+            return token
+
+    def invalidate(self, repo_owner, repo_name):
+        with self._lock:
+            installation_id = self._installation_ids.pop((repo_owner, repo_name), None)
+            self._access_tokens.pop(installation_id, None)
+
+
+credential_cache = GitHubCredentialCache()
+
+
+class GitHubClient:
+    """
+    Routes GitHub API calls through shared rate-limit handling.
+    Throttled calls (403/429 from a primary or secondary rate limit) are retried after
+    the delay given by Retry-After or X-RateLimit-Reset, or after an exponential backoff,
+    and every worker pauses meanwhile. Concurrency is halved on each throttle and grows
+    back by one per successful call, up to max_workers. Counts calls for metrics.
+    """
 
-            # Generate the JWT token
-            payload = {
-                "iat": int(time.time()),  # Issued at time
-                "exp": int(time.time()) + (10 * 60),  # Expires after 10 minutes
-                "iss": GITHUB_APP_ID,  # GitHub App ID
-            }
-            logger.log_text(
-                f"Payload for JWT token created: {payload}", severity="DEBUG"
-            )
+    def __init__(self, github, max_workers=MAX_CONCURRENT_BLOBS, max_retries=GITHUB_MAX_RETRIES):
+        self.github = github
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self._condition = threading.Condition()
+        self._allowed = max_workers
+        self._in_flight = 0
+        self._paused_until = 0.0
+        self.calls = 0
+        self.retries = 0
+        self.throttled = 0
+        self.backoff_seconds = 0.0
+
+    def call(self, fn, *args, **kwargs):
+        """
+        Calls fn(*args, **kwargs), a PyGithub method, retrying it while it is rate limited.
+        """
+        attempt = 0
+        while True:
+            self._acquire()
+            try:
+                result = fn(*args, **kwargs)
+            except GithubException as e:
+                delay = self._throttle_delay(e, attempt)
+                if delay is None or attempt >= self.max_retries:
+                    raise
+                self._throttle(delay)
+                attempt += 1
+                continue
+            finally:
+                self._release()
+            self._succeed()
+            return result
+
+    def map(self, fn, items):
+        """
+        Runs fn over items in a pool of max_workers threads and returns the results in order.
+        fn is expected to issue its GitHub calls through call(), which bounds the actual concurrency.
+        """
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            return list(executor.map(fn, items))
+
+    def metrics(self):
+        """
+        Returns call counts for this client and the remaining GitHub quota.
+        """
+        remaining, limit = self.github.rate_limiting if self.calls else (None, None)
+        return {
+            "calls": self.calls,
+            "retries": self.retries,
+            "throttled": self.throttled,
+            "backoff_seconds": round(self.backoff_seconds, 3),
+            "rate_limit_remaining": remaining,
+            "rate_limit_limit": limit,
+        }
+
+    def _acquire(self):
+        with self._condition:
+            while True:
+                wait = self._paused_until - time.time()
+                if wait > 0:
+                    self._condition.wait(wait)
+                elif self._in_flight >= self._allowed:
+                    self._condition.wait()
+                else:
+                    break
+            self._in_flight += 1
+            self.calls += 1
+
+    def _release(self):
+        with self._condition:
+            self._in_flight -= 1
+            self._condition.notify_all()
+
+    def _succeed(self):
+        with self._condition:
+            if self._allowed < self.max_workers:
+                self._allowed += 1
+                self._condition.notify_all()
+
+    def _throttle(self, delay):
+        with self._condition:
+            self.retries += 1
+            self.throttled += 1
+            self.backoff_seconds += delay
+            self._allowed = max(1, self._allowed // 2)
+            self._paused_until = max(self._paused_until, time.time() + delay)
+        logger.log_text(
+            f"GitHub rate limit hit, pausing calls for {delay:.1f}s.", severity="WARNING"
+        )
 
-            jwt_token = jwt.encode(payload, private_key, algorithm="RS256")
-            logger.log_text("JWT token successfully generated.", severity="INFO")
+    @staticmethod
+    def _throttle_delay(exception, attempt):
+        """
+        Returns how long to wait before retrying a failed call, or None if the failure
+        is not a rate limit (e.g. a genuine 403 permission error).
+        """
+        if exception.status not in (403, 429):
+            return None
+        headers = {key.lower(): value for key, value in (exception.headers or {}).items()}
+        if "retry-after" in headers:
+            delay = float(headers["retry-after"])
+        elif headers.get("x-ratelimit-remaining") == "0" and "x-ratelimit-reset" in headers:
+            delay = max(0.0, float(headers["x-ratelimit-reset"]) - time.time()) + 1
+        elif exception.status == 429 or "secondary rate limit" in str(exception.data).lower():
+            delay = GITHUB_BACKOFF_BASE_SECONDS * (2 ** attempt) * (1 + random.random())
+        else:
+            return None
+        if delay > GITHUB_MAX_WAIT_SECONDS:
+            return None
+        return delay
 
-            if return_private_key:
-                return jwt_token, private_key
-            return jwt_token
-    except Exception as e:
-        logger.log_text(f"Error generating JWT token: {str(e)}", severity="ERROR")
-        raise RuntimeError(f"JWT generation failed: {str(e)}")
+
+def build_github_client(installation_token):
+    """
+    Creates a GitHub client for an installation token. PyGithub's own retries and
+    request spacing are disabled so GitHubClient alone paces and retries calls.
+    """
+    github = Github(
+        auth=Auth.Token(installation_token),
+        base_url=GITHUB_API_URL,
+        retry=None,
+        pool_size=MAX_CONCURRENT_BLOBS,
+        seconds_between_requests=None,
+        seconds_between_writes=None,
+    )
+    return GitHubClient(github)
 
 
-def create_git_pull_request(github, repo_owner, repo_name, local_path, branch_name):
+def create_git_pull_request(
+    github_client, storage_client, bucket_name, gcs_prefix, repo_owner, repo_name, branch_name, trace=None
+):
     """
-    Orchestrates the creation of a GitHub Pull Request with the files in the specified local path.
+    Orchestrates the creation of a GitHub Pull Request with the files under the specified GCS prefix.
     Args:
-        github: Authenticated PyGithub instance.
+        github_client (GitHubClient): Rate-limit-aware client wrapping an authenticated PyGithub instance.
+        storage_client (google.cloud.storage.Client): The GCS storage client.
+        bucket_name (str): Name of the GCS bucket.
+        gcs_prefix (str): Prefix of the directory holding the files to commit.
         repo_owner (str): Owner of the target repository.
         repo_name (str): Name of the target repository.
-        local_path (str): Path to the local directory containing files to commit.
         branch_name (str): Name of the branch for the PR.
+        trace (Trace): Records the spans and counters of the request.
     Returns:
-        str: URL of the created Pull Request.
+        str: URL of the created Pull Request, or None if nothing changed.
     """
+    trace = trace or Trace(None, "function-5-git-pr")
     try:
         full_repo_name = f"{repo_owner}/{repo_name}"
-        repo, default_branch = get_repository(github, full_repo_name)
-        create_branch(repo, branch_name, default_branch)
-        upload_files_to_branch(repo, local_path, branch_name)
-        pr_url = create_pull_request(repo, branch_name, default_branch)
+        with trace.span("get_repository"):
+            repo, default_branch = get_repository(github_client, full_repo_name)
+        with trace.span("list_sources"):
+            source_blobs = list_source_blobs(storage_client, bucket_name, gcs_prefix)
+        trace.count(files=len(source_blobs), gcs_rpcs=1)
+        with trace.span("commit"):
+            commit_sha = commit_files_to_branch(
+                github_client, repo, source_blobs, branch_name, default_branch, trace
+            )
+        if commit_sha is None:
+            return None
+        with trace.span("open_pull_request"):
+            pr_url = create_pull_request(github_client, repo, branch_name, default_branch)
         return pr_url
     except Exception as e:
         logger.log_text(f"Error creating Pull Request: {str(e)}", severity="ERROR")
@@ -274,30 +551,33 @@ def get_installation_access_token(integration, installation_id):
         integration: Authenticated GithubIntegration instance.
         installation_id (int): Installation ID of the GitHub App.
     Returns:
-        str: Installation access token.
+        tuple: (installation access token, expiry as a UNIX timestamp)
     """
     try:
         access_token = integration.get_access_token(installation_id)
         logger.log_text(
             f"Retrieved installation token for installation ID {installation_id}"
         )
-        return access_token.token
+        expires_at = access_token.expires_at
+        if expires_at.tzinfo is None:
+            expires_at = expires_at.replace(tzinfo=timezone.utc)
+        return access_token.token, expires_at.timestamp()
     except Exception as e:
         logger.error(f"Error generating installation token: {e}")
         raise
 
 
-def get_repository(github, full_repo_name):
+def get_repository(github_client, full_repo_name):
     """
     Retrieves the target repository and checks write access.
     Args:
-        github: Authenticated PyGithub instance.
+        github_client (GitHubClient): Rate-limit-aware GitHub client.
         full_repo_name (str): Full name of the repository (owner/repo).
     Returns:
         tuple: (Repository object, default branch name)
     """
     try:
-        repo = github.get_repo(full_repo_name)
+        repo = github_client.call(github_client.github.get_repo, full_repo_name)
         default_branch = repo.default_branch
         logger.log_text(
             f"Access confirmed for repository: {full_repo_name}", severity="INFO"
@@ -310,18 +590,18 @@ def get_repository(github, full_repo_name):
         raise RuntimeError(f"Error accessing repository {full_repo_name}: {str(e)}")
 
 
-def create_branch(repo, branch_name, default_branch):
+def create_branch(github_client, repo, branch_name, commit_sha):
     """
-    Creates a new branch in the repository based on the default branch.
+    Creates a new branch in the repository pointing at the given commit.
     Args:
+        github_client (GitHubClient): Rate-limit-aware GitHub client.
         repo: PyGithub repository object.
         branch_name (str): Name of the branch to create.
-        default_branch (str): Name of the default branch to base the new branch on.
+        commit_sha (str): SHA of the commit the branch should point to.
     """
     try:
         branch_ref = f"refs/heads/{branch_name}"
-        sha = repo.get_branch(default_branch).commit.sha
-        repo.create_git_ref(ref=branch_ref, sha=sha)
+        github_client.call(repo.create_git_ref, ref=branch_ref, sha=commit_sha)
         logger.log_text(
             f"Created new branch: {branch_name} in repository: {repo.full_name}"
         )
@@ -352,82 +632,154 @@ def validate_and_sanitize_path(relative_path):
     return sanitized_path
 
 
-def upload_files_to_branch(repo, local_path, branch_name):
+def list_source_blobs(storage_client, bucket_name, gcs_prefix):
     """
-    Uploads files from the local path to the specified branch in the repository.
-    Excludes hidden directories (e.g., .git) to prevent uploading Git's internal files.
+    Lists the GCS objects under the prefix that should be committed.
+    Excludes hidden files and directories (e.g., .git) and paths GitHub would reject.
+    Args:
+        storage_client (google.cloud.storage.Client): The GCS storage client.
+        bucket_name (str): Name of the GCS bucket.
+        gcs_prefix (str): Prefix of the directory to list.
+    Returns:
+        list: (relative_path, blob) tuples.
     """
     try:
-        for root, dirs, files in os.walk(local_path):
-            # Exclude hidden directories (starting with a dot)
-            dirs[:] = [d for d in dirs if not d.startswith(".")]
-
-            for file_name in files:
-                file_path = os.path.join(root, file_name)
-                relative_path = os.path.relpath(file_path, local_path)
-
-                # Skip hidden files (starting with a dot)
-                if relative_path.startswith(".") or "/." in relative_path:
-                    logger.log_text(
-                        f"Skipping hidden file: {relative_path}", severity="INFO"
-                    )
-                    continue  # Skip hidden files
-
-                # Validate and sanitize the path
-                try:
-                    relative_path = validate_and_sanitize_path(relative_path)
-                except ValueError as ve:
-                    logger.log_text(
-                        f"Skipping invalid file path: {relative_path}. Reason: {ve}",
-                        severity="WARNING",
-                    )
-                    continue  # Skip invalid paths
-
-                # Log the sanitized path
+        bucket = storage_client.bucket(bucket_name)
+        collected = []
+        for blob in bucket.list_blobs(prefix=gcs_prefix):
+            if blob.name.endswith("/"):
+                continue  # Skip directories
+            relative_path = os.path.relpath(blob.name, gcs_prefix)
+
+            # Skip hidden files and files in hidden directories (starting with a dot)
+            if relative_path.startswith(".") or "/." in relative_path:
                 logger.log_text(
-                    f"Uploading file with sanitized relative path: {relative_path}",
-                    severity="DEBUG",
+                    f"Skipping hidden file: {relative_path}", severity="INFO"
                 )
+                continue  # Skip hidden files
+
+            # Validate and sanitize the path
+            try:
+                relative_path = validate_and_sanitize_path(relative_path)
+            except ValueError as ve:
+                logger.log_text(
+                    f"Skipping invalid file path: {relative_path}. Reason: {ve}",
+                    severity="WARNING",
+                )
+                continue  # Skip invalid paths
+
+            collected.append((relative_path, blob))
+        return collected
+    except Exception as e:
+        logger.log_text(f"Failed to list source files: {str(e)}", severity="ERROR")
+        raise RuntimeError(
+            f"Error listing files with prefix {gcs_prefix}: {str(e)}"
+        )
+
+
+def git_blob_sha(content):
+    """
+    Computes the SHA-1 git assigns to a blob with the given content.
+    Args:
+        content (bytes): File content.
+    Returns:
+        str: Hex SHA-1 of the blob.
+    """
+    header = f"blob {len(content)}\0".encode("ascii")
+    return hashlib.sha1(header + content).hexdigest()
+
 
-                # Read the file content
-                with open(file_path, "rb") as file:
-                    content = file.read()
-
-                # Proceed with upload as before...
-                try:
-                    existing_file = repo.get_contents(relative_path, ref=branch_name)
-                    # Update the existing file
-                    repo.update_file(
-                        path=relative_path,
-                        message=f"Update {relative_path}",
-                        content=content,
-                        sha=existing_file.sha,
-                        branch=branch_name,
-                    )
-                    logger.log_text(
-                        f"Updated file in branch {branch_name}: {relative_path}"
-                    )
-                except GithubException as e:
-                    if e.status == 404:
-                        repo.create_file(
-                            path=relative_path,
-                            message=f"Add {relative_path}",
-                            content=content,
-                            branch=branch_name,
-                        )
-                        logger.log_text(
-                            f"Created new file in branch {branch_name}: {relative_path}"
-                        )
-                    else:
-                        raise
+def get_remote_tree_entries(github_client, repo, tree_sha):
+    """
+    Fetches every blob of a tree in a single recursive call.
+    Args:
+        github_client (GitHubClient): Rate-limit-aware GitHub client.
+        repo: PyGithub repository object.
+        tree_sha (str): SHA of the tree to list.
+    Returns:
+        dict: path -> (blob SHA, file mode). Empty if GitHub truncated the listing,
+        in which case every file is treated as changed.
+    """
+    tree = github_client.call(repo.get_git_tree, tree_sha, recursive=True)
+    if tree.raw_data.get("truncated"):
+        logger.log_text(
+            f"Tree {tree_sha} listing is truncated, all files will be uploaded.",
+            severity="WARNING",
+        )
+        return {}
+    return {
+        element.path: (element.sha, element.mode)
+        for element in tree.tree
+        if element.type == "blob"
+    }
+
+
+def commit_files_to_branch(github_client, repo, source_blobs, branch_name, default_branch, trace=None):
+    """
+    Commits the GCS objects that differ from the default branch to a new branch
+    in a single commit. Each object is downloaded into memory and, unless its git
+    blob SHA matches the default branch's tree, pushed as a GitHub blob through
+    the client's bounded pool. Then creates one tree on top of the default
+    branch's tree, one commit and one ref.
+    Args:
+        github_client (GitHubClient): Rate-limit-aware GitHub client.
+        repo: PyGithub repository object.
+        source_blobs (list): (relative_path, GCS blob) tuples to commit.
+        branch_name (str): Name of the branch to create.
+        default_branch (str): Name of the branch to base the commit on.
+        trace (Trace): Records the bytes read and the files changed.
+    Returns:
+        str: SHA of the created commit, or None if no file changed.
+    """
+    trace = trace or Trace(None, "function-5-git-pr")
+    try:
+        base_commit = github_client.call(repo.get_branch, default_branch).commit
+        remote_entries = get_remote_tree_entries(github_client, repo, base_commit.commit.tree.sha)
+
+        def push_blob(source):
+            relative_path, gcs_blob = source
+            content = gcs_blob.download_as_bytes()
+            trace.count(gcs_rpcs=1, bytes_read=len(content))
+            remote_sha, mode = remote_entries.get(relative_path, (None, "100644"))
+            if git_blob_sha(content) == remote_sha:
+                return None  # Unchanged on the default branch
+            blob = github_client.call(
+                repo.create_git_blob, base64.b64encode(content).decode("ascii"), "base64"
+            )
+            trace.count(files_changed=1, bytes_pushed=len(content))
+            logger.log_text(
+                f"Created blob for {relative_path}: {blob.sha}", severity="DEBUG"
+            )
+            return InputGitTreeElement(relative_path, mode, "blob", sha=blob.sha)
+
+        tree_elements = [
+            element for element in github_client.map(push_blob, source_blobs) if element
+        ]
+
+        if not tree_elements:
+            logger.log_text(
+                f"No file differs from {default_branch}, nothing to commit.", severity="INFO"
+            )
+            return None
+
+        tree = github_client.call(repo.create_git_tree, tree_elements, base_commit.commit.tree)
+        commit = github_client.call(
+            repo.create_git_commit, f"Update from {branch_name}", tree, [base_commit.commit]
+        )
+        create_branch(github_client, repo, branch_name, commit.sha)
+        logger.log_text(
+            f"Committed {len(tree_elements)} files to branch {branch_name} in commit {commit.sha}"
+        )
+        return commit.sha
     except GithubException as e:
-        raise RuntimeError(f"Error uploading files to branch {branch_name}: {str(e)}")
+        raise RuntimeError(f"Error committing files to branch {branch_name}: {str(e)}")
 
 
-def create_pull_request(repo, branch_name, default_branch):
+def create_pull_request(github_client, repo, branch_name, default_branch):
     """
     Creates a pull request in the repository.
     Args:
+        github_client (GitHubClient): Rate-limit-aware GitHub client.
         repo: PyGithub repository object.
         branch_name (str): Source branch for the pull request.
         default_branch (str): Target branch for the pull request.
@@ -435,7 +787,8 @@ def create_pull_request(repo, branch_name, default_branch):
         str: URL of the created pull request.
     """
     try:
-        pr = repo.create_pull(
+        pr = github_client.call(
+            repo.create_pull,
             title=f"Update from {branch_name}",
             body="Automated update from run_inference function.",
             head=branch_name,  # Since we are pushing to the same repo, head is just the branch name
@@ -493,16 +846,17 @@ def parse_storage_uri(storage_uri):
         )
 
 
-def download_github_private_key(
-    storage_client: storage.Client, bucket_name: str, blob_name: str, local_path: str
-) -> None:
+def load_github_private_key(
+    storage_client: "storage.Client", bucket_name: str, blob_name: str
+) -> str:
     """
-    Downloads the specified GitHub private key file from a Google Cloud Storage (GCS) bucket.
+    Reads the specified GitHub private key file from a Google Cloud Storage (GCS) bucket.
     Args:
         storage_client (storage.Client): The Google Cloud Storage client instance.
         bucket_name (str): The name of the GCS bucket.
-        blob_name (str): The name of the blob (file) to download.
-        local_path (str): The local file path where the private key will be saved.
+        blob_name (str): The name of the blob (file) to read.
+    Returns:
+        str: The PEM-encoded private key.
     Raises:
         RuntimeError: If there is an error during the download process.
     """
@@ -510,19 +864,9 @@ def download_github_private_key(
         logger.log_text(
             f"Initiating download of GitHub private key: {blob_name} from bucket: {bucket_name}."
         )
-
-        # Access the bucket
-        bucket = storage_client.bucket(bucket_name)
-
-        # Access the blob (file) within the bucket
-        blob = bucket.blob(blob_name)
-
-        # Download the blob to the specified local file path
-        blob.download_to_filename(local_path)
-
-        logger.log_text(
-            f"GitHub private key file successfully downloaded to {local_path}."
-        )
+        private_key = storage_client.bucket(bucket_name).blob(blob_name).download_as_text()
+        logger.log_text("GitHub private key successfully loaded.")
+        return private_key
     except Exception as e:
         logger.error(
             f"Failed to download GitHub private key: {blob_name} from bucket: {bucket_name}."
@@ -530,31 +874,3 @@ def download_github_private_key(
         raise RuntimeError(
             f"Error downloading GitHub private key {blob_name}: {str(e)}"
         )
-
-
-def download_directory(storage_client, bucket_name, gcs_prefix, local_destination):
-    """
-    Downloads all files from a GCS directory to a local destination.
-    Args:
-        storage_client (google.cloud.storage.Client): The GCS storage client.
-        bucket_name (str): Name of the GCS bucket.
-        gcs_prefix (str): Prefix of the directory to download.
-        local_destination (str): Local path where files should be downloaded.
-    """
-    try:
-        bucket = storage_client.bucket(bucket_name)
-        blobs = bucket.list_blobs(prefix=gcs_prefix)
-
-        for blob in blobs:
-            if blob.name.endswith("/"):
-                continue  # Skip directories
-            relative_path = os.path.relpath(blob.name, gcs_prefix)
-            local_path = os.path.join(local_destination, relative_path)
-            os.makedirs(os.path.dirname(local_path), exist_ok=True)
-            blob.download_to_filename(local_path)
-            logger.log_text(f"Downloaded {blob.name} to {local_path}")
-    except Exception as e:
-        logger.log_text(f"Failed to download directory: {str(e)}", severity="ERROR")
-        raise RuntimeError(
-            f"Error downloading directory with prefix {gcs_prefix}: {str(e)}"
-        )
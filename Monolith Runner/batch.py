@@ -0,0 +1,177 @@
+import os
+import time
+import random
+import functools
+import logging
+import tempfile
+import threading
+import dataclasses
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, Dict, Iterable, Iterator, Optional
+
+from pipeline import MonolithConfig, gemini_generate, load_function, run_pipeline
+from storage_backends import Storage
+
+logger = logging.getLogger(__name__)
+
+
+class ModelQuota:
+    """
+    Shares one Gemini quota between every pipeline of the process, through function-3's
+    fair scheduler: calls in flight, requests and tokens per minute, and fair shares
+    between tenants (one per repository in a batch), so a small repository is not stuck
+    behind a large one. Calls rejected with a 429 are retried after an exponential backoff.
+    """
+
+    def __init__(self, generate: Callable[[str], Optional[str]] = gemini_generate, max_in_flight: int = 8,
+                 requests_per_minute: int = 0, tokens_per_minute: int = 0, weights: Optional[Dict[str, float]] = None,
+                 max_retries: int = 5, backoff_seconds: float = 2.0):
+        function_3 = load_function("function-3-comment")
+        self.scheduler = function_3.FairScheduler(
+            function_3.MemoryQuotaBackend(requests_per_minute, tokens_per_minute), max_in_flight, weights)
+        self.chars_per_token = function_3.CHARS_PER_TOKEN
+        self.generate = generate
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self.throttled = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, prompt: str, tenant: str = "default") -> Optional[str]:
+        attempt = 0
+        while True:
+            with self.scheduler.slot(tenant, len(prompt) // self.chars_per_token):
+                try:
+                    return self.generate(prompt)
+                except Exception as e:
+                    if getattr(e, "code", None) != 429 or attempt >= self.max_retries:
+                        raise
+            with self._lock:
+                self.throttled += 1
+            delay = self.backoff_seconds * (2 ** attempt) * (1 + random.random())
+            logger.warning(f"Gemini quota exceeded, retrying in {delay:.1f}s")
+            time.sleep(delay)
+            attempt += 1
+
+    def for_tenant(self, tenant: str) -> Callable[[str], Optional[str]]:
+        return functools.partial(self, tenant=tenant)
+
+    def metrics(self) -> dict:
+        """The scheduler's queue depth and per-tenant calls and waits, and the 429s retried."""
+        with self._lock:
+            return {**self.scheduler.metrics(), "throttled": self.throttled}
+
+
+class GitHubBudgetExhausted(RuntimeError):
+    pass
+
+
+class GitHubBudget:
+    """
+    Hands out one function-5 GitHubClient per installation token, so the repositories of an
+    organization share its connection pool, pacing and rate-limit backoff. A pull request is
+    refused once the batch has made max_requests GitHub requests (0: no cap), or when fewer
+    than reserve requests are left in the installation's hourly quota.
+    """
+
+    def __init__(self, max_requests: int = 0, reserve: int = 100):
+        self.max_requests = max_requests
+        self.reserve = reserve
+        self._clients: Dict[str, object] = {}
+        self._lock = threading.Lock()
+
+    def client(self, token: str):
+        with self._lock:
+            used = self.requests()
+            if self.max_requests and used >= self.max_requests:
+                raise GitHubBudgetExhausted(f"GitHub request budget of {self.max_requests} used up")
+            github_client = self._clients.get(token)
+            if github_client is None:
+                github_client = self._clients[token] = load_function("function-5-git-pr").build_github_client(token)
+            remaining = github_client.metrics()["rate_limit_remaining"]
+            if remaining is not None and remaining < self.reserve:
+                raise GitHubBudgetExhausted(f"Only {remaining} GitHub requests left before the rate limit resets")
+            return github_client
+
+    def requests(self) -> int:
+        return sum(github_client.calls for github_client in self._clients.values())
+
+    def metrics(self) -> dict:
+        with self._lock:
+            return {"requests": self.requests(), "clients": len(self._clients),
+                    "retries": sum(github_client.retries for github_client in self._clients.values())}
+
+
+def cache_doxygen_binary(storage: Storage, config: MonolithConfig, directory: str) -> MonolithConfig:
+    """
+    Downloads the stored Doxygen binary once for the whole batch, instead of once per repository.
+    """
+    if config.doxygen_command or "html" in config.skip_stages:
+        return config
+    doxygen_command = os.path.join(directory, "doxygen")
+    with open(doxygen_command, "wb") as file:
+        file.write(storage.read(config.doxygen_binary_name))
+    os.chmod(doxygen_command, 0o755)
+    return dataclasses.replace(config, doxygen_command=doxygen_command)
+
+
+def run_batch(urls: Iterable[str], storage: Storage, config: Optional[MonolithConfig] = None,
+              quota: Optional[ModelQuota] = None, github: Optional[GitHubBudget] = None,
+              max_parallel: int = 4) -> Iterator[dict]:
+    """
+    Documents several repositories, up to max_parallel at once, and yields each one's
+    result as soon as it finishes, then a summary. The pipelines share the storage, the
+    Gemini quota, the GitHub clients and budget, and the cached Doxygen binary.
+    """
+    config = config or MonolithConfig()
+    quota = quota or ModelQuota()
+    github = github or GitHubBudget()
+    started_at = time.perf_counter()
+    counts = {"success": 0, "error": 0}
+    throttled_before = quota.metrics()["throttled"]  # The quota may be shared with other batches
+
+    urls = list(urls)
+    seen = {}
+    repo_names = [os.path.basename(url.rstrip("/")).replace(".git", "") for url in urls]
+    for index, (url, repo_name) in enumerate(zip(urls, repo_names)):
+        # Two repositories with one name would overwrite each other's files in storage
+        if repo_name in seen:
+            counts["error"] += 1
+            yield {"index": index, "url": url, "status": "error",
+                   "message": f"Same repository name as {urls[seen[repo_name]]}"}
+        else:
+            seen[repo_name] = index
+
+    def document(index, url):
+        try:
+            result = run_pipeline(url, storage, batch_config, generate=quota.for_tenant(repo_names[index]),
+                                  github_clients=github.client)
+        except Exception as e:
+            logger.exception(f"Pipeline failed for {url}")
+            result = {"status": "error", "message": str(e)}
+        return {"index": index, "url": url, **result, "model": quota.metrics()["tenants"].get(repo_names[index])}
+
+    with tempfile.TemporaryDirectory(dir=config.work_dir or None) as cache_dir:
+        batch_config = cache_doxygen_binary(storage, config, cache_dir)
+        with ThreadPoolExecutor(max_workers=max(1, max_parallel)) as executor:
+            futures = [executor.submit(document, index, urls[index]) for index in sorted(seen.values())]
+            for future in as_completed(futures):
+                result = future.result()
+                counts["success" if result["status"] == "success" else "error"] += 1
+                yield result
+
+    model = quota.metrics()
+    model = {"queue_depth": model["queue_depth"], "throttled": model["throttled"] - throttled_before}
+    yield {"summary": {**counts, "repositories": len(urls), "model": model, "github": github.metrics(),
+                       "seconds": round(time.perf_counter() - started_at, 3)}}
+
+
+def repo_urls_of_organization(owner: str, token: str = "") -> list:
+    """Lists the clone URLs of an organization's or user's public repositories."""
+    from github import Auth, Github, GithubException
+
+    github = Github(auth=Auth.Token(token) if token else None, base_url=load_function("function-5-git-pr").GITHUB_API_URL)
+    try:
+        account = github.get_organization(owner)
+    except GithubException:
+        account = github.get_user(owner)
+    return [repo.clone_url for repo in account.get_repos() if not repo.archived and not repo.fork]
@@ -0,0 +1,138 @@
+import os
+import sys
+import json
+import argparse
+import logging
+import functools
+
+import functions_framework
+from flask import Response, jsonify
+
+from batch import GitHubBudget, ModelQuota, repo_urls_of_organization, run_batch
+from pipeline import MonolithConfig, run_pipeline
+from storage_backends import build_storage
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+BUCKET = "doxygen-gcp-storage"
+
+
+def config_from_env() -> MonolithConfig:
+    return MonolithConfig(
+        doxygen_command=os.environ.get("DOXYGEN_COMMAND", ""),
+        doxygen_timeout_seconds=int(os.environ.get("DOXYGEN_TIMEOUT_SECONDS", "3000")),
+        docs_prefix=os.environ.get("GCS_DOCS_PREFIX", "generated_docs/"),
+        zip_compress_level=int(os.environ.get("ZIP_COMPRESS_LEVEL", "1")),
+        comment_workers=int(os.environ.get("COMMENT_WORKERS", "4")),
+        persist_sources=os.environ.get("PERSIST_SOURCES", "true").lower() == "true",
+        skip_stages=[stage for stage in os.environ.get("SKIP_STAGES", "").split(",") if stage],
+        github_token=os.environ.get("GITHUB_TOKEN", ""),
+        streaming=os.environ.get("STREAMING", "false").lower() == "true",
+        queue_size=int(os.environ.get("STREAMING_QUEUE_SIZE", "32")),
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def shared_model_quota() -> ModelQuota:
+    """One Gemini quota for every batch served by this instance."""
+    return ModelQuota(max_in_flight=int(os.environ.get("MODEL_MAX_IN_FLIGHT", "8")),
+                      requests_per_minute=int(os.environ.get("MODEL_REQUESTS_PER_MINUTE", "0")),
+                      tokens_per_minute=int(os.environ.get("MODEL_TOKENS_PER_MINUTE", "0")),
+                      weights=json.loads(os.environ.get("TENANT_WEIGHTS", "{}")))
+
+
+def github_budget_from_env() -> GitHubBudget:
+    return GitHubBudget(max_requests=int(os.environ.get("GITHUB_REQUEST_BUDGET", "0")),
+                        reserve=int(os.environ.get("GITHUB_REQUEST_RESERVE", "100")))
+
+
+@functions_framework.http
+def run_pipeline_function(request):
+    """HTTP entry point.
+    Args:
+        a GET or POST HTTP request with the 'url' of the repository to document
+    Returns:
+        a JSON response with each stage's result and timings
+    """
+    request_json = request.get_json(silent=True)
+    url = request_json.get("url") if request_json else request.args.get("url")
+    if not url:
+        return jsonify({"status": "error", "message": "No url provided"}), 400
+    try:
+        storage = build_storage(os.environ.get("STORAGE_BACKEND", "gcs"), os.environ.get("STORAGE_LOCATION", BUCKET))
+        result = run_pipeline(url, storage, config_from_env())
+    except Exception as e:
+        logger.exception("Pipeline failed")
+        return jsonify({"status": "error", "message": str(e)}), 500
+    return jsonify(result), 200 if result["status"] == "success" else 500
+
+
+@functions_framework.http
+def run_batch_function(request):
+    """HTTP entry point for several repositories.
+    Args:
+        a POST HTTP request with the 'urls' of the repositories and/or the 'owner' (organization
+        or user) whose repositories to document, and optionally 'max_parallel'
+    Returns:
+        a streamed JSON Lines response: one line per repository as soon as it is done, then a summary
+    """
+    request_json = request.get_json(silent=True) or {}
+    urls = list(request_json.get("urls") or [])
+    try:
+        if request_json.get("owner"):
+            urls += repo_urls_of_organization(request_json["owner"], os.environ.get("GITHUB_TOKEN", ""))
+        storage = build_storage(os.environ.get("STORAGE_BACKEND", "gcs"), os.environ.get("STORAGE_LOCATION", BUCKET))
+    except Exception as e:
+        logger.exception("Batch setup failed")
+        return jsonify({"status": "error", "message": str(e)}), 500
+    if not urls:
+        return jsonify({"status": "error", "message": "No urls or owner provided"}), 400
+
+    max_parallel = int(request_json.get("max_parallel") or os.environ.get("BATCH_MAX_PARALLEL", "4"))
+    results = run_batch(urls, storage, config_from_env(), quota=shared_model_quota(),
+                        github=github_budget_from_env(), max_parallel=max_parallel)
+    return Response((json.dumps(result) + "\n" for result in results), mimetype="application/x-ndjson")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the whole documentation pipeline in one process.")
+    parser.add_argument("urls", nargs="*", metavar="url", help="URL of a Git repository to document")
+    parser.add_argument("--owner", help="Also document every repository of this GitHub organization or user")
+    parser.add_argument("--parallel", type=int, default=4, help="Repositories documented at once in a batch")
+    parser.add_argument("--storage", choices=["gcs", "local", "memory"], default="gcs")
+    parser.add_argument("--location", default=BUCKET, help="Bucket name for gcs, root directory for local")
+    parser.add_argument("--doxygen", default="", help="Local Doxygen binary instead of the stored one")
+    parser.add_argument("--skip", action="append", default=[], choices=["comment", "readme", "html", "pull_request"])
+    parser.add_argument("--no-persist", action="store_true", help="Do not write the sources back to storage")
+    parser.add_argument("--streaming", action="store_true",
+                        help="Pass each file on to the next stage as soon as it is ready")
+    args = parser.parse_args()
+
+    config = config_from_env()
+    config.doxygen_command = args.doxygen or config.doxygen_command
+    config.skip_stages = args.skip or config.skip_stages
+    config.persist_sources = config.persist_sources and not args.no_persist
+    config.streaming = config.streaming or args.streaming
+    urls = args.urls + (repo_urls_of_organization(args.owner, config.github_token) if args.owner else [])
+    if not urls:
+        parser.error("give at least one url, or --owner")
+    storage = build_storage(args.storage, args.location)
+
+    if len(urls) == 1:
+        result = run_pipeline(urls[0], storage, config)
+        json.dump(result, sys.stdout, indent=2)
+        print()
+        return 0 if result["status"] == "success" else 1
+
+    # One JSON line per repository as soon as it is done, then the summary
+    failed = False
+    for result in run_batch(urls, storage, config, quota=shared_model_quota(), github=github_budget_from_env(),
+                            max_parallel=args.parallel):
+        failed = failed or result.get("status") == "error"
+        print(json.dumps(result), flush=True)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
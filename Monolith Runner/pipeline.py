@@ -0,0 +1,642 @@
+import os
+import io
+import re
+import json
+import stat
+import time
+import queue
+import logging
+import tempfile
+import functools
+import threading
+import importlib.util
+import importlib.machinery
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from storage_backends import Storage
+
+PROJECT_ID = "doxygen-gcp"
+LOCATION = "europe-west1"
+CLOUD_FUNCTIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Cloud Functions")
+SOURCE_EXTENSIONS = (".c", ".h")
+
+logger = logging.getLogger(__name__)
+
+
+@functools.lru_cache(maxsize=None)
+def load_function(directory: str, file_name: str = "main.py"):
+    """
+    Imports a Cloud Function's source file as a module, so its helpers are reused as is.
+    """
+    loader = importlib.machinery.SourceFileLoader(directory.replace("-", "_"),
+                                                  os.path.join(CLOUD_FUNCTIONS_DIR, directory, file_name))
+    spec = importlib.util.spec_from_loader(loader.name, loader)
+    module = importlib.util.module_from_spec(spec)
+    loader.exec_module(module)
+    return module
+
+
+@dataclass
+class MonolithConfig:
+    theme_prefix: str = "doxygen-awesome-css/"  # Storage prefix of the Doxygen theme
+    doxyfile_name: str = "Doxyfile"  # Storage key of the Doxyfile template
+    doxygen_command: str = ""  # Local Doxygen binary; downloaded from storage when empty
+    doxygen_binary_name: str = "doxygen"  # Storage key of the Doxygen binary
+    doxygen_timeout_seconds: int = 3000
+    docs_prefix: str = "generated_docs/"  # Storage prefix of the documentation archives
+    zip_compress_level: int = 1  # Deflate level of the archives (1 = fastest), as ZIP_COMPRESS_LEVEL in function-4-html
+    comment_workers: int = 4  # Gemini calls in flight while commenting
+    persist_sources: bool = True  # Write the commented sources and README back to storage
+    skip_stages: List[str] = field(default_factory=list)  # Any of 'comment', 'readme', 'html', 'pull_request'
+    github_token: str = ""  # Use this token instead of the GitHub App installation token
+    work_dir: str = ""  # Scratch directory for the clone and the Doxygen build, a temporary one when empty
+    streaming: bool = False  # Hand each file to the next stage as soon as it is ready (see run_streaming_stages)
+    queue_size: int = 32  # Files waiting between two streaming stages, before the upstream one blocks
+
+
+@dataclass
+class Workspace:
+    """The repository's files, kept in memory between stages."""
+    repo_name: str
+    files: Dict[str, bytes] = field(default_factory=dict)  # Relative path -> content
+    skipped: Dict[str, dict] = field(default_factory=dict)  # Reason -> files and bytes left out of the download
+    index: Optional[dict] = None  # Symbol index of the sources as downloaded (see index_sources)
+
+    def sources(self):
+        return sorted(path for path in self.files if path.endswith(SOURCE_EXTENSIONS))
+
+
+_vertexai_lock = threading.Lock()
+_gemini_model = None
+
+
+def gemini_generate(prompt: str) -> Optional[str]:
+    """
+    Sends a prompt to Gemini and returns the answer text, or None if it was blocked.
+    """
+    global _gemini_model
+    with _vertexai_lock:
+        if _gemini_model is None:
+            import vertexai
+            from vertexai.preview.generative_models import GenerativeModel
+
+            vertexai.init(project=PROJECT_ID, location=LOCATION)
+            _gemini_model = GenerativeModel("gemini-1.5-pro")
+    try:
+        return _gemini_model.generate_content([prompt]).text
+    except ValueError:
+        return None
+
+
+def extract_repo_details(git_url):
+    match = re.match(r"https?://(?:www\.)?github\.com/([^/]+)/([^/]+)", git_url)
+    if match:
+        return match.group(1), match.group(2).replace(".git", "")
+    return None, None
+
+
+def clone_repository(url_git: str, work_dir: str) -> Tuple[str, List[tuple], Dict[str, dict]]:
+    """
+    Shallow-clones the repository and returns its name, the (local path, relative path, size)
+    of the files that function-1-download's upload policy keeps (no .git directory, build
+    artifacts, binaries or oversized files), and the files skipped per reason.
+    """
+    import git
+
+    function_1 = load_function("function-1-download")
+    repo_name = os.path.basename(url_git.rstrip("/")).replace(".git", "")
+    clone_dir = tempfile.mkdtemp(prefix="clone-", dir=work_dir)
+    git.Repo.clone_from(url_git, clone_dir, depth=1)
+    selected, stats = function_1.UploadPolicy.from_request(None).select(clone_dir)
+    return repo_name, selected, stats["skipped"]
+
+
+def read_selected(selected: List[tuple]) -> Iterator[Tuple[str, bytes]]:
+    for local_path, relative_path, size in selected:
+        with open(local_path, "rb") as file:
+            yield relative_path, file.read()
+
+
+def index_sources(workspace: Workspace) -> dict:
+    """
+    Builds function-1-download's symbol index of the sources: their includes, and the
+    declarations each one uses from the files it includes.
+    """
+    function_1 = load_function("function-1-download")
+    return function_1.build_symbol_index({path: workspace.files[path].decode("utf-8", errors="replace")
+                                          for path in workspace.sources()})
+
+
+def download_repository(url_git: str, work_dir: str) -> Workspace:
+    """
+    Clones the repository and loads the kept files into memory.
+    """
+    repo_name, selected, skipped = clone_repository(url_git, work_dir)
+    workspace = Workspace(repo_name, skipped=skipped)
+    workspace.files.update(read_selected(selected))
+    return workspace
+
+
+def comment_sources(workspace: Workspace, generate: Callable[[str], Optional[str]], workers: int) -> Dict[str, int]:
+    """
+    Replaces each C source and header with the Gemini-commented version, as function-3-comment
+    does, with the declarations it uses from other files when the workspace is indexed.
+    """
+    function_3 = load_function("function-3-comment")
+
+    def comment(path):
+        response = generate(function_3.build_comment_prompt(workspace.files[path].decode("utf-8", errors="replace"),
+                                                             function_3.declarations_context(workspace.index, path)))
+        if response is None:
+            return path, None
+        return path, response.encode("utf-8")
+
+    stats = {"files": 0, "commented": 0}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for path, content in executor.map(comment, workspace.sources()):
+            stats["files"] += 1
+            if content is not None:
+                workspace.files[path] = content
+                stats["commented"] += 1
+    return stats
+
+
+README_SUMMARY_MAX_CHARS = 4000  # Entry files up to this size are given whole to the README prompt
+
+
+def strip_comments_and_literals(line: str, in_comment: bool) -> Tuple[str, bool]:
+    """Returns the code of a C line without comments and string or char literals, and
+    whether a block comment is still open at its end."""
+    code = []
+    i = 0
+    while i < len(line):
+        if in_comment:
+            end = line.find("*/", i)
+            if end < 0:
+                return "".join(code), True
+            i, in_comment = end + 2, False
+        elif line.startswith("/*", i):
+            i, in_comment = i + 2, True
+        elif line.startswith("//", i):
+            break
+        elif line[i] in "\"'":
+            quote = line[i]
+            i += 1
+            while i < len(line) and line[i] != quote:
+                i += 2 if line[i] == "\\" else 1
+            i += 1
+        else:
+            code.append(line[i])
+            i += 1
+    return "".join(code), in_comment
+
+
+def summarize_for_readme(content: str, max_chars: int = README_SUMMARY_MAX_CHARS) -> str:
+    """
+    Reduces a C source or header to what a README needs: its comments, includes, macros,
+    types and function signatures, without the function bodies. Short files are kept whole.
+    """
+    if len(content) <= max_chars:
+        return content
+    kept = []
+    blocks = []  # One entry per open brace: whether its body is kept
+    in_comment = False
+    previous_code = ""
+    for line in content.splitlines():
+        keep = all(blocks)
+        code, in_comment = strip_comments_and_literals(line, in_comment)
+        for index, char in enumerate(code):
+            if char == "{":
+                # A brace right after a parameter list opens a function body
+                is_body = (previous_code + code[:index]).rstrip().endswith(")")
+                blocks.append(all(blocks) and not is_body)
+            elif char == "}" and blocks:
+                if not blocks.pop() and all(blocks) and not keep:
+                    kept += ["\t...", "}"]
+        if keep:
+            kept.append(line)
+        if code.strip():
+            previous_code = code
+    summary = "\n".join(kept)
+    return summary if len(summary) <= max_chars else summary[:max_chars] + "\n..."
+
+
+def write_readme(repo_name: str, sources: Dict[str, bytes], generate: Callable[[str], Optional[str]],
+                 index: Optional[dict] = None) -> Optional[bytes]:
+    """
+    Returns the README.md generated from the given sources, as function-2-readme does,
+    or None if Gemini gave no answer. With the sources' symbol index, the prompt gives
+    the entry files in full and an overview of the others, instead of every file.
+    """
+    function_2 = load_function("function-2-readme")
+    omitted = 0
+    if index is not None:
+        entry_contents = {path: sources[path].decode("utf-8", errors="replace") for path in function_2.entry_files(index)}
+        file_analyses, omitted = function_2.build_repository_overview(index, repo_name, entry_contents)
+    else:
+        file_analyses = [(f"{repo_name}/{path}", content.decode("utf-8", errors="replace"))
+                         for path, content in sorted(sources.items())]
+    response = generate(function_2.build_readme_prompt(file_analyses, omitted))
+    return response.encode("utf-8") if response is not None else None
+
+
+class PipelineCancelled(RuntimeError):
+    pass
+
+
+class Channel:
+    """
+    A bounded queue between two streaming stages, closed by its producer once it is done.
+    put() blocks while the queue is full, so a fast stage waits for a slow one instead of
+    piling files up in memory, and both ends give up once another stage has failed.
+    """
+    _CLOSED = object()
+
+    def __init__(self, size: int, cancelled: threading.Event):
+        self._queue = queue.Queue(maxsize=max(1, size))
+        self._cancelled = cancelled
+        self.max_depth = 0
+
+    def put(self, item):
+        while not self._cancelled.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+            except queue.Full:
+                continue
+            self.max_depth = max(self.max_depth, self._queue.qsize())
+            return
+        raise PipelineCancelled("Cancelled after another stage failed")
+
+    def close(self):
+        self.put(self._CLOSED)
+
+    def __iter__(self):
+        while not self._cancelled.is_set():
+            try:
+                item = self._queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if item is self._CLOSED:
+                self._queue.put(item)  # For the stage's other workers
+                return
+            yield item
+        raise PipelineCancelled("Cancelled after another stage failed")
+
+
+def run_streaming_stages(url_git: str, workspace: Optional[Workspace], config: MonolithConfig,
+                         generate: Callable[[str], Optional[str]], work_dir: str,
+                         timer: "StageTimer") -> Tuple[Workspace, Dict[str, dict]]:
+    """
+    Runs the download, comment and README stages with each file moving on as soon as it is
+    ready: listed from the clone, then read and commented, then, for the entry files,
+    summarized for the README (summarize_for_readme), through bounded
+    queues of config.queue_size files. Only the headers are read before files move on, to
+    index the declarations every file's prompt needs; each other source is read, and added
+    to the index, once the comment stage takes it. The README prompt waits for every file,
+    and gives the commented entry files and an index overview.
+    Returns the workspace and each stage's result; a download failure is raised.
+    """
+    function_1 = load_function("function-1-download")
+    function_2 = load_function("function-2-readme")
+    function_3 = load_function("function-3-comment")
+    cancelled = threading.Event()
+    to_comment = Channel(config.queue_size, cancelled) if "comment" not in config.skip_stages else None
+    to_summarize = Channel(config.queue_size, cancelled) if "readme" not in config.skip_stages else None
+    state = {"workspace": workspace}
+    comment_stats = {"files": 0, "commented": 0}
+    summaries = {}
+    lock = threading.Lock()
+
+    def read(path, local_path):
+        """A file's content, from the clone or the given workspace, added to the index if it is a source."""
+        if local_path is None:
+            content = state["workspace"].files[path]
+        else:
+            with open(local_path, "rb") as file:
+                content = file.read()
+        if path.endswith(SOURCE_EXTENSIONS) and path not in state["index"]["files"]:
+            with lock:
+                function_1.index_source(state["index"], path, content.decode("utf-8", errors="replace"),
+                                        state["resolve"])
+        return content
+
+    def read_text(local_path, path):
+        if local_path is None:
+            return state["workspace"].files[path].decode("utf-8", errors="replace")
+        with open(local_path, "r", encoding="utf-8", errors="replace") as file:
+            return file.read()
+
+    def download():
+        if state["workspace"] is None:
+            repo_name, selected, skipped = clone_repository(url_git, work_dir)
+            state["workspace"] = Workspace(repo_name, skipped=skipped)
+        else:
+            selected = [(None, path, len(content)) for path, content in state["workspace"].files.items()]
+        current = state["workspace"]
+        state["resolve"] = function_1.include_resolver(path for _, path, _ in selected)
+        if current.index is None:
+            # Every file's prompt needs the declarations of the headers it includes, so they are indexed first
+            headers = {path: read_text(local_path, path) for local_path, path, _ in selected if path.endswith(".h")}
+            current.index = function_1.build_symbol_index(headers, state["resolve"])
+            del headers
+        state["index"] = current.index
+        for local_path, path, size in selected:
+            if not path.endswith(SOURCE_EXTENSIONS):
+                continue
+            if to_comment:
+                to_comment.put((path, local_path))
+            elif to_summarize:
+                content = read(path, local_path)
+                current.files[path] = content
+                to_summarize.put((path, content))
+        # The other files only matter once the pipeline is done: the HTML, pull request and write-back
+        for local_path, path, size in selected:
+            if local_path is not None and not path.endswith(SOURCE_EXTENSIONS):
+                current.files[path] = read(path, local_path)
+
+    def comment():
+        for path, local_path in to_comment:
+            content = read(path, local_path)
+            context = function_3.declarations_context(state["index"], path)
+            response = generate(function_3.build_comment_prompt(content.decode("utf-8", errors="replace"), context))
+            if response is not None:
+                content = response.encode("utf-8")
+            state["workspace"].files[path] = content
+            with lock:
+                comment_stats["files"] += 1
+                comment_stats["commented"] += response is not None
+            if to_summarize:
+                to_summarize.put((path, content))
+
+    def summarize():
+        # A file is indexed before it is sent on, so whether it defines main() is known here
+        for path, content in to_summarize:
+            index = state["index"]
+            with lock:
+                is_entry = any("main" in index["declarations"][declaration_id]["names"]
+                               for declaration_id in index["files"][path]["declares"])
+            if is_entry:
+                summaries[path] = summarize_for_readme(content.decode("utf-8", errors="replace"))
+
+    def stage(body, outbox, workers=1):
+        def worker():
+            try:
+                body()
+            except Exception:
+                cancelled.set()  # Unblocks the stages waiting on this one
+                raise
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(worker) for _ in range(workers)]
+        # The worker that failed first, rather than the ones cancelled because of it
+        errors = sorted((future.exception() for future in futures if future.exception()),
+                        key=lambda error: isinstance(error, PipelineCancelled))
+        if errors:
+            raise errors[0]
+        if outbox:
+            outbox.close()
+
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        futures = {"download": executor.submit(timer.run, "download", stage, download, to_comment or to_summarize)}
+        if to_comment:
+            futures["comment"] = executor.submit(timer.run, "comment", stage, comment, to_summarize,
+                                                 config.comment_workers)
+        if to_summarize:
+            futures["summarize"] = executor.submit(timer.run, "summarize", stage, summarize, None)
+        errors = {}
+        for name, future in futures.items():
+            try:
+                future.result()
+            except Exception as e:
+                errors[name] = e
+    if "download" in errors and not isinstance(errors["download"], PipelineCancelled):
+        raise errors["download"]
+    for name, error in errors.items():
+        if not isinstance(error, PipelineCancelled):
+            logger.error(f"Stage {name} failed: {error}")
+
+    workspace = state["workspace"]
+    stages = {"download": {"files": len(workspace.files), "skipped": workspace.skipped}}
+    if to_comment:
+        stages["comment"] = ({"error": str(errors["comment"])} if "comment" in errors else
+                             {**comment_stats, "max_queued": to_comment.max_depth})
+    if to_summarize:
+        if errors:
+            stages["readme"] = {"error": str(errors.get("summarize") or "Not written after another stage failed")}
+        else:
+            file_analyses, omitted = function_2.build_repository_overview(workspace.index, workspace.repo_name,
+                                                                          summaries)
+            prompt = function_2.build_readme_prompt(file_analyses, omitted)
+            readme = timer.run("readme", generate, prompt)
+            if readme is not None:
+                workspace.files["README.md"] = readme.encode("utf-8")
+            stages["readme"] = {"written": readme is not None, "files": len(file_analyses), "omitted": omitted,
+                                "prompt_chars": len(prompt), "max_queued": to_summarize.max_depth}
+    return workspace, stages
+
+
+def materialize(storage: Storage, prefix: str, destination: str) -> None:
+    for key in storage.list(prefix):
+        local_path = os.path.join(destination, os.path.relpath(key, prefix))
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        with open(local_path, "wb") as file:
+            file.write(storage.read(key))
+
+
+def build_html(workspace: Workspace, storage: Storage, config: MonolithConfig, work_dir: str) -> dict:
+    """
+    Runs Doxygen on the in-memory sources with the stored Doxyfile and theme, then
+    streams the HTML output as a zip into storage, as function-4-html does.
+    """
+    function_4 = load_function("function-4-html", "main.c")
+    build_dir = tempfile.mkdtemp(prefix="html-", dir=work_dir)
+    source_dir = os.path.join(build_dir, workspace.repo_name)
+    for path, content in workspace.files.items():
+        local_path = os.path.join(source_dir, path)
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        with open(local_path, "wb") as file:
+            file.write(content)
+    materialize(storage, config.theme_prefix, os.path.join(build_dir, config.theme_prefix))
+
+    doxyfile_lines = storage.read_text(config.doxyfile_name).splitlines(keepends=True)
+    base_doxyfile = os.path.join(build_dir, "Doxyfile.base")
+    with open(base_doxyfile, "w") as file:
+        file.writelines(function_4.rewrite_doxyfile_paths(doxyfile_lines, base_dir=build_dir))
+    output_dir = os.path.join(build_dir, "docs")
+    doxyfile = function_4.write_doxyfile_overrides(
+        base_doxyfile, os.path.join(build_dir, "Doxyfile"),
+        {"INPUT": source_dir, "OUTPUT_DIRECTORY": output_dir})
+
+    doxygen_command = config.doxygen_command
+    if not doxygen_command:
+        doxygen_command = os.path.join(build_dir, "doxygen")
+        with open(doxygen_command, "wb") as file:
+            file.write(storage.read(config.doxygen_binary_name))
+        os.chmod(doxygen_command, os.stat(doxygen_command).st_mode | stat.S_IEXEC)
+    function_4.validate_environment(doxygen_command)
+
+    log_stream = io.StringIO()
+    run_result = function_4.run_doxygen_command(doxygen_command, doxyfile, log_stream, config.doxygen_timeout_seconds)
+    warnings = run_result.summary.to_dict()
+    if run_result.timed_out or run_result.returncode != 0:
+        raise RuntimeError(f"Doxygen failed (return code {run_result.returncode}, timed out: {run_result.timed_out}): "
+                           f"{log_stream.getvalue()[-1000:]}")
+
+    docs_key = f"{config.docs_prefix}{workspace.repo_name}.zip"
+    with storage.open_write(docs_key, content_type="application/zip") as stream:
+        function_4.write_zip_directory(stream, output_dir, config.zip_compress_level)
+    return {"docs_uri": storage.uri(docs_key), "warnings": warnings}
+
+
+class MemoryBlob:
+    """Gives in-memory content the download_as_bytes() of a GCS blob, for function-5-git-pr."""
+
+    def __init__(self, content: bytes):
+        self.content = content
+
+    def download_as_bytes(self):
+        return self.content
+
+
+def open_pull_request(workspace: Workspace, url_git: str, config: MonolithConfig,
+                      github_clients: Optional[Callable[[str], object]] = None) -> dict:
+    """
+    Commits the in-memory files that differ from the default branch and opens a pull request,
+    as function-5-git-pr does. github_clients(token) returns the GitHub client to use, a new
+    one by default.
+    """
+    function_5 = load_function("function-5-git-pr")
+    repo_owner, repo_name = extract_repo_details(url_git)
+    if not repo_owner:
+        raise ValueError(f"Not a GitHub repository URL: {url_git}")
+    token = config.github_token or function_5.credential_cache.installation_token(repo_owner, repo_name)
+    github_client = (github_clients or function_5.build_github_client)(token)
+
+    source_blobs = []
+    for path in sorted(workspace.files):
+        # Skip hidden files and files in hidden directories, and paths GitHub would reject
+        if path.startswith(".") or "/." in path:
+            continue
+        try:
+            source_blobs.append((function_5.validate_and_sanitize_path(path), MemoryBlob(workspace.files[path])))
+        except ValueError as e:
+            logger.warning(f"Skipping {path}: {e}")
+
+    repo, default_branch = function_5.get_repository(github_client, f"{repo_owner}/{repo_name}")
+    branch_name = f"update-{datetime.now(timezone.utc).strftime('%Y%m%d%H%M%S')}"
+    pr_url = None
+    if function_5.commit_files_to_branch(github_client, repo, source_blobs, branch_name, default_branch) is not None:
+        pr_url = function_5.create_pull_request(github_client, repo, branch_name, default_branch)
+    return {"pull_request_url": pr_url, "github_metrics": github_client.metrics()}
+
+
+def persist_workspace(workspace: Workspace, storage: Storage, workers: int = 16) -> dict:
+    """
+    Writes the files under '<repo_name>/', and the symbol index if any, the layout the
+    Cloud Functions leave in the bucket.
+    """
+    def write(item):
+        path, content = item
+        storage.write(f"{workspace.repo_name}/{path}", content)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(write, workspace.files.items()))
+    if workspace.index is not None:
+        index_key = f"{load_function('function-1-download').INDEX_PREFIX}{workspace.repo_name}.json"
+        storage.write(index_key, json.dumps(workspace.index).encode("utf-8"))
+    return {"files": len(workspace.files)}
+
+
+class StageTimer:
+    def __init__(self):
+        self.durations: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def run(self, name, fn, *args):
+        started_at = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            with self._lock:
+                self.durations[name] = round(time.perf_counter() - started_at, 3)
+
+
+def run_pipeline(url_git: str, storage: Storage, config: Optional[MonolithConfig] = None,
+                 generate: Callable[[str], Optional[str]] = gemini_generate,
+                 workspace: Optional[Workspace] = None,
+                 github_clients: Optional[Callable[[str], object]] = None) -> dict:
+    """
+    Runs the five stages in one process: download, then comments and README in parallel
+    (or file by file with config.streaming, see run_streaming_stages), then the HTML
+    documentation, the pull request and the write-back to storage in parallel.
+    Files are handed from stage to stage in memory; storage is only read for the Doxygen
+    inputs and written with the results. Pass workspace to skip the download, and
+    github_clients to share GitHub clients between pipelines (see open_pull_request).
+    """
+    config = config or MonolithConfig()
+    timer = StageTimer()
+    started_at = time.perf_counter()
+    result = {"status": "success", "stages": {}}
+
+    def collect(futures):
+        values = {}
+        for name, future in futures.items():
+            try:
+                values[name] = future.result()
+            except Exception as e:
+                logger.exception(f"Stage {name} failed")
+                result["status"] = "error"
+                result["stages"][name] = {"error": str(e)}
+        return values
+
+    with tempfile.TemporaryDirectory(dir=config.work_dir or None) as work_dir:
+        if config.streaming:
+            workspace, stages = run_streaming_stages(url_git, workspace, config, generate, work_dir, timer)
+            result["repo_name"] = workspace.repo_name
+            result["stages"].update(stages)
+            if any("error" in stage for stage in stages.values()):
+                result["status"] = "error"
+        else:
+            if workspace is None:
+                workspace = timer.run("download", download_repository, url_git, work_dir)
+            result["repo_name"] = workspace.repo_name
+            result["stages"]["download"] = {"files": len(workspace.files), "skipped": workspace.skipped}
+            if workspace.index is None:
+                workspace.index = timer.run("index", index_sources, workspace)
+
+            # The README is written from the sources as downloaded, like the parallel Cloud Functions
+            original_sources = {path: workspace.files[path] for path in workspace.sources()}
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                futures = {}
+                if "comment" not in config.skip_stages:
+                    futures["comment"] = executor.submit(timer.run, "comment", comment_sources, workspace,
+                                                         generate, config.comment_workers)
+                if "readme" not in config.skip_stages:
+                    futures["readme"] = executor.submit(timer.run, "readme", write_readme, workspace.repo_name,
+                                                        original_sources, generate, workspace.index)
+                values = collect(futures)
+            if "comment" in values:
+                result["stages"]["comment"] = values["comment"]
+            if "readme" in values:
+                # Added once commenting is done, so that stage never sees the workspace change under it
+                if values["readme"] is not None:
+                    workspace.files["README.md"] = values["readme"]
+                result["stages"]["readme"] = {"written": values["readme"] is not None}
+
+        if result["status"] == "success":
+            with ThreadPoolExecutor(max_workers=3) as executor:
+                futures = {}
+                if "html" not in config.skip_stages:
+                    futures["html"] = executor.submit(timer.run, "html", build_html, workspace, storage, config, work_dir)
+                if "pull_request" not in config.skip_stages:
+                    futures["pull_request"] = executor.submit(timer.run, "pull_request", open_pull_request,
+                                                              workspace, url_git, config, github_clients)
+                if config.persist_sources:
+                    futures["persist"] = executor.submit(timer.run, "persist", persist_workspace, workspace, storage)
+                result["stages"].update(collect(futures))
+
+    result["timings"] = {**timer.durations, "total": round(time.perf_counter() - started_at, 3)}
+    return result
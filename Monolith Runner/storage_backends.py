@@ -0,0 +1,182 @@
+import io
+import os
+import threading
+from abc import ABC, abstractmethod
+from typing import BinaryIO, Dict, List, Optional
+
+
+class Storage(ABC):
+    """
+    Flat object store used by the monolith runner: keys are '/'-separated paths, values are bytes.
+    Backends implement list, read, write, open_write, delete and uri.
+    """
+
+    @abstractmethod
+    def list(self, prefix: str) -> List[str]:
+        ...
+
+    @abstractmethod
+    def read(self, key: str) -> bytes:
+        ...
+
+    @abstractmethod
+    def write(self, key: str, data: bytes, content_type: Optional[str] = None) -> None:
+        ...
+
+    @abstractmethod
+    def open_write(self, key: str, content_type: Optional[str] = None) -> BinaryIO:
+        """Returns a writable binary stream; the object exists once the stream is closed."""
+
+    @abstractmethod
+    def delete(self, key: str) -> None:
+        ...
+
+    @abstractmethod
+    def uri(self, key: str) -> str:
+        ...
+
+    def exists(self, key: str) -> bool:
+        return key in self.list(key)
+
+    def read_text(self, key: str) -> str:
+        return self.read(key).decode("utf-8")
+
+    def write_text(self, key: str, text: str) -> None:
+        self.write(key, text.encode("utf-8"), content_type="text/plain")
+
+
+class GCSStorage(Storage):
+    def __init__(self, bucket_name: str, client=None, chunk_size: int = 8 * 1024 * 1024):
+        from google.cloud import storage
+
+        self.bucket_name = bucket_name
+        self.client = client or storage.Client()
+        self.bucket = self.client.bucket(bucket_name)
+        self.chunk_size = chunk_size
+
+    def list(self, prefix):
+        return [blob.name for blob in self.client.list_blobs(self.bucket_name, prefix=prefix)
+                if not blob.name.endswith("/")]
+
+    def read(self, key):
+        return self.bucket.blob(key).download_as_bytes()
+
+    def write(self, key, data, content_type=None):
+        self.bucket.blob(key).upload_from_string(data, content_type=content_type or "application/octet-stream")
+
+    def open_write(self, key, content_type=None):
+        # zipfile flushes the stream when closing the archive, which BlobWriter only tolerates with ignore_flush
+        return self.bucket.blob(key).open("wb", chunk_size=self.chunk_size, ignore_flush=True,
+                                          content_type=content_type or "application/octet-stream")
+
+    def delete(self, key):
+        self.bucket.blob(key).delete()
+
+    def exists(self, key):
+        return self.bucket.blob(key).exists()
+
+    def uri(self, key):
+        return f"gs://{self.bucket_name}/{key}"
+
+
+class LocalStorage(Storage):
+    def __init__(self, root: str):
+        self.root = os.path.abspath(root)
+
+    def _path(self, key):
+        path = os.path.abspath(os.path.join(self.root, key))
+        if path != self.root and not path.startswith(self.root + os.sep):
+            raise ValueError(f"Key escapes the storage root: {key}")
+        return path
+
+    def list(self, prefix):
+        keys = []
+        for root, dirs, files in os.walk(self.root):
+            dirs.sort()
+            for file_name in sorted(files):
+                key = os.path.relpath(os.path.join(root, file_name), self.root).replace(os.sep, "/")
+                if key.startswith(prefix):
+                    keys.append(key)
+        return keys
+
+    def read(self, key):
+        with open(self._path(key), "rb") as file:
+            return file.read()
+
+    def write(self, key, data, content_type=None):
+        with self.open_write(key, content_type) as file:
+            file.write(data)
+
+    def open_write(self, key, content_type=None):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return open(path, "wb")
+
+    def delete(self, key):
+        os.remove(self._path(key))
+
+    def exists(self, key):
+        return os.path.isfile(self._path(key))
+
+    def uri(self, key):
+        return "file://" + self._path(key)
+
+
+class _MemoryWriter(io.BytesIO):
+    def __init__(self, storage, key):
+        super().__init__()
+        self._storage = storage
+        self._key = key
+
+    def close(self):
+        if not self.closed:
+            self._storage.write(self._key, self.getvalue())
+        super().close()
+
+
+class MemoryStorage(Storage):
+    def __init__(self, objects: Optional[Dict[str, bytes]] = None):
+        self.objects = dict(objects or {})
+        self._lock = threading.Lock()
+
+    def list(self, prefix):
+        with self._lock:
+            return sorted(key for key in self.objects if key.startswith(prefix))
+
+    def read(self, key):
+        with self._lock:
+            if key not in self.objects:
+                raise FileNotFoundError(key)
+            return self.objects[key]
+
+    def write(self, key, data, content_type=None):
+        with self._lock:
+            self.objects[key] = bytes(data)
+
+    def open_write(self, key, content_type=None):
+        return _MemoryWriter(self, key)
+
+    def delete(self, key):
+        with self._lock:
+            self.objects.pop(key, None)
+
+    def exists(self, key):
+        with self._lock:
+            return key in self.objects
+
+    def uri(self, key):
+        return f"memory://{key}"
+
+
+def build_storage(backend: str, location: str) -> Storage:
+    """
+    Returns the backend named 'gcs' (location is the bucket), 'local' (location is a
+    directory) or 'memory' (location is ignored).
+    """
+    if backend == "gcs":
+        return GCSStorage(location)
+    if backend == "local":
+        return LocalStorage(location)
+    if backend == "memory":
+        return MemoryStorage()
+    raise ValueError(f"Unknown storage backend: {backend}")
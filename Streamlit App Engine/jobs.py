@@ -0,0 +1,135 @@
+import time
+import uuid
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Dict, Optional, Tuple
+
+import requests
+
+from orchestrator import CONNECT_TIMEOUT_SECONDS, PipelineOrchestrator, StageResult, documentation_stages
+
+MAX_CONCURRENT_JOBS = 8  # Pipeline runs executing at once on this instance
+RESULT_TTL_SECONDS = 3600  # Finished runs are served from cache for this long
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class Job:
+    key: Tuple[str, Optional[str]]  # (repository URL, commit SHA)
+    url_git: str
+    status: str = "queued"  # 'queued', 'running', 'done' or 'failed'
+    stages: Dict[str, StageResult] = field(default_factory=dict)
+    submitted_at: float = field(default_factory=time.time)
+    finished_at: Optional[float] = None
+    error: Optional[str] = None
+    trace_id: str = field(default_factory=lambda: uuid.uuid4().hex)  # Sent to every function of the run
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ("done", "failed")
+
+
+def normalize_repo_url(url_git):
+    return url_git.strip().rstrip("/").removesuffix(".git").lower()
+
+
+def advertised_refs(data: bytes) -> Dict[str, str]:
+    """
+    Parses the refs a git server advertises to git-upload-pack (pkt-lines of '<sha> <ref>',
+    the first one followed by a NUL and the capabilities) into {ref: sha}.
+    """
+    refs = {}
+    position = 0
+    while position + 4 <= len(data):
+        length = int(data[position:position + 4], 16)
+        if length == 0:  # Flush packet
+            position += 4
+            continue
+        line = data[position + 4:position + length].rstrip(b"\n").split(b"\0")[0].decode("utf-8")
+        position += length
+        if not line.startswith("#") and " " in line:
+            sha, ref = line.split(" ", 1)
+            refs[ref] = sha
+    return refs
+
+
+def resolve_commit_sha(session, url_git):
+    """
+    Returns the SHA of the repository's default branch head, or None if it cannot be resolved.
+    Asks the git server itself, like git ls-remote <url> HEAD, since GitHub's REST API only
+    allows 60 unauthenticated requests an hour.
+    """
+    try:
+        response = session.get(
+            f"{url_git.strip().rstrip('/')}/info/refs",
+            params={"service": "git-upload-pack"},
+            timeout=CONNECT_TIMEOUT_SECONDS,
+        )
+        if response.status_code == 200:
+            sha = advertised_refs(response.content).get("HEAD")
+            if sha:
+                return sha
+            logger.warning(f"Could not resolve HEAD of {url_git}: no HEAD advertised")
+        else:
+            logger.warning(f"Could not resolve HEAD of {url_git}: HTTP {response.status_code}")
+    except (requests.RequestException, ValueError) as e:
+        logger.warning(f"Could not resolve HEAD of {url_git}: {e}")
+    return None
+
+
+class JobManager:
+    """
+    Runs documentation pipelines in background threads, keyed by (repository URL, commit SHA).
+    A submission for a key that is already running joins that run, and a finished run is
+    served from cache for RESULT_TTL_SECONDS. Failed runs, and runs whose commit could not
+    be resolved, are not reused once finished.
+    """
+
+    def __init__(self, session, max_workers=MAX_CONCURRENT_JOBS, ttl_seconds=RESULT_TTL_SECONDS):
+        self.session = session
+        self.ttl_seconds = ttl_seconds
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="pipeline")
+        self._lock = threading.Lock()
+        self._jobs: Dict[Tuple[str, Optional[str]], Job] = {}
+
+    def submit(self, url_git) -> Job:
+        key = (normalize_repo_url(url_git), resolve_commit_sha(self.session, url_git))
+        with self._lock:
+            self._evict_expired()
+            job = self._jobs.get(key)
+            if job and not (job.finished and (job.status == "failed" or key[1] is None)):
+                return job
+            job = Job(key, url_git)
+            self._jobs[key] = job
+        self._executor.submit(self._run, job)
+        return job
+
+    def get(self, key) -> Optional[Job]:
+        with self._lock:
+            return self._jobs.get(tuple(key))
+
+    def _run(self, job: Job):
+        job.status = "running"
+        status = "failed"
+        try:
+            orchestrator = PipelineOrchestrator(documentation_stages(job.url_git), session=self.session,
+                                                trace_id=job.trace_id)
+            results = orchestrator.run(on_stage_done=lambda result: job.stages.__setitem__(result.name, result))
+            status = "done" if all(result.status == "success" for result in results.values()) else "failed"
+        except Exception as e:
+            logger.exception(f"Pipeline for {job.url_git} crashed")
+            job.error = str(e)
+        finally:
+            # finished_at first: a job seen as finished always has it, for _evict_expired
+            job.finished_at = time.time()
+            job.status = status
+
+    def _evict_expired(self):
+        now = time.time()
+        expired = [key for key, job in self._jobs.items()
+                   if job.finished and now - job.finished_at > self.ttl_seconds]
+        for key in expired:
+            del self._jobs[key]
@@ -0,0 +1,291 @@
+import re
+import time
+import uuid
+import logging
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+FUNCTIONS_BASE_URL = "https://europe-west1-doxygen-gcp.cloudfunctions.net"
+HTML_FUNCTION_URL = "https://function-4-html-32678029811.europe-west1.run.app/"
+BUCKET = "doxygen-gcp-storage"
+CONNECT_TIMEOUT_SECONDS = 10
+RETRY_BACKOFF_SECONDS = 2.0
+RETRYABLE_STATUS_CODES = (429, 500, 502, 503, 504)
+TRACE_HEADER = "X-Trace-Id"  # Lets every function attach its spans to the pipeline run
+
+logger = logging.getLogger(__name__)
+
+
+class StageError(RuntimeError):
+    """A stage answered, but with an error or an unexpected payload."""
+
+    def __init__(self, message, retryable=False):
+        super().__init__(message)
+        self.retryable = retryable
+
+
+@dataclass
+class Stage:
+    name: str
+    run: Callable[[requests.Session, float, Dict[str, Any]], Any]  # (session, timeout, results so far) -> value
+    depends_on: List[str] = field(default_factory=list)
+    timeout: float = 600  # Read timeout of one attempt, in seconds
+    retries: int = 0  # Extra attempts on connection errors, timeouts and 429/5xx answers
+
+
+@dataclass
+class StageResult:
+    name: str
+    status: str  # 'success', 'error' or 'skipped'
+    value: Any = None
+    error: Optional[str] = None
+    attempts: int = 0
+    started_at: float = 0.0
+    finished_at: float = 0.0
+
+    @property
+    def duration(self) -> float:
+        return self.finished_at - self.started_at
+
+
+def build_session(pool_size: int = 10) -> requests.Session:
+    """
+    Returns a keep-alive HTTP session whose connection pool is shared by all stages.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update({"Content-Type": "application/json"})
+    return session
+
+
+class TracedSession:
+    """
+    Sends every request of one pipeline run through the shared session with the run's trace id header.
+    """
+
+    def __init__(self, session: requests.Session, trace_id: str):
+        self.session = session
+        self.trace_id = trace_id
+
+    def get(self, url, **kwargs):
+        kwargs["headers"] = {**(kwargs.get("headers") or {}), TRACE_HEADER: self.trace_id}
+        return self.session.get(url, **kwargs)
+
+    def post(self, url, **kwargs):
+        kwargs["headers"] = {**(kwargs.get("headers") or {}), TRACE_HEADER: self.trace_id}
+        return self.session.post(url, **kwargs)
+
+
+def post_json(session, url, payload, timeout):
+    """
+    POSTs payload to a pipeline function and returns its decoded JSON answer.
+    """
+    response = session.post(url, json=payload, timeout=(CONNECT_TIMEOUT_SECONDS, timeout))
+    return decode_response(response)
+
+
+def decode_response(response):
+    if response.status_code in RETRYABLE_STATUS_CODES:
+        raise StageError(f"HTTP {response.status_code} from {response.url}", retryable=True)
+    try:
+        body = response.json()
+    except ValueError:
+        raise StageError(f"Invalid JSON from {response.url}: {response.text[:200]}")
+    if response.status_code >= 400 or body.get("status") == "error":
+        raise StageError(body.get("message") or f"HTTP {response.status_code} from {response.url}")
+    return body
+
+
+def extract_repo_details(git_url):
+    pattern = r"https?://(?:www\.)?github\.com/([^/]+)/([^/]+)"
+    match = re.match(pattern, git_url)
+    if match:
+        repo_owner = match.group(1)
+        repo_name = match.group(2).replace(
+            ".git", ""
+        )  # Supprimer l'extension .git si présente
+        return repo_owner, repo_name
+    return None, None
+
+
+class PipelineOrchestrator:
+    """
+    Runs stages as a dependency graph: each stage starts as soon as all the stages it
+    depends on have succeeded, so the end-to-end latency is the critical path rather
+    than the sum of the stages. A stage whose dependency failed is skipped.
+    All the stages' requests carry the same trace id.
+    """
+
+    def __init__(self, stages: List[Stage], session: Optional[requests.Session] = None, max_workers: int = 4,
+                 trace_id: Optional[str] = None):
+        names = {stage.name for stage in stages}
+        for stage in stages:
+            missing = [dep for dep in stage.depends_on if dep not in names]
+            if missing:
+                raise ValueError(f"Stage {stage.name} depends on unknown stages: {missing}")
+        self.stages = {stage.name: stage for stage in stages}
+        self.session = session or build_session()
+        self.max_workers = max_workers
+        self.trace_id = trace_id or uuid.uuid4().hex
+
+    def run(self, on_stage_done: Optional[Callable[[StageResult], None]] = None) -> Dict[str, StageResult]:
+        """
+        Runs every stage and returns their results by name.
+        on_stage_done is called from the calling thread as each stage finishes.
+        """
+        results: Dict[str, StageResult] = {}
+        running = {}
+        pending = dict(self.stages)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while pending or running:
+                scheduled = False
+                for name, stage in list(pending.items()):
+                    dependencies = [results.get(dep) for dep in stage.depends_on]
+                    if any(dep is not None and dep.status != "success" for dep in dependencies):
+                        del pending[name]
+                        scheduled = True
+                        now = time.time()
+                        results[name] = StageResult(name, "skipped", error="A dependency failed",
+                                                    started_at=now, finished_at=now)
+                        if on_stage_done:
+                            on_stage_done(results[name])
+                    elif all(dep is not None for dep in dependencies):
+                        del pending[name]
+                        scheduled = True
+                        running[executor.submit(self._run_stage, stage, dict(results))] = name
+
+                if not running:
+                    if not scheduled:
+                        raise ValueError(f"Dependency cycle between stages: {sorted(pending)}")
+                    continue  # Only skips happened, schedule again
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    results[name] = future.result()
+                    if on_stage_done:
+                        on_stage_done(results[name])
+        return results
+
+    def _run_stage(self, stage: Stage, previous: Dict[str, StageResult]) -> StageResult:
+        values = {name: result.value for name, result in previous.items()}
+        started_at = time.time()
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                value = stage.run(TracedSession(self.session, self.trace_id), stage.timeout, values)
+                return StageResult(stage.name, "success", value=value, attempts=attempt,
+                                   started_at=started_at, finished_at=time.time())
+            except (requests.ConnectionError, requests.Timeout, StageError) as e:
+                retryable = not isinstance(e, StageError) or e.retryable
+                if retryable and attempt <= stage.retries:
+                    logger.warning(f"Stage {stage.name} attempt {attempt} failed: {e}, retrying.")
+                    time.sleep(RETRY_BACKOFF_SECONDS * attempt)
+                    continue
+                return StageResult(stage.name, "error", error=str(e), attempts=attempt,
+                                   started_at=started_at, finished_at=time.time())
+            except Exception as e:
+                return StageResult(stage.name, "error", error=str(e), attempts=attempt,
+                                   started_at=started_at, finished_at=time.time())
+
+
+def timings(results: Dict[str, StageResult]) -> Dict[str, float]:
+    """
+    Returns each stage's duration and the end-to-end wall time, in seconds.
+    """
+    durations = {name: round(result.duration, 2) for name, result in results.items()}
+    if results:
+        start = min(result.started_at for result in results.values())
+        end = max(result.finished_at for result in results.values())
+        durations["total"] = round(end - start, 2)
+    return durations
+
+
+def download_stage(url_git):
+    def run(session, timeout, values):
+        response = session.get(f"{FUNCTIONS_BASE_URL}/function-1-download", params={"url": url_git},
+                               timeout=(CONNECT_TIMEOUT_SECONDS, timeout))
+        body = decode_response(response)
+        if "storage_uri" not in body:
+            raise StageError(body.get("response_text") or "No storage_uri returned")
+        return body["storage_uri"]
+    return run
+
+
+def comment_stage(url_git):
+    def run(session, timeout, values):
+        # The repository owner's requests share one fair share of the Gemini quota
+        repo_owner, _ = extract_repo_details(url_git)
+        payload = {"storage_uri": f"gs://{BUCKET}/{values['download']}"}
+        if repo_owner:
+            payload["tenant"] = repo_owner
+        # A partial answer left files for another call; stop when a call no longer makes progress
+        finished = -1
+        while True:
+            body = post_json(session, f"{FUNCTIONS_BASE_URL}/function-3-comment", payload, timeout)
+            files = body.get("files") or {}
+            if body["status_comment"] != "partial" or files.get("done", 0) + files.get("failed", 0) <= finished:
+                return body["status_comment"]
+            finished = files.get("done", 0) + files.get("failed", 0)
+    return run
+
+
+def readme_stage(session, timeout, values):
+    body = post_json(session, f"{FUNCTIONS_BASE_URL}/function-2-readme",
+                     {"storage_uri": f"gs://{BUCKET}/{values['download']}"}, timeout)
+    return body["status_readme"]
+
+
+def html_stage(session, timeout, values):
+    path = values["download"]
+    payload = {
+        "project_id": "doxygen-gcp",
+        "bucket_name": BUCKET,
+        "doxyfile_name": "Doxyfile",
+        "local_doxyfile_path": "/tmp/Doxyfile",
+        "gcs_prefixes": ["doxygen-awesome-css/", path + "/"],
+        "local_destinations": ["/tmp/doxygen-awesome-css/", "/tmp/" + path + "/"],
+        "doxygen_command": "/tmp/doxygen",
+        "signed_url_expiration_seconds": "3600",
+        "doxygen_binary_blob_name": "doxygen",
+    }
+    body = post_json(session, HTML_FUNCTION_URL, payload, timeout)
+    return body.get("docs_signed_url") or body.get("docs_index_url")
+
+
+def pull_request_stage(url_git):
+    def run(session, timeout, values):
+        repo_owner, repo_name = extract_repo_details(url_git)
+        if not repo_owner:
+            raise StageError(f"Not a GitHub repository URL: {url_git}")
+        payload = {
+            "storage_uri": f"gs://{BUCKET}/{values['download']}",
+            "repo_owner": repo_owner,
+            "repo_name": repo_name,
+        }
+        body = post_json(session, f"{FUNCTIONS_BASE_URL}/function-5-git-pr", payload, timeout)
+        return body.get("pull_request_url")
+    return run
+
+
+def documentation_stages(url_git) -> List[Stage]:
+    """
+    The documentation pipeline: download first, then comments and README in parallel,
+    then the HTML documentation and the pull request in parallel.
+    Commenting resumes from function-3's checkpoints, so a retry only comments the files
+    left; the pull request is not retried, since it would be opened twice.
+    """
+    return [
+        Stage("download", download_stage(url_git), timeout=600, retries=2),
+        Stage("comment", comment_stage(url_git), depends_on=["download"], timeout=3600, retries=2),
+        Stage("readme", readme_stage, depends_on=["download"], timeout=3600, retries=1),
+        Stage("html", html_stage, depends_on=["comment", "readme"], timeout=3600, retries=1),
+        Stage("pull_request", pull_request_stage(url_git), depends_on=["comment", "readme"], timeout=600),
+    ]
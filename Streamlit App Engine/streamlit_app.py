@@ -113,11 +113,12 @@
 ###################################################################################################
 
 
+import time
+
 import streamlit as st
-import requests
-import json
-import re
-import logging
+
+from jobs import JobManager
+from orchestrator import build_session, timings
 
 # Set page configuration
 st.set_page_config(
@@ -127,72 +128,65 @@ st.set_page_config(
     initial_sidebar_state="expanded",
 )
 
+STAGE_LABELS = {
+    "download": "📥 Downloading repository",
+    "comment": "💬 Adding comments",
+    "readme": "📄 Generating README",
+    "html": "🌐 Generating HTML Documentation",
+    "pull_request": "🚀 Pull Request",
+}
 
-def extract_repo_details(git_url):
-    pattern = r"https?://(?:www\.)?github\.com/([^/]+)/([^/]+)"
-    match = re.match(pattern, git_url)
-    if match:
-        repo_owner = match.group(1)
-        repo_name = match.group(2).replace(
-            ".git", ""
-        )  # Supprimer l'extension .git si présente
-        return repo_owner, repo_name
-    return None, None
-
-
-def make_pull_request(path, url_git):
-
-    repo_owner, repo_name = extract_repo_details(url_git)
-    logging.info(repo_owner, repo_name)
-    storage_uri = "gs://doxygen-gcp-storage/" + path
-    url = "https://europe-west1-doxygen-gcp.cloudfunctions.net/function-5-git-pr"
-    payload = {
-        "storage_uri": storage_uri,
-        "repo_owner": repo_owner,
-        "repo_name": repo_name,
-    }
-    response = requests.post(
-        url, headers={"Content-Type": "application/json"}, data=json.dumps(payload)
-    )
-    return response.json()["status"]
-
-
-def create_doc_html(path):
-    api_url = "https://function-4-html-32678029811.europe-west1.run.app/"
-
-    payload = {
-        "project_id": "doxygen-gcp",
-        "bucket_name": "doxygen-gcp-storage",
-        "doxyfile_name": "Doxyfile",
-        "local_doxyfile_path": "/tmp/Doxyfile",
-        "gcs_prefixes": ["doxygen-awesome-css/", path + "/"],
-        "local_destinations": ["/tmp/doxygen-awesome-css/", "/tmp/" + path + "/"],
-        "doxygen_command": "/tmp/doxygen",
-        "signed_url_expiration_seconds": "3600",
-        "doxygen_binary_blob_name": "doxygen",
-    }
-    response = requests.post(
-        api_url, json=payload, headers={"Content-Type": "application/json"}
-    )
-    return response.json()["status"]
 
+JOB_POLL_SECONDS = 2
 
-def comment_text(path):
-    response = requests.post(
-        "https://europe-west1-doxygen-gcp.cloudfunctions.net/function-3-comment",
-        headers={"Content-Type": "application/json"},
-        data=json.dumps({"storage_uri": "gs://doxygen-gcp-storage/" + path}),
-        timeout=3600,
-    )
-    return response.json()["status_comment"]
 
+@st.cache_resource
+def get_http_session():
+    """One keep-alive connection pool shared by every run of the app."""
+    return build_session(pool_size=32)
 
-def Download_Response(url_git):
-    response = requests.get(
-        "https://europe-west1-doxygen-gcp.cloudfunctions.net/function-1-download?url="
-        + url_git
-    )
-    return response.json()["storage_uri"]
+
+@st.cache_resource
+def get_job_manager():
+    """Background pipeline runs and their cached results, shared by every user of the instance."""
+    return JobManager(get_http_session())
+
+
+def show_job(job):
+    for name, label in STAGE_LABELS.items():
+        result = job.stages.get(name)
+        if result is None:
+            st.info(f"⏳ {label}...")
+        elif result.status == "success":
+            st.success(f"{label}: done in {result.duration:.1f}s")
+        elif result.status == "skipped":
+            st.warning(f"{label}: skipped, a previous step failed")
+        else:
+            st.error(f"{label}: {result.error}")
+    if job.error:
+        st.error(job.error)
+    if not job.finished:
+        return
+
+    html, pull_request = job.stages.get("html"), job.stages.get("pull_request")
+    if html and html.status == "success" and html.value:
+        st.markdown(f"[📦 Download the HTML documentation]({html.value})")
+    if pull_request and pull_request.status == "success":
+        if pull_request.value:
+            st.markdown(f"[🔀 Open the Pull Request]({pull_request.value})")
+        else:
+            st.info("No changes to propose, no Pull Request was opened.")
+    st.caption(f"Stage timings (s): {timings(job.stages)}")
+    st.caption(f"Trace id: {job.trace_id}")
+
+
+@st.fragment(run_every=JOB_POLL_SECONDS)
+def poll_job(job_key):
+    """Re-renders the running job every few seconds without blocking the rest of the app."""
+    job = get_job_manager().get(job_key)
+    if job is None or job.finished:
+        st.rerun()  # Render the final state outside the polling fragment
+    show_job(job)
 
 
 # Add custom CSS for dark theme
@@ -308,32 +302,25 @@ def main():
     if st.session_state.show_install_dialog:
         install_app_dialog()
 
-    # Proceed with Documentation Process
+    # Proceed with Documentation Process: submit a background job once, reruns only poll it
     if st.session_state.proceed:
-        result = None
-        with st.spinner("📥 Downloading repository..."):
-            result = Download_Response(url_git)
-            # Simulate download process
-            st.success("Successfully downloaded repository!")
-        with st.spinner("💬 Adding comments..."):
-            comment = comment_text(result)
-            # Simulate comments process
-            st.success("Comments successfully added!")
-
-        with st.spinner("📄 Generating README..."):
-            create_doc = create_doc_html(result)
-            # Simulate README generation process
-            st.success("README successfully generated!")
-
-        with st.spinner("🌐 Generating HTML Documentation..."):
-            pull_request = make_pull_request(result, url_git)
-            # Simulate HTML documentation process
-            st.success("HTML Documentation successfully generated!")
-
-        with st.spinner("🚀 Pull Request..."):
-            pull_request = make_pull_request(result, url_git)
-            # Simulate pull request process
-            st.success("Pull Request successfully created!")
+        job = get_job_manager().submit(url_git)
+        st.session_state.job_key = job.key
+        st.session_state.job_from_cache = job.finished
+        st.session_state.proceed = False
+
+    if st.session_state.get("job_key"):
+        job = get_job_manager().get(st.session_state.job_key)
+        if job is None:
+            st.warning("This run has expired, start the documentation process again.")
+            del st.session_state.job_key
+        elif job.finished:
+            if st.session_state.job_from_cache:
+                minutes = int((time.time() - job.finished_at) / 60)
+                st.caption(f"Result reused from a run finished {minutes} min ago.")
+            show_job(job)
+        else:
+            poll_job(job.key)
 
     # Footer
     st.markdown(
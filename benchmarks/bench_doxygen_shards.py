@@ -0,0 +1,97 @@
+"""
+Compares the wall time of a monolithic Doxygen build with the sharded build of function-4-html.
+
+Usage:
+    python benchmarks/bench_doxygen_shards.py --doxygen /usr/bin/doxygen --dirs 20 --files-per-dir 250
+
+Requires the function-4-html requirements to be installed, since its module is imported as is.
+"""
+import argparse
+import importlib.machinery
+import importlib.util
+import io
+import os
+import shutil
+import tempfile
+import time
+
+FUNCTION_4_SOURCE = os.path.join(os.path.dirname(__file__), '..', 'Cloud Functions', 'function-4-html', 'main.c')
+
+
+def load_function_4():
+    loader = importlib.machinery.SourceFileLoader('function_4_html', FUNCTION_4_SOURCE)
+    spec = importlib.util.spec_from_loader(loader.name, loader)
+    module = importlib.util.module_from_spec(spec)
+    loader.exec_module(module)
+    return module
+
+
+def generate_source_tree(root, dirs, files_per_dir):
+    """
+    Writes a synthetic C project: each directory holds a header and sources calling into the previous directory.
+    """
+    for d in range(dirs):
+        module_dir = os.path.join(root, f'module_{d}')
+        os.makedirs(module_dir)
+        with open(os.path.join(module_dir, f'module_{d}.h'), 'w') as header:
+            header.write(f'typedef struct s_module_{d} {{ int id; }} t_module_{d};\n')
+            for f in range(files_per_dir):
+                header.write(f'int module_{d}_fn_{f}(t_module_{d} *m);\n')
+        for f in range(files_per_dir):
+            with open(os.path.join(module_dir, f'file_{f}.c'), 'w') as source:
+                source.write(f'#include "module_{d}.h"\n')
+                source.write(f'int module_{d}_fn_{f}(t_module_{d} *m) {{ return m->id + {f}; }}\n')
+    with open(os.path.join(root, 'main.c'), 'w') as main_file:
+        main_file.write('int main(void) { return 0; }\n')
+
+
+def write_doxyfile(path, input_dir, output_dir):
+    with open(path, 'w') as doxyfile:
+        doxyfile.write(f'INPUT = {input_dir}\n')
+        doxyfile.write(f'OUTPUT_DIRECTORY = {output_dir}\n')
+        doxyfile.write('RECURSIVE = YES\nEXTRACT_ALL = YES\nGENERATE_LATEX = NO\nQUIET = YES\n')
+
+
+def timed(label, fn):
+    start = time.perf_counter()
+    result = fn()
+    elapsed = time.perf_counter() - start
+    print(f'{label:<12} {elapsed:8.2f}s  returncode={result.returncode}  warnings={result.summary.total}')
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--doxygen', default=shutil.which('doxygen') or '/tmp/doxygen')
+    parser.add_argument('--source', help='Existing source tree to document instead of a synthetic one')
+    parser.add_argument('--dirs', type=int, default=20)
+    parser.add_argument('--files-per-dir', type=int, default=250)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 2)
+    parser.add_argument('--timeout', type=int, default=3600)
+    args = parser.parse_args()
+
+    function_4 = load_function_4()
+    with tempfile.TemporaryDirectory() as work:
+        source = args.source
+        if not source:
+            source = os.path.join(work, 'src')
+            generate_source_tree(source, args.dirs, args.files_per_dir)
+        _, _, file_count = function_4.plan_shards([source])
+        print(f'{file_count} files, {args.workers} workers')
+
+        mono_doxyfile = os.path.join(work, 'mono.Doxyfile')
+        write_doxyfile(mono_doxyfile, source, os.path.join(work, 'mono'))
+        mono = timed('monolithic', lambda: function_4.run_doxygen_command(
+            args.doxygen, mono_doxyfile, io.StringIO(), args.timeout))
+
+        sharded_doxyfile = os.path.join(work, 'sharded.Doxyfile')
+        write_doxyfile(sharded_doxyfile, source, os.path.join(work, 'sharded'))
+        sharded = timed('sharded', lambda: function_4.run_sharded_doxygen(
+            args.doxygen, sharded_doxyfile, io.StringIO(), args.timeout, args.workers,
+            os.path.join(work, 'shards')))
+
+        print(f'speedup      {mono / sharded:8.2f}x')
+
+
+if __name__ == '__main__':
+    main()
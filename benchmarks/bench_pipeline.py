@@ -0,0 +1,304 @@
+"""
+End-to-end benchmark of the five Cloud Functions against local stand-ins for GCS, Gemini and GitHub.
+
+For each repository size, a synthetic C project is generated and committed, the fake bucket
+is seeded (Doxyfile, theme, Doxygen binary, keys) and the fake GitHub serves a copy of the
+project. Then each function's entry point (run_inference / run_doxygen_function) runs in its
+own process, as it would on Cloud Functions, and reports its wall time, import time, storage
+RPCs and bytes, Gemini calls and estimated tokens, GitHub requests and peak RSS.
+
+Usage:
+    python benchmarks/bench_pipeline.py --files 10 1000 --vertex-latency 0.5 --json results.json
+    python benchmarks/bench_pipeline.py --files 1000 --baseline results.json --tolerance 0.25
+
+With --baseline, exits with status 1 if a stage's wall time or storage/GitHub request counts
+grew by more than the tolerance. Requires the functions' requirements (functions-framework,
+Flask, gitpython, PyGithub, PyJWT with cryptography) and git. Without --doxygen, a stub that
+writes a single page stands in for Doxygen. function-4-html writes its binary and key to /tmp,
+as on Cloud Functions. Each function's trace is appended to traces.jsonl in the state
+directory (see --keep).
+"""
+import argparse
+import importlib.machinery
+import importlib.util
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+FUNCTIONS_DIR = os.path.join(BENCHMARKS_DIR, "..", "Cloud Functions")
+sys.path.insert(0, BENCHMARKS_DIR)
+
+import fake_gcp  # noqa: E402
+from synthetic_repo import generate_c_repo, read_tree  # noqa: E402
+
+BUCKET = "doxygen-gcp-storage"
+GITHUB_OWNER = "bench"
+GITHUB_PRIVATE_KEY = "code-documenter.2024-11-17.private-key.pem"
+SERVICE_ACCOUNT_KEY = "doxygen-gcp-cc505b0f3449.json"
+
+# (stage, function directory, source file, entry point)
+STAGES = [
+    ("download", "function-1-download", "main.py", "run_inference"),
+    ("comment", "function-3-comment", "main.py", "run_inference"),
+    ("readme", "function-2-readme", "main.py", "run_inference"),
+    ("html", "function-4-html", "main.c", "run_doxygen_function"),
+    ("pull_request", "function-5-git-pr", "main.py", "run_inference"),
+]
+
+STUB_DOXYGEN = """#!/bin/sh
+out=$(grep '^OUTPUT_DIRECTORY' "$1" | tail -1 | sed 's/.*= *//')
+mkdir -p "$out/html"
+echo '<html><body>stub</body></html>' > "$out/html/index.html"
+"""
+
+REGRESSION_METRICS = ("wall_seconds", "gcs_rpcs", "github_requests")
+
+
+def stage_payload(stage, state_dir, repo_dir, repo_name):
+    work_dir = os.path.join(state_dir, "work")
+    storage_uri = f"gs://{BUCKET}/{repo_name}"
+    if stage == "download":
+        return {"url": repo_dir}
+    if stage == "html":
+        return {
+            "project_id": "doxygen-gcp",
+            "bucket_name": BUCKET,
+            "doxyfile_name": "Doxyfile",
+            "local_doxyfile_path": os.path.join(work_dir, "Doxyfile"),
+            "gcs_prefixes": ["doxygen-awesome-css/", repo_name + "/"],
+            "local_destinations": [os.path.join(work_dir, "doxygen-awesome-css") + "/",
+                                   os.path.join(work_dir, repo_name) + "/"],
+            "doxygen_command": "/tmp/doxygen",
+            "signed_url_expiration_seconds": "3600",
+            "doxygen_binary_blob_name": "doxygen",
+            "use_build_cache": False,
+        }
+    if stage == "pull_request":
+        return {"storage_uri": storage_uri, "repo_owner": GITHUB_OWNER, "repo_name": repo_name}
+    return {"storage_uri": storage_uri}
+
+
+def generate_private_key():
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    return key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.TraditionalOpenSSL,
+                             serialization.NoEncryption())
+
+
+def seed_state(state_dir, repo_name, doxygen_binary):
+    work_dir = os.path.join(state_dir, "work")
+    os.makedirs(work_dir, exist_ok=True)
+    if doxygen_binary:
+        with open(doxygen_binary, "rb") as file:
+            doxygen = file.read()
+    else:
+        doxygen = STUB_DOXYGEN.encode()
+    fake_gcp.seed_bucket(os.path.join(state_dir, "gcs"), BUCKET, {
+        "Doxyfile": (f"PROJECT_NAME = {repo_name}\n"
+                     f"INPUT = {os.path.join(work_dir, repo_name)}\n"
+                     f"OUTPUT_DIRECTORY = {os.path.join(work_dir, 'docs')}\n"
+                     "RECURSIVE = YES\nEXTRACT_ALL = YES\nGENERATE_LATEX = NO\nQUIET = YES\n"
+                     f"HTML_EXTRA_STYLESHEET = {os.path.join(work_dir, 'doxygen-awesome-css', 'doxygen-awesome.css')}\n").encode(),
+        "doxygen-awesome-css/doxygen-awesome.css": b"html { --primary-color: #1779c4; }\n",
+        "doxygen": doxygen,
+        SERVICE_ACCOUNT_KEY: json.dumps({"type": "service_account", "project_id": "doxygen-gcp"}).encode(),
+        GITHUB_PRIVATE_KEY: generate_private_key(),
+    })
+
+
+def run_stage(args):
+    """Child process: runs one function's entry point against the fakes and prints its metrics as JSON."""
+    fake_gcp.install(os.path.join(args.state, "gcs"), gcs_latency=args.gcs_latency, gcs_error_rate=args.gcs_error_rate,
+                     vertex_latency=args.vertex_latency, vertex_error_rate=args.vertex_error_rate,
+                     vertex_rpm=args.vertex_rpm, seed=args.seed)
+    stage, directory, file_name, entry_point = next(s for s in STAGES if s[0] == args.run_stage)
+    function_dir = os.path.join(FUNCTIONS_DIR, directory)
+    os.chdir(function_dir)  # Cloud Functions run from their source directory
+    os.environ["DOCS_OUTPUT_DIR"] = os.path.join(args.state, "work", "docs")
+    os.environ.setdefault("TRACE_SINK", "file:" + os.path.join(args.state, "traces.jsonl"))
+    # function-3's limiter stays out of the measurement; --vertex-rpm makes the fake Gemini answer 429s instead
+    os.environ["MODEL_REQUESTS_PER_MINUTE"] = "0"
+
+    import flask
+
+    started_at = time.perf_counter()
+    loader = importlib.machinery.SourceFileLoader(directory.replace("-", "_"), os.path.join(function_dir, file_name))
+    spec = importlib.util.spec_from_loader(loader.name, loader)
+    module = importlib.util.module_from_spec(spec)
+    loader.exec_module(module)
+    import_seconds = time.perf_counter() - started_at
+    if stage == "comment":
+        # Pause after each Gemini call, none when deployed since the scheduler paces the calls
+        module.useGemini.__defaults__ = (args.comment_delay,) + module.useGemini.__defaults__[1:]
+
+    payload = stage_payload(stage, args.state, args.repo, os.path.basename(args.repo))
+    app = flask.Flask("bench")
+    started_at = time.perf_counter()
+    error = None
+    with app.test_request_context(method="POST", json=payload):
+        try:
+            response = app.make_response(getattr(module, entry_point)(flask.request))
+            status_code = response.status_code
+            body = response.get_json(silent=True) or json.loads(response.get_data(as_text=True) or "{}")
+        except Exception as e:
+            status_code, body, error = 500, {}, f"{type(e).__name__}: {e}"
+    wall_seconds = time.perf_counter() - started_at
+
+    self_usage = resource.getrusage(resource.RUSAGE_SELF)
+    children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    counters = fake_gcp.metrics()
+    print(json.dumps({
+        "stage": stage,
+        "status_code": status_code,
+        "ok": status_code < 400 and body.get("status") != "error" and error is None,
+        "error": error or body.get("message"),
+        "wall_seconds": round(wall_seconds, 3),
+        "import_seconds": round(import_seconds, 3),
+        "gcs_rpcs": counters["gcs"].get("rpcs", 0),
+        "gcs": counters["gcs"],
+        "vertex": counters["vertex"],
+        "peak_rss_mb": round(self_usage.ru_maxrss / 1024, 1),
+        "children_peak_rss_mb": round(children_usage.ru_maxrss / 1024, 1),
+    }))
+
+
+def github_delta(before, after):
+    endpoints = {name: count - before["by_endpoint"].get(name, 0) for name, count in after["by_endpoint"].items()}
+    return after["requests"] - before["requests"], {name: count for name, count in endpoints.items() if count}
+
+
+def run_size(args, file_count, root):
+    from fake_github import FakeGitHub
+
+    repo_name = f"bench-{file_count}"
+    repo_dir = os.path.join(root, "repos", repo_name)
+    state_dir = os.path.join(root, f"state-{file_count}")
+    written = generate_c_repo(repo_dir, file_count, seed=args.seed)
+    seed_state(state_dir, repo_name, args.doxygen)
+
+    results = []
+    with FakeGitHub(latency=args.github_latency, rate_limit=args.github_rate_limit,
+                    secondary_every=args.github_secondary_every) as github:
+        github.add_repo(GITHUB_OWNER, repo_name, read_tree(repo_dir))
+        env = {**os.environ, "GITHUB_API_URL": github.url}
+        for stage, *_ in STAGES:
+            if stage in args.skip:
+                continue
+            before = github.stats()
+            command = [sys.executable, os.path.abspath(__file__), "--run-stage", stage, "--state", state_dir,
+                       "--repo", repo_dir] + child_arguments(args)
+            completed = subprocess.run(command, env=env, capture_output=True, text=True)
+            lines = [line for line in completed.stdout.splitlines() if line.startswith("{")]
+            if completed.returncode != 0 or not lines:
+                result = {"stage": stage, "ok": False, "error": completed.stderr.strip()[-500:]}
+            else:
+                result = json.loads(lines[-1])
+            result["github_requests"], result["github"] = github_delta(before, github.stats())
+            result["files"] = written
+            results.append(result)
+            print_row(file_count, result)
+            if not result["ok"] and args.stop_on_error:
+                break
+    return results
+
+
+def child_arguments(args):
+    return ["--gcs-latency", str(args.gcs_latency), "--gcs-error-rate", str(args.gcs_error_rate),
+            "--vertex-latency", str(args.vertex_latency), "--vertex-error-rate", str(args.vertex_error_rate),
+            "--vertex-rpm", str(args.vertex_rpm), "--comment-delay", str(args.comment_delay), "--seed", str(args.seed)]
+
+
+HEADER = (f"{'files':>6} {'stage':<13}{'ok':<4}{'wall s':>9}{'import s':>9}{'gcs rpc':>9}{'MB down':>9}{'MB up':>8}"
+          f"{'gemini':>8}{'tok in':>10}{'tok out':>9}{'github':>8}{'RSS MB':>8}")
+
+
+def print_row(file_count, result):
+    gcs = result.get("gcs", {})
+    vertex = result.get("vertex", {})
+    print(f"{file_count:>6} {result['stage']:<13}{'yes' if result['ok'] else 'NO':<4}"
+          f"{result.get('wall_seconds', 0):>9.2f}{result.get('import_seconds', 0):>9.2f}{result.get('gcs_rpcs', 0):>9}"
+          f"{gcs.get('bytes_down', 0) / 1e6:>9.2f}{gcs.get('bytes_up', 0) / 1e6:>8.2f}"
+          f"{vertex.get('calls', 0):>8}{vertex.get('tokens_in', 0):>10}{vertex.get('tokens_out', 0):>9}"
+          f"{result.get('github_requests', 0):>8}{result.get('peak_rss_mb', 0):>8.1f}", flush=True)
+    if not result["ok"] and result.get("error"):
+        print(f"{'':>7}{result['error']}", flush=True)
+
+
+def find_regressions(results, baseline, tolerance):
+    previous = {(r["files"], r["stage"]): r for r in baseline}
+    regressions = []
+    for result in results:
+        reference = previous.get((result["files"], result["stage"]))
+        if not reference or not reference.get("ok"):
+            continue
+        if not result["ok"]:
+            regressions.append(f"{result['files']} files, {result['stage']}: now failing ({result.get('error')})")
+            continue
+        for metric in REGRESSION_METRICS:
+            old, new = reference.get(metric, 0), result.get(metric, 0)
+            if old and new > old * (1 + tolerance):
+                regressions.append(f"{result['files']} files, {result['stage']}: {metric} {old} -> {new}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--files", type=int, nargs="+", default=[10, 100, 1000], help="Repository sizes, 10 to 50000 files")
+    parser.add_argument("--doxygen", default=shutil.which("doxygen"), help="Doxygen binary to upload to the fake bucket")
+    parser.add_argument("--skip", action="append", default=[], choices=[s[0] for s in STAGES])
+    parser.add_argument("--gcs-latency", type=float, default=0.0, help="Seconds added to each storage RPC")
+    parser.add_argument("--gcs-error-rate", type=float, default=0.0, help="Fraction of storage RPCs failing with 503")
+    parser.add_argument("--vertex-latency", type=float, default=0.0, help="Seconds added to each Gemini call")
+    parser.add_argument("--vertex-error-rate", type=float, default=0.0)
+    parser.add_argument("--vertex-rpm", type=int, default=0, help="Gemini requests per minute before 429s (0: unlimited)")
+    parser.add_argument("--github-latency", type=float, default=0.0)
+    parser.add_argument("--github-rate-limit", type=int, default=5000)
+    parser.add_argument("--github-secondary-every", type=int, default=0, help="Every Nth GitHub request hits a secondary rate limit")
+    parser.add_argument("--comment-delay", type=float, default=0.0, help="Pause after each Gemini call in function-3")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--stop-on-error", action="store_true")
+    parser.add_argument("--keep", help="Keep the generated repositories and state in this directory")
+    parser.add_argument("--json", help="Write the results to this file")
+    parser.add_argument("--baseline", help="Results of a previous run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed relative growth before a regression is reported")
+    parser.add_argument("--run-stage", help=argparse.SUPPRESS)
+    parser.add_argument("--state", help=argparse.SUPPRESS)
+    parser.add_argument("--repo", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_stage:
+        run_stage(args)
+        return 0
+
+    root = args.keep or tempfile.mkdtemp(prefix="bench-pipeline-")
+    results = []
+    print(HEADER)
+    try:
+        for file_count in args.files:
+            results += run_size(args, file_count, root)
+    finally:
+        if not args.keep:
+            shutil.rmtree(root, ignore_errors=True)
+
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(results, file, indent=2)
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = find_regressions(results, json.load(file), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        return 1 if regressions else 0
+    return 0 if all(result["ok"] for result in results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
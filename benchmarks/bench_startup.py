@@ -0,0 +1,175 @@
+"""
+Cold start benchmark of the five Cloud Functions: how long a fresh instance takes from
+interpreter start to an importable, callable entry point, and what that import pulls in.
+
+Each function is imported in a new Python process, several times, and the medians are
+reported:
+  - process: interpreter start to entry point ready, measured by the parent
+  - import: executing the function's source file
+  - first use: building the lazily created clients, model and prompt assets (get_logger,
+    get_storage_client, get_bucket, get_model, load_examples) that the first request pays for
+  - modules: modules imported by the function's source, and which heavy SDKs among them
+
+Usage:
+    python benchmarks/bench_startup.py --repeat 10
+    python benchmarks/bench_startup.py --fakes --json startup.json
+    python benchmarks/bench_startup.py --baseline startup.json --tolerance 0.25
+
+By default the installed SDKs are imported, as on Cloud Functions; the first use then needs
+Google credentials and reports an error without them. --fakes replaces google.cloud.storage,
+google.cloud.logging and vertexai with the stand-ins of fake_gcp.py.
+"""
+import argparse
+import importlib.machinery
+import importlib.util
+import json
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCHMARKS_DIR)
+
+from bench_pipeline import FUNCTIONS_DIR, STAGES  # noqa: E402
+
+HEAVY_MODULES = ("google.cloud.storage", "google.cloud.logging", "vertexai", "git", "github", "jwt")
+# Lazy accessors called to measure the first request's extra work, when the function has them
+FIRST_USE = (("get_logger", ()), ("get_storage_client", ()), ("get_bucket", ()), ("get_model", ()),
+             ("load_examples", ()))
+REGRESSION_METRICS = ("process_seconds", "import_seconds")
+
+
+def run_function(args):
+    """Child process: imports one function and prints its startup metrics as JSON."""
+    stage, directory, file_name, entry_point = next(s for s in STAGES if s[0] == args.run_function)
+    if args.fakes:
+        import fake_gcp
+
+        fake_gcp.install(tempfile.mkdtemp(prefix="bench-startup-"))
+    function_dir = os.path.join(FUNCTIONS_DIR, directory)
+    os.chdir(function_dir)  # Cloud Functions run from their source directory
+    modules_before = set(sys.modules)
+
+    started_at = time.perf_counter()
+    loader = importlib.machinery.SourceFileLoader(directory.replace("-", "_"), os.path.join(function_dir, file_name))
+    spec = importlib.util.spec_from_loader(loader.name, loader)
+    module = importlib.util.module_from_spec(spec)
+    loader.exec_module(module)
+    getattr(module, entry_point)  # Ready once the entry point resolves
+    import_seconds = time.perf_counter() - started_at
+    imported = set(sys.modules) - modules_before
+    heavy = sorted(name for name in HEAVY_MODULES if name in imported)
+
+    error = None
+    started_at = time.perf_counter()
+    for name, arguments in FIRST_USE:
+        if hasattr(module, name):
+            try:
+                getattr(module, name)(*arguments)
+            except Exception as e:
+                error = error or f"{name}: {type(e).__name__}: {e}"
+    first_use_seconds = time.perf_counter() - started_at
+
+    print(json.dumps({
+        "stage": stage,
+        "import_seconds": round(import_seconds, 4),
+        "first_use_seconds": round(first_use_seconds, 4),
+        "first_use_error": error,
+        "modules_imported": len(imported),
+        "heavy_modules_at_import": heavy,
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }))
+
+
+def measure(args, stage):
+    command = [sys.executable, os.path.abspath(__file__), "--run-function", stage] + (["--fakes"] if args.fakes else [])
+    runs = []
+    for _ in range(args.repeat):
+        started_at = time.perf_counter()
+        completed = subprocess.run(command, capture_output=True, text=True)
+        process_seconds = time.perf_counter() - started_at
+        lines = [line for line in completed.stdout.splitlines() if line.startswith("{")]
+        if completed.returncode != 0 or not lines:
+            return {"stage": stage, "ok": False, "error": completed.stderr.strip()[-500:]}
+        run = json.loads(lines[-1])
+        run["process_seconds"] = process_seconds
+        runs.append(run)
+
+    result = dict(runs[-1], ok=True, runs=len(runs))
+    for metric in ("process_seconds", "import_seconds", "first_use_seconds", "peak_rss_mb"):
+        result[metric] = round(statistics.median(run[metric] for run in runs), 4)
+    return result
+
+
+HEADER = f"{'stage':<13}{'ok':<4}{'process ms':>11}{'import ms':>10}{'first use ms':>13}{'modules':>9}{'RSS MB':>8}  heavy at import"
+
+
+def print_row(result):
+    if not result["ok"]:
+        print(f"{result['stage']:<13}{'NO':<4}  {result['error']}", flush=True)
+        return
+    print(f"{result['stage']:<13}{'yes':<4}{result['process_seconds'] * 1000:>11.0f}{result['import_seconds'] * 1000:>10.0f}"
+          f"{result['first_use_seconds'] * 1000:>13.0f}{result['modules_imported']:>9}{result['peak_rss_mb']:>8.1f}"
+          f"  {', '.join(result['heavy_modules_at_import']) or '-'}", flush=True)
+    if result.get("first_use_error"):
+        print(f"{'':>17}first use: {result['first_use_error'][:200]}", flush=True)
+
+
+def find_regressions(results, baseline, tolerance):
+    previous = {r["stage"]: r for r in baseline}
+    regressions = []
+    for result in results:
+        reference = previous.get(result["stage"])
+        if not reference or not reference.get("ok"):
+            continue
+        if not result["ok"]:
+            regressions.append(f"{result['stage']}: now failing ({result.get('error')})")
+            continue
+        for metric in REGRESSION_METRICS:
+            old, new = reference.get(metric, 0), result.get(metric, 0)
+            if old and new > old * (1 + tolerance):
+                regressions.append(f"{result['stage']}: {metric} {old} -> {new}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=5, help="Fresh processes per function; medians are reported")
+    parser.add_argument("--skip", action="append", default=[], choices=[s[0] for s in STAGES])
+    parser.add_argument("--fakes", action="store_true", help="Use fake_gcp instead of the Google SDKs")
+    parser.add_argument("--json", help="Write the results to this file")
+    parser.add_argument("--baseline", help="Results of a previous run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed relative growth before a regression is reported")
+    parser.add_argument("--run-function", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_function:
+        run_function(args)
+        return 0
+
+    print(HEADER)
+    results = []
+    for stage, *_ in STAGES:
+        if stage in args.skip:
+            continue
+        results.append(measure(args, stage))
+        print_row(results[-1])
+
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(results, file, indent=2)
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = find_regressions(results, json.load(file), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        return 1 if regressions else 0
+    return 0 if all(result["ok"] for result in results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,387 @@
+"""
+In-process stand-ins for google.cloud.storage, google.cloud.logging and vertexai, so the
+Cloud Functions can be run unmodified without Google services.
+
+Objects live as files under a root directory, so several processes (one per function)
+share one fake bucket. Every storage RPC and Gemini call is counted, with the bytes
+moved and an estimate of the tokens sent and received, and can be slowed down or failed
+on purpose:
+
+    fake_gcp.install(root, gcs_latency=0.02, gcs_error_rate=0.01, vertex_latency=1.5, vertex_rpm=60)
+    module = load the function's main.py
+    ...
+    print(fake_gcp.metrics())
+
+install() must run before the function's module is imported.
+"""
+import base64
+import hashlib
+import io
+import json
+import math
+import os
+import random
+import sys
+import threading
+import time
+import types
+from collections import Counter
+
+try:
+    from google.api_core.exceptions import PreconditionFailed, ResourceExhausted, ServiceUnavailable
+except ImportError:
+    class PreconditionFailed(Exception):
+        code = 412
+
+    class ServiceUnavailable(Exception):
+        code = 503
+
+    class ResourceExhausted(Exception):
+        code = 429
+
+CHARS_PER_TOKEN = 4  # Rough average for source code and French prose
+
+
+class Faults:
+    """Latency, random failures and a requests-per-minute limit applied to one fake service."""
+
+    def __init__(self, latency=0.0, error_rate=0.0, rpm=0, seed=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rpm = rpm
+        self._random = random.Random(seed)
+        self._window = []
+        self._lock = threading.Lock()
+
+    def apply(self, counters, name):
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            if self.rpm:
+                now = time.time()
+                self._window = [t for t in self._window if now - t < 60]
+                if len(self._window) >= self.rpm:
+                    counters["throttled"] += 1
+                    raise ResourceExhausted(f"429 Quota exceeded for {name}")
+                self._window.append(now)
+            if self.error_rate and self._random.random() < self.error_rate:
+                counters["errors"] += 1
+                raise ServiceUnavailable(f"503 Injected failure of {name}")
+
+
+_counters = Counter()
+_counters_lock = threading.Lock()
+_gcs_faults = Faults()
+_vertex_faults = Faults()
+_vertex_response = None
+_root = None
+_store_lock = threading.Lock()
+
+
+def count(**increments):
+    with _counters_lock:
+        _counters.update(increments)
+
+
+def metrics():
+    """Returns the counters of this process, grouped by service."""
+    with _counters_lock:
+        snapshot = dict(_counters)
+    grouped = {"gcs": {}, "vertex": {}}
+    for key, value in snapshot.items():
+        service, _, name = key.partition("_")
+        grouped.setdefault(service, {})[name] = value
+    grouped["gcs"]["rpcs"] = sum(v for k, v in grouped["gcs"].items() if k.startswith("rpc"))
+    return grouped
+
+
+def _gcs_rpc(op):
+    count(**{f"gcs_rpc_{op}": 1})
+    counters = Counter()
+    try:
+        _gcs_faults.apply(counters, f"storage.{op}")
+    finally:
+        if counters:
+            count(**{f"gcs_{k}": v for k, v in counters.items()})
+
+
+# google.cloud.storage
+
+class Blob:
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.size = None
+        self.md5_hash = None
+        self.crc32c = None
+        self.generation = None
+        self.content_type = None
+
+    @property
+    def _path(self):
+        return os.path.join(_root, self.bucket.name, self.name)
+
+    def _load_metadata(self):
+        with open(self._path, "rb") as file:
+            data = file.read()
+        self.size = len(data)
+        self.md5_hash = base64.b64encode(hashlib.md5(data).digest()).decode()
+        self.generation = os.stat(self._path).st_mtime_ns
+        return self
+
+    def exists(self, client=None):
+        _gcs_rpc("metadata")
+        return os.path.isfile(self._path)
+
+    def reload(self, client=None):
+        _gcs_rpc("metadata")
+        if not os.path.isfile(self._path):
+            raise FileNotFoundError(f"404 No such object: {self.bucket.name}/{self.name}")
+        self._load_metadata()
+
+    def download_as_bytes(self, client=None, **kwargs):
+        _gcs_rpc("read")
+        with open(self._path, "rb") as file:
+            data = file.read()
+        count(gcs_bytes_down=len(data))
+        return data
+
+    def download_as_text(self, client=None, encoding="utf-8", **kwargs):
+        return self.download_as_bytes().decode(encoding)
+
+    def download_to_filename(self, filename, client=None, **kwargs):
+        data = self.download_as_bytes()
+        with open(filename, "wb") as file:
+            file.write(data)
+
+    def _store(self, data, rpcs=1, if_generation_match=None):
+        """Writes the object; with if_generation_match, only if it still has that generation (0: absent)."""
+        for _ in range(rpcs):
+            _gcs_rpc("write")
+        os.makedirs(os.path.dirname(self._path), exist_ok=True)
+        with _store_lock:
+            previous = os.stat(self._path).st_mtime_ns if os.path.isfile(self._path) else 0
+            if if_generation_match is not None and previous != if_generation_match:
+                raise PreconditionFailed(f"412 Generation of {self.bucket.name}/{self.name} is not {if_generation_match}")
+            # Written aside then renamed, so readers see the old or the new object, never a partial one
+            temporary = f"{self._path}.{threading.get_ident()}.tmp"
+            with open(temporary, "wb") as file:
+                file.write(data)
+            if os.stat(temporary).st_mtime_ns <= previous:  # Every write gets a new generation
+                os.utime(temporary, ns=(previous + 1, previous + 1))
+            os.replace(temporary, self._path)
+        count(gcs_bytes_up=len(data))
+
+    def upload_from_string(self, data, content_type="text/plain", client=None, if_generation_match=None, **kwargs):
+        self._store(data.encode("utf-8") if isinstance(data, str) else data, if_generation_match=if_generation_match)
+
+    def upload_from_filename(self, filename, content_type=None, client=None, **kwargs):
+        with open(filename, "rb") as file:
+            self._store(file.read())
+
+    def upload_from_file(self, file_obj, content_type=None, client=None, **kwargs):
+        self._store(file_obj.read())
+
+    def open(self, mode="r", chunk_size=None, ignore_flush=False, encoding="utf-8", **kwargs):
+        if mode in ("r", "rb", "rt"):
+            data = self.download_as_bytes()
+            return io.BytesIO(data) if mode == "rb" else io.StringIO(data.decode(encoding))
+        if mode in ("w", "wb", "wt"):
+            writer = _BlobWriter(self, chunk_size or 40 * 1024 * 1024)
+            return writer if mode == "wb" else io.TextIOWrapper(writer, encoding=encoding, write_through=True)
+        raise ValueError(f"Unsupported mode {mode}")
+
+    def delete(self, client=None):
+        _gcs_rpc("delete")
+        os.remove(self._path)
+
+    def generate_signed_url(self, expiration=None, version=None, method="GET", **kwargs):
+        return f"https://storage.fake/{self.bucket.name}/{self.name}?X-Goog-Signature=fake"
+
+
+class _BlobWriter(io.RawIOBase):
+    """Buffers a resumable upload and counts one RPC per chunk, plus the session start."""
+
+    def __init__(self, blob, chunk_size):
+        super().__init__()
+        self._blob = blob
+        self._chunk_size = chunk_size
+        self._buffer = io.BytesIO()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        return self._buffer.write(data)
+
+    def close(self):
+        if not self.closed:
+            data = self._buffer.getvalue()
+            self._blob._store(data, rpcs=1 + max(1, math.ceil(len(data) / self._chunk_size)))
+        super().close()
+
+
+class Bucket:
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+
+    def blob(self, name, **kwargs):
+        return Blob(self, name)
+
+    def get_blob(self, name, client=None, **kwargs):
+        _gcs_rpc("metadata")
+        blob = Blob(self, name)
+        return blob._load_metadata() if os.path.isfile(blob._path) else None
+
+    def list_blobs(self, prefix=None, **kwargs):
+        return self.client.list_blobs(self, prefix=prefix)
+
+
+class Client:
+    def __init__(self, project=None, credentials=None, **kwargs):
+        self.project = project
+
+    @classmethod
+    def from_service_account_json(cls, json_credentials_path, *args, **kwargs):
+        return cls()
+
+    def bucket(self, bucket_name, user_project=None):
+        return Bucket(self, bucket_name)
+
+    def list_blobs(self, bucket_or_name, prefix=None, **kwargs):
+        bucket = bucket_or_name if isinstance(bucket_or_name, Bucket) else Bucket(self, bucket_or_name)
+        bucket_dir = os.path.join(_root, bucket.name)
+        names = []
+        for directory, dirs, files in os.walk(bucket_dir):
+            for file_name in files:
+                name = os.path.relpath(os.path.join(directory, file_name), bucket_dir).replace(os.sep, "/")
+                if name.startswith(prefix or ""):
+                    names.append(name)
+        for _ in range(max(1, math.ceil(len(names) / 1000))):  # One RPC per page of 1000 objects
+            _gcs_rpc("list")
+        return iter([Blob(bucket, name)._load_metadata() for name in sorted(names)])
+
+
+# google.cloud.logging
+
+class Logger:
+    def __init__(self, name):
+        self.name = name
+
+    def log_text(self, text, severity=None, **kwargs):
+        count(logging_entries=1)
+
+    def log(self, payload=None, **kwargs):
+        count(logging_entries=1)
+
+    def log_struct(self, info, severity=None, **kwargs):
+        count(logging_entries=1)
+
+    def error(self, text, *args, **kwargs):
+        count(logging_entries=1)
+
+
+class LoggingClient:
+    def __init__(self, project=None, **kwargs):
+        self.project = project
+
+    def setup_logging(self, **kwargs):
+        pass
+
+    def logger(self, name):
+        return Logger(name)
+
+
+# vertexai
+
+def estimate_tokens(text):
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+class GenerationResponse:
+    def __init__(self, text, blocked=False):
+        self._text = text
+        self._blocked = blocked
+
+    @property
+    def text(self):
+        if self._blocked:
+            raise ValueError("Response candidate was blocked")
+        return self._text
+
+
+def default_response(prompt):
+    """Answers a comment prompt with the analysed file, and anything else with a short README."""
+    marker = "Code source à analyser :"
+    if marker in prompt:
+        source = prompt.split(marker, 1)[1].split("Je te donne des exemples:", 1)[0]
+        source = source.split("Déclarations d'autres fichiers du projet", 1)[0].strip()
+        return "/**\n * @file\n * @brief Generated by the fake model.\n */\n" + source + "\n"
+    return "# Project\n\n## Table des matières\n\n- Description\n- Utilisation\n"
+
+
+class GenerativeModel:
+    def __init__(self, model_name, **kwargs):
+        self.model_name = model_name
+
+    def generate_content(self, contents, **kwargs):
+        prompt = "".join(contents) if isinstance(contents, (list, tuple)) else str(contents)
+        count(vertex_calls=1, vertex_tokens_in=estimate_tokens(prompt), vertex_bytes_in=len(prompt.encode()))
+        counters = Counter()
+        try:
+            _vertex_faults.apply(counters, "generate_content")
+        finally:
+            if counters:
+                count(**{f"vertex_{k}": v for k, v in counters.items()})
+        text = (_vertex_response or default_response)(prompt)
+        count(vertex_tokens_out=estimate_tokens(text))
+        return GenerationResponse(text)
+
+
+def _module(name, **attributes):
+    module = types.ModuleType(name)
+    module.__dict__.update(attributes)
+    sys.modules[name] = module
+    return module
+
+
+def install(root, gcs_latency=0.0, gcs_error_rate=0.0, vertex_latency=0.0, vertex_error_rate=0.0,
+            vertex_rpm=0, vertex_response=None, seed=0):
+    """
+    Registers the fakes as google.cloud.storage, google.cloud.logging and vertexai.
+    root holds one directory per bucket. vertex_response(prompt) -> text overrides the model's answers.
+    """
+    global _root, _gcs_faults, _vertex_faults, _vertex_response
+    _root = os.path.abspath(root)
+    _gcs_faults = Faults(gcs_latency, gcs_error_rate, seed=seed)
+    _vertex_faults = Faults(vertex_latency, vertex_error_rate, vertex_rpm, seed=seed + 1)
+    _vertex_response = vertex_response
+
+    try:
+        import google.cloud as google_cloud
+    except ImportError:
+        google_cloud = _module("google.cloud")
+        _module("google", cloud=google_cloud)
+    storage = _module("google.cloud.storage", Client=Client, Bucket=Bucket, Blob=Blob)
+    logging = _module("google.cloud.logging", Client=LoggingClient, Logger=Logger)
+    google_cloud.storage = storage
+    google_cloud.logging = logging
+
+    generative_models = _module("vertexai.preview.generative_models", GenerativeModel=GenerativeModel)
+    generative_models_ga = _module("vertexai.generative_models", GenerativeModel=GenerativeModel)
+    preview = _module("vertexai.preview", generative_models=generative_models)
+    _module("vertexai", init=lambda **kwargs: None, preview=preview, generative_models=generative_models_ga)
+
+
+def seed_bucket(root, bucket_name, objects):
+    """Writes {name: bytes} into the fake bucket without counting RPCs."""
+    for name, data in objects.items():
+        path = os.path.join(root, bucket_name, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as file:
+            file.write(data)
+
+
+if __name__ == "__main__":
+    print(json.dumps(metrics()))
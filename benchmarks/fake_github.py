@@ -0,0 +1,278 @@
+"""
+Local stand-in for the parts of the GitHub REST API used by function-5-git-pr.
+
+Serves repositories, branches, git data (blobs, trees, commits, refs), pull requests and
+GitHub App installation tokens from memory. It can inject latency, a primary rate limit
+(X-RateLimit-* headers, 403 once exhausted) and secondary rate limits (403/429 with
+Retry-After), and counts requests per endpoint.
+
+Usage:
+    with FakeGitHub(rate_limit=100, secondary_every=20) as fake:
+        os.environ["GITHUB_API_URL"] = fake.url
+        ...
+        print(fake.stats())
+
+or standalone: python benchmarks/fake_github.py --port 8765
+"""
+import argparse
+import base64
+import hashlib
+import json
+import re
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+
+def git_object_sha(kind, content):
+    return hashlib.sha1(f"{kind} {len(content)}\0".encode() + content).hexdigest()
+
+
+class FakeRepository:
+    def __init__(self, owner, name, files=None, default_branch="main"):
+        self.owner = owner
+        self.name = name
+        self.default_branch = default_branch
+        self.blobs = {}
+        self.trees = {}
+        self.commits = {}
+        self.refs = {}
+        self.pulls = []
+        tree_sha = self.add_tree({path: self.add_blob(content) for path, content in (files or {}).items()})
+        self.refs[f"refs/heads/{default_branch}"] = self.add_commit("Initial commit", tree_sha, [])
+
+    def add_blob(self, content):
+        sha = git_object_sha("blob", content)
+        self.blobs[sha] = content
+        return sha
+
+    def add_tree(self, entries):
+        """entries maps a path to a blob SHA; trees are stored flat, keyed by path."""
+        sha = git_object_sha("tree", json.dumps(sorted(entries.items())).encode())
+        self.trees[sha] = dict(entries)
+        return sha
+
+    def add_commit(self, message, tree_sha, parents):
+        sha = git_object_sha("commit", json.dumps([message, tree_sha, parents, time.time()]).encode())
+        self.commits[sha] = {"message": message, "tree": tree_sha, "parents": parents}
+        return sha
+
+
+class FakeGitHub:
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, rate_limit=5000,
+                 secondary_every=0, secondary_status=403, retry_after=1):
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.remaining = rate_limit
+        self.reset_at = int(time.time()) + 3600
+        self.secondary_every = secondary_every
+        self.secondary_status = secondary_status
+        self.retry_after = retry_after
+        self.repos = {}
+        self.requests = Counter()
+        self.throttled = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def add_repo(self, owner, name, files=None, default_branch="main"):
+        repo = FakeRepository(owner, name, files, default_branch)
+        self.repos[(owner, name)] = repo
+        return repo
+
+    def stats(self):
+        with self._lock:
+            return {
+                "requests": sum(self.requests.values()),
+                "by_endpoint": dict(self.requests),
+                "throttled": self.throttled,
+                "rate_limit_remaining": self.remaining,
+            }
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _admit(self):
+        """Returns (status, headers, body) if the next request must be rejected. Caller holds the lock."""
+        total = sum(self.requests.values()) + 1
+        if self.secondary_every and total % self.secondary_every == 0:
+            self.throttled += 1
+            return self.secondary_status, {"Retry-After": str(self.retry_after)}, {
+                "message": "You have exceeded a secondary rate limit. Please wait a few minutes before you try again."}
+        if self.remaining <= 0:
+            self.throttled += 1
+            return 403, {}, {"message": "API rate limit exceeded"}
+        self.remaining -= 1
+        return None
+
+    def _rate_limit_headers(self):
+        return {
+            "X-RateLimit-Limit": str(self.rate_limit),
+            "X-RateLimit-Remaining": str(max(self.remaining, 0)),
+            "X-RateLimit-Reset": str(self.reset_at),
+        }
+
+    def _route(self, method, path, body):
+        base = self.url
+        match = re.match(r"^/repos/([^/]+)/([^/]+)(/.*)?$", path)
+        if method == "POST" and re.match(r"^/app/installations/\d+/access_tokens$", path):
+            expires = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(time.time() + 3600))
+            return "access_tokens", 201, {"token": "fake-installation-token", "expires_at": expires}
+        if not match:
+            return "unknown", 404, {"message": "Not Found"}
+        repo = self.repos.get((match.group(1), match.group(2)))
+        if repo is None:
+            return "repo", 404, {"message": "Not Found"}
+        repo_url = f"{base}/repos/{repo.owner}/{repo.name}"
+        rest = match.group(3) or ""
+
+        def commit_payload(sha):
+            commit = repo.commits[sha]
+            return {"sha": sha, "url": f"{repo_url}/git/commits/{sha}", "message": commit["message"],
+                    "tree": {"sha": commit["tree"], "url": f"{repo_url}/git/trees/{commit['tree']}"},
+                    "parents": [{"sha": p, "url": f"{repo_url}/git/commits/{p}"} for p in commit["parents"]]}
+
+        if method == "GET" and rest == "":
+            return "repo", 200, {"name": repo.name, "full_name": f"{repo.owner}/{repo.name}",
+                                 "owner": {"login": repo.owner}, "url": repo_url,
+                                 "default_branch": repo.default_branch}
+        if method == "GET" and rest == "/installation":
+            return "installation", 200, {"id": 1, "app_id": 1}
+        branch = re.match(r"^/branches/(.+)$", rest)
+        if method == "GET" and branch:
+            sha = repo.refs.get(f"refs/heads/{branch.group(1)}")
+            if sha is None:
+                return "branch", 404, {"message": "Branch not found"}
+            return "branch", 200, {"name": branch.group(1), "commit": {
+                "sha": sha, "url": f"{repo_url}/commits/{sha}", "commit": commit_payload(sha)}}
+        tree = re.match(r"^/git/trees/([0-9a-f]+)$", rest)
+        if method == "GET" and tree:
+            entries = repo.trees.get(tree.group(1))
+            if entries is None:
+                return "get_tree", 404, {"message": "Not Found"}
+            return "get_tree", 200, {"sha": tree.group(1), "url": f"{repo_url}/git/trees/{tree.group(1)}", "truncated": False,
+                                     "tree": [{"path": p, "mode": "100644", "type": "blob", "sha": s} for p, s in sorted(entries.items())]}
+        commit = re.match(r"^/git/commits/([0-9a-f]+)$", rest)
+        if method == "GET" and commit:
+            if commit.group(1) not in repo.commits:
+                return "get_commit", 404, {"message": "Not Found"}
+            return "get_commit", 200, commit_payload(commit.group(1))
+        if method == "POST" and rest == "/git/blobs":
+            content = body["content"].encode()
+            if body.get("encoding") == "base64":
+                content = base64.b64decode(content)
+            sha = repo.add_blob(content)
+            return "create_blob", 201, {"sha": sha, "url": f"{repo_url}/git/blobs/{sha}"}
+        if method == "POST" and rest == "/git/trees":
+            entries = dict(repo.trees.get(body.get("base_tree"), {}))
+            for element in body["tree"]:
+                if element.get("sha") is None:
+                    entries.pop(element["path"], None)
+                else:
+                    entries[element["path"]] = element["sha"]
+            sha = repo.add_tree(entries)
+            return "create_tree", 201, {"sha": sha, "url": f"{repo_url}/git/trees/{sha}", "tree": []}
+        if method == "POST" and rest == "/git/commits":
+            sha = repo.add_commit(body["message"], body["tree"], body.get("parents", []))
+            return "create_commit", 201, commit_payload(sha)
+        if method == "POST" and rest == "/git/refs":
+            if body["ref"] in repo.refs:
+                return "create_ref", 422, {"message": "Reference already exists"}
+            repo.refs[body["ref"]] = body["sha"]
+            return "create_ref", 201, {"ref": body["ref"], "url": f"{repo_url}/git/{body['ref']}",
+                                       "object": {"sha": body["sha"], "type": "commit"}}
+        if method == "POST" and rest == "/pulls":
+            number = len(repo.pulls) + 1
+            repo.pulls.append(body)
+            return "create_pull", 201, {"number": number, "url": f"{repo_url}/pulls/{number}",
+                                        "html_url": f"https://github.com/{repo.owner}/{repo.name}/pull/{number}",
+                                        "title": body.get("title"), "state": "open"}
+        return "unknown", 404, {"message": "Not Found"}
+
+    def _handler_class(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _serve(self, method):
+                length = int(self.headers.get("Content-Length") or 0)
+                body = json.loads(self.rfile.read(length) or b"{}") if length else {}
+                path = urlparse(self.path).path
+                if fake.latency:
+                    time.sleep(fake.latency)
+                with fake._lock:
+                    rejection = fake._admit()
+                    if rejection:
+                        endpoint = "throttled"
+                        status, extra_headers, payload = rejection
+                    else:
+                        endpoint, status, payload = fake._route(method, path, body)
+                        extra_headers = {}
+                    fake.requests[endpoint] += 1
+                    headers = {**fake._rate_limit_headers(), **extra_headers}
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                self._serve("GET")
+
+            def do_POST(self):
+                self._serve("POST")
+
+            def do_PATCH(self):
+                self._serve("PATCH")
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a fake GitHub API server.")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--rate-limit", type=int, default=5000)
+    parser.add_argument("--secondary-every", type=int, default=0)
+    parser.add_argument("--repo", default="octo/demo", help="owner/name of an empty repository to serve")
+    args = parser.parse_args()
+
+    fake = FakeGitHub(port=args.port, latency=args.latency, rate_limit=args.rate_limit,
+                      secondary_every=args.secondary_every)
+    owner, name = args.repo.split("/")
+    fake.add_repo(owner, name, {"README.md": b"# demo\n"})
+    print(f"Fake GitHub listening on {fake.url}")
+    try:
+        fake._server.serve_forever()
+    except KeyboardInterrupt:
+        fake.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+"""
+Generates a synthetic C project of a given size as a git repository.
+
+Files are grouped in modules of up to FILES_PER_MODULE sources sharing one header; each
+source defines a struct-handling function and a few helpers, and calls into the previous
+module, so Doxygen and the prompts see realistic cross-file references.
+
+Usage:
+    python benchmarks/synthetic_repo.py /tmp/bench-repo --files 5000
+"""
+import argparse
+import os
+import random
+import subprocess
+
+FILES_PER_MODULE = 200
+
+
+def module_header(module, functions):
+    lines = [f"#ifndef MODULE_{module}_H", f"# define MODULE_{module}_H", "", "# include <stddef.h>", ""]
+    if module:
+        lines += [f'# include "../module_{module - 1}/module_{module - 1}.h"', ""]
+    lines += [
+        f"typedef enum e_state_{module} {{ STATE_{module}_IDLE, STATE_{module}_BUSY, STATE_{module}_DONE }} t_state_{module};",
+        "",
+        f"typedef struct s_module_{module}",
+        "{",
+        "\tint\t\t\tid;",
+        "\tsize_t\t\tcount;",
+        f"\tt_state_{module}\tstate;",
+        "}\t\t\t\t" + f"t_module_{module};",
+        "",
+    ]
+    lines += [f"int\tmodule_{module}_fn_{index}(t_module_{module} *m, int value);" for index in functions]
+    lines += ["", "#endif", ""]
+    return "\n".join(lines)
+
+
+def module_source(module, index, rng):
+    helpers = rng.randint(1, 4)
+    lines = [f'#include "module_{module}.h"', ""]
+    for helper in range(helpers):
+        lines += [
+            f"static int\thelper_{index}_{helper}(int value)",
+            "{",
+            f"\tif (value > {rng.randint(1, 1000)})",
+            f"\t\treturn (value - {rng.randint(1, 100)});",
+            f"\treturn (value * {rng.randint(2, 9)} + {helper});",
+            "}",
+            "",
+        ]
+    call_previous = f"module_{module - 1}_fn_{index}(NULL, value)" if module else "0"
+    lines += [
+        f"int\tmodule_{module}_fn_{index}(t_module_{module} *m, int value)",
+        "{",
+        "\tint\tresult;",
+        "",
+        "\tif (!m)",
+        f"\t\treturn ({call_previous});",
+        f"\tm->state = STATE_{module}_BUSY;",
+        "\tresult = value;",
+    ]
+    lines += [f"\tresult = helper_{index}_{helper}(result);" for helper in range(helpers)]
+    lines += ["\tm->count++;", f"\tm->state = STATE_{module}_DONE;", "\treturn (result + m->id);", "}", ""]
+    return "\n".join(lines)
+
+
+def generate_c_repo(root, file_count, seed=0, commit=True):
+    """
+    Writes about file_count files (sources, headers, main.c and a Makefile) under root
+    and commits them. Returns the number of files written.
+    """
+    rng = random.Random(seed)
+    os.makedirs(root, exist_ok=True)
+    remaining = max(file_count - 2, 1)  # main.c and the Makefile
+    written = 0
+    module = 0
+    while remaining > 0:
+        sources = min(FILES_PER_MODULE, max(remaining - 1, 1))
+        module_dir = os.path.join(root, f"module_{module}")
+        os.makedirs(module_dir, exist_ok=True)
+        with open(os.path.join(module_dir, f"module_{module}.h"), "w") as header:
+            header.write(module_header(module, range(sources)))
+        for index in range(sources):
+            with open(os.path.join(module_dir, f"file_{index}.c"), "w") as source:
+                source.write(module_source(module, index, rng))
+        written += sources + 1
+        remaining -= sources + 1
+        module += 1
+
+    with open(os.path.join(root, "main.c"), "w") as main_file:
+        main_file.write('#include "module_0/module_0.h"\n\nint\tmain(void)\n{\n\treturn (module_0_fn_0(NULL, 42));\n}\n')
+    with open(os.path.join(root, "Makefile"), "w") as makefile:
+        makefile.write("NAME = bench\nSRCS = $(wildcard main.c module_*/*.c)\n\nall:\n\tcc -Wall -Wextra -Werror $(SRCS) -o $(NAME)\n")
+    written += 2
+
+    if commit:
+        git = ["git", "-c", "user.name=bench", "-c", "user.email=bench@example.com", "-C", root]
+        subprocess.run(git + ["init", "-q"], check=True)
+        subprocess.run(git + ["add", "-A"], check=True)
+        subprocess.run(git + ["commit", "-q", "-m", "Synthetic project"], check=True)
+    return written
+
+
+def read_tree(root):
+    """Returns {relative path: bytes} for the files under root, without the .git directory."""
+    files = {}
+    for directory, dirs, names in os.walk(root):
+        dirs[:] = [d for d in dirs if d != ".git"]
+        for name in names:
+            path = os.path.join(directory, name)
+            with open(path, "rb") as file:
+                files[os.path.relpath(path, root).replace(os.sep, "/")] = file.read()
+    return files
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("root")
+    parser.add_argument("--files", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    print(f"{generate_c_repo(args.root, args.files, args.seed)} files written to {args.root}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,35 @@
+"""
+Loads the Cloud Functions as their own modules, against the fakes of benchmarks/, so
+their behaviour can be checked without Google services or GitHub.
+"""
+import importlib.machinery
+import importlib.util
+import os
+import sys
+
+import pytest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FUNCTIONS_DIR = os.path.join(REPO_ROOT, "Cloud Functions")
+sys.path.insert(0, os.path.join(REPO_ROOT, "benchmarks"))
+
+import fake_gcp  # noqa: E402
+
+
+def load_function(directory, file_name="main.py"):
+    """Imports a function's source as a new module, so module-level state starts fresh."""
+    loader = importlib.machinery.SourceFileLoader(directory.replace("-", "_"),
+                                                  os.path.join(FUNCTIONS_DIR, directory, file_name))
+    spec = importlib.util.spec_from_loader(loader.name, loader)
+    module = importlib.util.module_from_spec(spec)
+    loader.exec_module(module)
+    return module
+
+
+@pytest.fixture
+def gcs_root(tmp_path):
+    """A fake bucket root, with fake_gcp registered as google.cloud and vertexai."""
+    root = tmp_path / "gcs"
+    root.mkdir()
+    fake_gcp.install(str(root))
+    return root
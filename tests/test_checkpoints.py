@@ -0,0 +1,183 @@
+import json
+import os
+import threading
+import time
+
+import pytest
+
+import fake_gcp
+from conftest import load_function
+
+SOURCES = {f"repo/src/file{i}.c": f"int file{i}(void) {{ return {i}; }}\n".encode() for i in range(12)}
+
+
+@pytest.fixture
+def function_3(gcs_root, monkeypatch):
+    monkeypatch.setenv("MODEL_REQUESTS_PER_MINUTE", "0")
+    function_3 = load_function("function-3-comment")
+    fake_gcp.seed_bucket(str(gcs_root), function_3.BUCKET, SOURCES)
+    return function_3
+
+
+class FakeRequest:
+    def __init__(self, body):
+        self.body = body
+        self.args = {}
+        self.headers = {}
+
+    def get_json(self, silent=True):
+        return self.body
+
+
+class Recycled(BaseException):
+    """The instance going away, which no code of the function catches."""
+
+
+class Model:
+    """
+    Answers like fake_gcp's model, but recycles the instance on every call after the first
+    fail_after, and raises on the prompts containing fail_on.
+    """
+
+    def __init__(self, fail_after=None, fail_on=None):
+        self.fail_after = fail_after
+        self.fail_on = fail_on
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def generate_content(self, contents, **kwargs):
+        prompt = "".join(contents) if isinstance(contents, (list, tuple)) else contents
+        with self._lock:
+            self.calls += 1
+            if self.fail_after is not None and self.calls > self.fail_after:
+                raise Recycled()
+        time.sleep(0.01)
+        if self.fail_on is not None and self.fail_on in prompt:
+            raise RuntimeError("Quota exceeded")
+        return fake_gcp.GenerationResponse(fake_gcp.default_response(prompt))
+
+
+def comment(function_3):
+    return json.loads(function_3.run_inference(FakeRequest({"storage_uri": f"gs://{function_3.BUCKET}/repo"})))
+
+
+def comments_per_file(gcs_root, function_3):
+    directory = os.path.join(gcs_root, function_3.BUCKET, "repo", "src")
+    return {name: open(os.path.join(directory, name)).read().count("Generated by the fake model")
+            for name in os.listdir(directory)}
+
+
+def test_update_retries_after_a_concurrent_write(function_3):
+    bucket = function_3.get_storage_client().bucket(function_3.BUCKET)
+    hashes = function_3.list_source_files(function_3.BUCKET, "repo")
+    manifest = function_3.CheckpointManifest(bucket, "repo")
+    other = function_3.CheckpointManifest(bucket, "repo")
+    manifest.sync(hashes)
+
+    # The other worker writes between this one's read of the manifest and its write
+    get_blob = bucket.get_blob
+    interleaved = []
+
+    def get_blob_then_interleave(name):
+        blob = get_blob(name)
+        if not interleaved:
+            interleaved.extend(other.checkpoint(claim=3))
+        return blob
+
+    manifest.bucket = type("Bucket", (), {"get_blob": staticmethod(get_blob_then_interleave),
+                                          "blob": bucket.blob})()
+    claimed = manifest.checkpoint(claim=3)
+
+    assert manifest.conflicts == 1
+    assert len(interleaved) == len(claimed) == 3
+    assert not {path for path, _ in claimed} & {path for path, _ in interleaved}
+    assert manifest.counts["in_progress"] == 6
+
+
+def test_sync_reconciles_the_manifest_with_the_stored_files(function_3):
+    bucket = function_3.get_storage_client().bucket(function_3.BUCKET)
+    manifest = function_3.CheckpointManifest(bucket, "repo")
+    hashes = function_3.list_source_files(function_3.BUCKET, "repo")
+    manifest.sync(hashes)
+    (written, input_md5), (finished, _), (uploaded_again, _) = manifest.checkpoint(claim=3)
+    manifest.checkpoint({finished: "commented-md5", uploaded_again: "commented-md5"})
+
+    # written was commented before its worker could record it; uploaded_again was replaced since
+    hashes = dict(hashes, **{written: "output-md5", finished: "commented-md5", uploaded_again: "new-md5"})
+    del hashes["repo/src/file11.c"]
+    assert manifest.sync(hashes) == {"pending": 9, "done": 2}
+
+    files = json.loads(bucket.get_blob(manifest.blob_name).download_as_text())["files"]
+    assert files[written] == {"state": "done", "input_md5": input_md5, "output_md5": "output-md5"}
+    assert files[uploaded_again] == {"state": "pending", "input_md5": "new-md5"}
+    assert "repo/src/file11.c" not in files
+
+
+def test_interrupted_run_resumes_without_commenting_twice(function_3, gcs_root, monkeypatch):
+    monkeypatch.setattr(function_3.CheckpointManifest.__init__, "__defaults__", (0.5,))  # Short leases
+    model = Model(fail_after=4)
+    monkeypatch.setattr(function_3, "get_model", lambda: model)
+    with pytest.raises(Recycled):
+        comment(function_3)
+    commented_before = sum(comments_per_file(gcs_root, function_3).values())
+    assert 0 < commented_before < len(SOURCES)
+
+    time.sleep(0.6)  # The leases of the files in flight when the run stopped expire
+    model.fail_after = None
+    calls_before = model.calls
+    result = comment(function_3)
+
+    assert result["status_comment"] == "ok"
+    assert result["files"] == {"pending": 0, "in_progress": 0, "done": len(SOURCES), "failed": 0}
+    assert set(comments_per_file(gcs_root, function_3).values()) == {1}
+    assert model.calls - calls_before == len(SOURCES) - commented_before
+    # Nothing is left to do for a later call
+    assert comment(function_3)["status_comment"] == "ok"
+    assert model.calls - calls_before == len(SOURCES) - commented_before
+
+
+def test_failing_file_does_not_stop_the_others(function_3, gcs_root, monkeypatch):
+    model = Model(fail_on="file3(void)")
+    monkeypatch.setattr(function_3, "get_model", lambda: model)
+
+    result = comment(function_3)
+
+    assert result["status_comment"] == "partial"
+    assert result["files"] == {"pending": 0, "in_progress": 0, "done": len(SOURCES) - 1, "failed": 1}
+    assert comments_per_file(gcs_root, function_3) == {f"file{i}.c": int(i != 3) for i in range(len(SOURCES))}
+    bucket = function_3.get_storage_client().bucket(function_3.BUCKET)
+    files = json.loads(bucket.get_blob(f"{function_3.CHECKPOINT_PREFIX}repo.json").download_as_text())["files"]
+    assert files["repo/src/file3.c"]["error"] == "Quota exceeded"
+    # The failed file is not retried until it is uploaded again
+    calls = model.calls
+    assert comment(function_3)["files"]["failed"] == 1
+    assert model.calls == calls
+
+
+def test_parallel_runs_share_the_files(function_3, gcs_root, monkeypatch):
+    model = Model()
+    monkeypatch.setattr(function_3, "get_model", lambda: model)
+    monkeypatch.setattr(function_3, "CLAIM_BATCH", 2)
+    results = []
+    runs = [threading.Thread(target=lambda: results.append(comment(function_3))) for _ in range(2)]
+    for run in runs:
+        run.start()
+    for run in runs:
+        run.join()
+
+    assert model.calls == len(SOURCES)
+    assert set(comments_per_file(gcs_root, function_3).values()) == {1}
+    assert any(result["status_comment"] == "ok" for result in results)
+
+
+def test_run_stops_claiming_at_the_deadline(function_3, gcs_root, monkeypatch):
+    model = Model()
+    monkeypatch.setattr(function_3, "get_model", lambda: model)
+    monkeypatch.setattr(function_3, "COMMENT_WORKERS", 1)
+    monkeypatch.setattr(function_3, "COMMENT_RUN_SECONDS", 0.02)
+
+    result = comment(function_3)
+
+    assert result["status_comment"] == "partial"
+    assert result["files"]["in_progress"] == 0  # Unstarted claims were given back
+    assert result["files"]["done"] == model.calls < len(SOURCES)
@@ -0,0 +1,124 @@
+import threading
+import time
+
+import pytest
+
+from conftest import load_function
+
+
+@pytest.fixture
+def function_3(gcs_root, monkeypatch):
+    monkeypatch.setenv("MODEL_REQUESTS_PER_MINUTE", "0")
+    return load_function("function-3-comment")
+
+
+def dispatch_order(scheduler, calls):
+    """
+    Queues calls, a list of (tenant, tokens), one after the other while a first call holds
+    the only slot, then releases it and returns the tenants in the order they were sent.
+    """
+    order = []
+    lock = threading.Lock()
+    holding = threading.Event()
+    release = threading.Event()
+
+    def blocker():
+        with scheduler.slot("blocker", 1):
+            holding.set()
+            release.wait()
+
+    def call(tenant, tokens):
+        with scheduler.slot(tenant, tokens):
+            with lock:
+                order.append(tenant)
+
+    threads = [threading.Thread(target=blocker)]
+    threads[0].start()
+    holding.wait()
+    for index, (tenant, tokens) in enumerate(calls):
+        threads.append(threading.Thread(target=call, args=(tenant, tokens)))
+        threads[-1].start()
+        while scheduler.metrics()["queue_depth"] < index + 1:  # Queued in this order
+            time.sleep(0.001)
+    release.set()
+    for thread in threads:
+        thread.join(timeout=5)
+    return order
+
+
+def test_small_tenant_overtakes_the_backlog_of_a_large_one(function_3):
+    scheduler = function_3.FairScheduler(function_3.MemoryQuotaBackend(), max_in_flight=1)
+
+    order = dispatch_order(scheduler, [("large", 100)] * 6 + [("small", 100)])
+
+    assert order.index("small") == 1
+    assert order.count("large") == 6
+
+
+def test_busy_tenants_share_calls_by_weight(function_3):
+    scheduler = function_3.FairScheduler(function_3.MemoryQuotaBackend(), max_in_flight=1,
+                                         weights={"gold": 2.0})
+
+    order = dispatch_order(scheduler, [("gold", 100)] * 8 + [("free", 100)] * 8)
+
+    # Until gold's backlog runs out, it gets two calls for each of free's
+    assert order[:9].count("gold") == 6
+    assert order[:9].count("free") == 3
+
+
+def test_idle_tenant_does_not_bank_credit(function_3):
+    scheduler = function_3.FairScheduler(function_3.MemoryQuotaBackend(), max_in_flight=1)
+    dispatch_order(scheduler, [("early", 100)])
+    dispatch_order(scheduler, [("busy", 100)] * 6)  # Moves the virtual time on while early is idle
+
+    # early starts again from the virtual time, instead of going first on its old, smaller tags
+    order = dispatch_order(scheduler, [("busy", 100)] * 4 + [("early", 100)] * 4)
+
+    assert order[:4].count("early") == order[:4].count("busy") == 2
+    assert scheduler.metrics()["tenants"]["early"]["calls"] == 5
+
+
+def test_quota_backend_spaces_requests(function_3):
+    backend = function_3.MemoryQuotaBackend(requests_per_minute=2, tokens_per_minute=1000)
+
+    assert backend.reserve(400) == 0
+    assert backend.reserve(400) == 0
+    assert backend.reserve(1) == pytest.approx(60, abs=1)  # Third request of the minute
+    backend = function_3.MemoryQuotaBackend(tokens_per_minute=1000)
+    assert backend.reserve(900) == 0
+    assert backend.reserve(200) == pytest.approx(60, abs=1)  # Over the token budget
+
+
+class QuotaExceeded(Exception):
+    code = 429
+
+
+def test_model_calls_rejected_with_a_429_are_retried(function_3, monkeypatch):
+    monkeypatch.setattr(function_3, "MODEL_BACKOFF_SECONDS", 0.01)
+    monkeypatch.setattr(function_3, "MODEL_MAX_RETRIES", 2)
+    answers = []
+
+    class Model:
+        def generate_content(self, prompt):
+            answers.append(prompt)
+            if len(answers) <= 2:
+                raise QuotaExceeded("429 Quota exceeded")
+            return "answer"
+
+    assert function_3.generate_content(Model(), "prompt") == "answer"
+    assert len(answers) == 3
+
+    answers.clear()
+    monkeypatch.setattr(function_3, "MODEL_MAX_RETRIES", 1)
+    with pytest.raises(QuotaExceeded):  # Out of retries
+        function_3.generate_content(Model(), "prompt")
+
+    class Broken:
+        def generate_content(self, prompt):
+            answers.append(prompt)
+            raise RuntimeError("Bad request")
+
+    answers.clear()
+    with pytest.raises(RuntimeError):  # Not retried
+        function_3.generate_content(Broken(), "prompt")
+    assert len(answers) == 1
@@ -0,0 +1,137 @@
+import threading
+import time
+
+import pytest
+from github import GithubException
+
+from conftest import load_function
+from fake_github import FakeGitHub
+
+
+@pytest.fixture
+def function_5(gcs_root):
+    return load_function("function-5-git-pr")
+
+
+@pytest.fixture
+def fake_github(function_5):
+    def start(**options):
+        fake = FakeGitHub(**options).start()
+        fake.add_repo("octo", "demo", {"README.md": b"# demo\n"})
+        function_5.GITHUB_API_URL = fake.url
+        started.append(fake)
+        return fake
+
+    started = []
+    yield start
+    for fake in started:
+        fake.stop()
+
+
+def test_secondary_rate_limit_is_retried_after_retry_after(function_5, fake_github):
+    fake = fake_github(secondary_every=3, retry_after=0.05)
+    client = function_5.build_github_client("token")
+
+    started_at = time.time()
+    repos = [client.call(client.github.get_repo, "octo/demo") for _ in range(6)]
+
+    assert [repo.default_branch for repo in repos] == ["main"] * 6
+    # Every third request is refused: the 3rd and the 6th of the 8 sent
+    metrics = client.metrics()
+    assert metrics["throttled"] == fake.stats()["throttled"] == 2
+    assert metrics["retries"] == 2
+    assert metrics["calls"] == fake.stats()["requests"] == 8
+    assert metrics["backoff_seconds"] == pytest.approx(0.1)
+    assert time.time() - started_at >= 0.1
+
+
+def test_primary_rate_limit_waits_for_the_reset(function_5, fake_github):
+    fake = fake_github(rate_limit=1)
+    client = function_5.build_github_client("token")
+    client.call(client.github.get_repo, "octo/demo")
+
+    # The quota is exhausted until X-RateLimit-Reset, a second from now, then refilled
+    fake.reset_at = int(time.time())
+    timer = threading.Timer(0.5, lambda: setattr(fake, "remaining", 1))
+    timer.start()
+    try:
+        repo = client.call(client.github.get_repo, "octo/demo")
+    finally:
+        timer.cancel()
+
+    assert repo.name == "demo"
+    metrics = client.metrics()
+    assert metrics["retries"] == 1
+    assert 0 < metrics["backoff_seconds"] <= 2
+    assert metrics["rate_limit_remaining"] == 0
+
+
+def test_primary_rate_limit_too_far_away_is_not_waited_for(function_5, fake_github):
+    fake_github(rate_limit=1)
+    client = function_5.build_github_client("token")
+    client.call(client.github.get_repo, "octo/demo")
+
+    with pytest.raises(GithubException) as error:
+        client.call(client.github.get_repo, "octo/demo")
+
+    assert error.value.status == 403
+    assert client.metrics()["retries"] == 0
+
+
+def test_throttle_delay(function_5, monkeypatch):
+    monkeypatch.setattr(function_5.random, "random", lambda: 0.5)
+    delay = function_5.GitHubClient._throttle_delay
+
+    assert delay(GithubException(429, {"message": "slow down"}, {"Retry-After": "7"}), 0) == 7
+    # Secondary limits without Retry-After back off exponentially
+    secondary = GithubException(403, {"message": "You have exceeded a secondary rate limit."}, {})
+    assert delay(secondary, 0) == pytest.approx(function_5.GITHUB_BACKOFF_BASE_SECONDS * 1.5)
+    assert delay(secondary, 3) == pytest.approx(function_5.GITHUB_BACKOFF_BASE_SECONDS * 8 * 1.5)
+    # A 403 that is not a rate limit is not retried
+    assert delay(GithubException(403, {"message": "Resource not accessible by integration"}, {}), 0) is None
+    assert delay(GithubException(404, {"message": "Not Found"}, {}), 0) is None
+
+
+def test_throttle_halves_concurrency_then_grows_back(function_5):
+    client = function_5.GitHubClient(github=None, max_workers=8)
+
+    client._throttle(0.0)
+    client._throttle(0.0)
+    assert client._allowed == 2
+    for _ in range(10):
+        client._succeed()
+    assert client._allowed == 8
+
+
+def test_token_refreshes_of_different_installations_run_concurrently(function_5, monkeypatch):
+    cache = function_5.GitHubCredentialCache()
+    cache._integration = object()
+    slow_started, release_slow = threading.Event(), threading.Event()
+    fetched = []
+
+    def get_installation_access_token(integration, installation_id):
+        if installation_id == 1:
+            slow_started.set()
+            release_slow.wait(5)  # A slow answer from GitHub
+        fetched.append(installation_id)
+        return f"token-{installation_id}-{len(fetched)}", time.time() + 3600
+
+    monkeypatch.setattr(function_5, "get_installation_id", lambda integration, owner, name: {"slow": 1, "fast": 2}[owner])
+    monkeypatch.setattr(function_5, "get_installation_access_token", get_installation_access_token)
+    tokens = {}
+    slow = [threading.Thread(target=lambda: tokens.setdefault("slow", cache.installation_token("slow", "demo")))
+            for _ in range(2)]
+    for thread in slow:
+        thread.start()
+    slow_started.wait(5)
+
+    # Not held up by installation 1's request
+    assert cache.installation_token("fast", "demo") == "token-2-1"
+    release_slow.set()
+    for thread in slow:
+        thread.join(5)
+
+    # The second request for installation 1 waited for the first one's token instead of fetching its own
+    assert tokens["slow"] == "token-1-2"
+    assert fetched == [2, 1]
+    assert cache.installation_token("slow", "demo") == "token-1-2"
@@ -0,0 +1,191 @@
+import io
+import os
+import zipfile
+
+import flask
+import pytest
+
+import fake_gcp
+from conftest import load_function
+
+BUCKET = "doxygen-gcp-storage"
+
+
+@pytest.fixture
+def function_4(gcs_root):
+    return load_function("function-4-html", "main.c")
+
+
+def write_tree(root, files):
+    for relative_path, content in files.items():
+        path = os.path.join(root, relative_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(content)
+
+
+def test_sync_uploads_changes_skips_unchanged_and_deletes_stale(function_4, gcs_root, tmp_path):
+    fake_gcp.seed_bucket(str(gcs_root), BUCKET, {
+        "sites/demo/html/index.html": b"<p>index</p>",
+        "sites/demo/html/changed.html": b"<p>before</p>",
+        "sites/demo/html/stale.html": b"<p>removed page</p>",
+        f"sites/demo/{function_4.BUILD_DIGEST_MARKER}": b"digest",
+        "sites/demo-other/index.html": b"<p>another site</p>",
+    })
+    docs = str(tmp_path / "docs")
+    write_tree(docs, {"html/index.html": "<p>index</p>", "html/changed.html": "<p>after</p>",
+                      "html/new.html": "<p>new page</p>"})
+
+    stats = function_4.sync_directory_to_gcs(function_4.get_storage_client(), BUCKET, docs, "sites/demo/",
+                                             workers=4, keep=(function_4.BUILD_DIGEST_MARKER,))
+
+    assert stats == {"uploaded": 2, "skipped": 1, "deleted": 1}
+    site = gcs_root / BUCKET / "sites" / "demo"
+    assert sorted(os.listdir(site / "html")) == ["changed.html", "index.html", "new.html"]
+    assert (site / "html" / "changed.html").read_text() == "<p>after</p>"
+    assert (site / function_4.BUILD_DIGEST_MARKER).read_text() == "digest"
+    assert (gcs_root / BUCKET / "sites" / "demo-other" / "index.html").exists()  # Outside the prefix
+
+    # A second sync of the same tree only compares hashes
+    assert function_4.sync_directory_to_gcs(function_4.get_storage_client(), BUCKET, docs, "sites/demo/",
+                                            keep=(function_4.BUILD_DIGEST_MARKER,)) == {"uploaded": 0, "skipped": 3, "deleted": 0}
+
+
+def test_site_index_url_is_under_site_base_url(function_4, gcs_root):
+    fake_gcp.seed_bucket(str(gcs_root), BUCKET, {"sites/demo/html/index.html": b"<p>index</p>"})
+    config = function_4.Config(project_id="demo", bucket_name=BUCKET, publish_mode="site", site_name="demo",
+                               site_base_url="https://docs.example.com/")
+
+    assert function_4.site_index_url(function_4.get_storage_client(), config) == \
+        "https://docs.example.com/sites/demo/html/index.html"
+
+
+def test_site_mode_without_site_base_url_is_refused(function_4, monkeypatch):
+    monkeypatch.delenv("SITE_BASE_URL", raising=False)
+    body = {"project_id": "demo", "bucket_name": BUCKET, "doxygen_binary_blob_name": "doxygen",
+            "publish_mode": "site"}
+
+    with flask.Flask(__name__).test_request_context(json=body):
+        response, status = function_4.run_doxygen_function(flask.request)
+
+    assert status == 400
+    assert "SITE_BASE_URL" in response.get_json()["message"]
+
+
+def test_doxyfile_lists_are_quote_aware_and_appendable(function_4, tmp_path):
+    doxyfile = tmp_path / "Doxyfile"
+    doxyfile.write_text('# INPUT = commented\n'
+                        'INPUT = src "third party" \\\n'
+                        '        include\n'
+                        'INPUT += extra/main.c\n'
+                        'HTML_OUTPUT = site\n')
+
+    tags = function_4.read_doxyfile_tags(str(doxyfile))
+
+    assert function_4.split_doxyfile_list(tags["INPUT"]) == ["src", "third party", "include", "extra/main.c"]
+    inputs, output_dir = function_4.doxyfile_paths(tags, "/work")
+    assert inputs == ["/work/src", "/work/third party", "/work/include", "/work/extra/main.c"]
+    assert output_dir == "/work"  # Doxygen's default: the directory it runs from
+    assert function_4.doxyfile_paths({"OUTPUT_DIRECTORY": '"/tmp/my docs"'}, "/work") == (["/work"], "/tmp/my docs")
+
+
+def test_rewritten_paths_keep_quotes_and_appends(function_4):
+    lines = function_4.rewrite_doxyfile_paths(['INPUT = src "third party"\n', 'INPUT += /abs/extra\n'], base_dir="/tmp")
+
+    assert lines == ['INPUT = /tmp/src "/tmp/third party"\n', 'INPUT += /abs/extra\n']
+
+
+def test_shards_are_planned_across_every_input(function_4, tmp_path):
+    write_tree(str(tmp_path), {"src/net/socket.c": "", "src/net/dns.c": "", "src/util/str.c": "", "src/main.c": "",
+                               "lib/util/list.c": "", "lib/.git/HEAD": "", "extra.c": ""})
+
+    shards, root_files, file_count = function_4.plan_shards(
+        [str(tmp_path / "src"), str(tmp_path / "lib"), str(tmp_path / "extra.c"), str(tmp_path / "missing")])
+
+    assert shards == [("net", str(tmp_path / "src" / "net")), ("util", str(tmp_path / "src" / "util")),
+                      ("util_2", str(tmp_path / "lib" / "util"))]
+    assert root_files == [str(tmp_path / "src" / "main.c"), str(tmp_path / "extra.c")]
+    assert file_count == 6
+
+
+def test_sharded_build_writes_under_the_default_output_directory(function_4, tmp_path, monkeypatch):
+    write_tree(str(tmp_path / "build"), {"src/a/a.c": "", "src/b/b.c": "", "src/main.c": ""})
+    (tmp_path / "build" / "Doxyfile").write_text("INPUT = src\n")
+    # Stands in for Doxygen, printing the Doxyfile it was given
+    doxygen = tmp_path / "doxygen"
+    doxygen.write_text("#!/bin/sh\ncat \"$1\"\n")
+    doxygen.chmod(0o755)
+    monkeypatch.chdir(tmp_path / "build")
+    log = io.StringIO()
+
+    result = function_4.run_sharded_doxygen(str(doxygen), "Doxyfile", log, 60, 2, str(tmp_path / "shards"))
+
+    assert result.returncode == 0
+    html_root = tmp_path / "build" / "html"
+    assert f'[a] HTML_OUTPUT = "{html_root / "a"}"' in log.getvalue()
+    assert f'[b] HTML_OUTPUT = "{html_root / "b"}"' in log.getvalue()
+    assert f'[root] INPUT = "{tmp_path / "build" / "src" / "main.c"}"' in log.getvalue()
+
+
+def test_build_digest_follows_the_build_inputs(function_4, gcs_root):
+    fake_gcp.seed_bucket(str(gcs_root), BUCKET, {
+        "examples/demo/main.c": b"int main(void) { return 0; }\n",
+        "examples/demo/util.h": b"int util(void);\n",
+        "doxygen-awesome-css/theme.css": b"body {}\n",
+        "Doxyfile": b"INPUT = examples\n",
+        "doxygen": b"binary v1",
+    })
+    client = function_4.get_storage_client()
+    bucket = client.bucket(BUCKET)
+    config = function_4.Config(project_id="demo", bucket_name=BUCKET, doxygen_binary_blob_name="doxygen")
+    digest = function_4.compute_build_digest(client, config)
+
+    # Unrelated objects, and published artifacts, are not inputs
+    bucket.blob("generated_docs/old.zip").upload_from_string(b"zip")
+    bucket.blob("other-repo/main.c").upload_from_string(b"int other;\n")
+    assert function_4.compute_build_digest(client, config) == digest
+
+    changes = [
+        lambda: bucket.blob("examples/demo/main.c").upload_from_string(b"int main(void) { return 1; }\n"),
+        lambda: bucket.blob("examples/demo/new.c").upload_from_string(b"int added;\n"),
+        lambda: bucket.blob("doxygen-awesome-css/theme.css").upload_from_string(b"body { color: red; }\n"),
+        lambda: bucket.blob("Doxyfile").upload_from_string(b"INPUT = examples\nEXTRACT_ALL = YES\n"),
+        lambda: bucket.blob("doxygen").upload_from_string(b"binary v1"),  # Same bytes, new generation
+    ]
+    seen = {digest}
+    for change in changes:
+        change()
+        changed = function_4.compute_build_digest(client, config)
+        assert changed not in seen
+        assert function_4.compute_build_digest(client, config) == changed  # Stable while nothing changes
+        seen.add(changed)
+
+    # The publishing options that shape the artifact are part of it too
+    config.zip_compress_level = 9
+    assert function_4.compute_build_digest(client, config) not in seen
+
+
+def test_cached_build_is_found_by_digest(function_4, gcs_root):
+    client = function_4.get_storage_client()
+    config = function_4.Config(project_id="demo", bucket_name=BUCKET, site_name="demo")
+    fake_gcp.seed_bucket(str(gcs_root), BUCKET, {"generated_docs/abc.zip": b"zip",
+                                                 f"sites/demo/{function_4.BUILD_DIGEST_MARKER}": b"abc\n"})
+
+    assert function_4.find_cached_build(client, config, "abc")
+    assert not function_4.find_cached_build(client, config, "abd")
+    config.publish_mode = "site"
+    assert function_4.find_cached_build(client, config, "abc")
+    assert not function_4.find_cached_build(client, config, "abd")
+
+
+def test_zip_stores_compressed_assets_and_deflates_the_rest(function_4, tmp_path):
+    write_tree(str(tmp_path / "docs"), {"html/index.html": "<p>index</p>" * 100, "html/search/data.js": "var x;\n"})
+    (tmp_path / "docs" / "html" / "logo.png").write_bytes(b"\x89PNG" + bytes(200))
+    stream = io.BytesIO()
+
+    function_4.write_zip_directory(stream, str(tmp_path / "docs"), compress_level=9)
+
+    with zipfile.ZipFile(stream) as archive:
+        entries = {info.filename: info.compress_type for info in archive.infolist()}
+    assert entries == {"html/index.html": zipfile.ZIP_DEFLATED, "html/logo.png": zipfile.ZIP_STORED,
+                       "html/search/data.js": zipfile.ZIP_DEFLATED}
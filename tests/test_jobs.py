@@ -0,0 +1,180 @@
+import os
+import subprocess
+import sys
+import threading
+
+import pytest
+
+from conftest import REPO_ROOT
+
+sys.path.insert(0, os.path.join(REPO_ROOT, "Streamlit App Engine"))
+
+import jobs  # noqa: E402
+from orchestrator import StageResult  # noqa: E402
+
+URL = "https://github.com/octo/demo"
+
+
+def git(*args, cwd=None):
+    return subprocess.run(["git", "-c", "user.name=test", "-c", "user.email=test@example.com", *args],
+                          cwd=cwd, check=True, capture_output=True).stdout
+
+
+def pkt_line(text):
+    return f"{len(text) + 4:04x}{text}".encode()
+
+
+def info_refs(repo):
+    """What a git server answers to GET <url>/info/refs?service=git-upload-pack."""
+    return (pkt_line("# service=git-upload-pack\n") + b"0000"
+            + git("upload-pack", "--stateless-rpc", "--advertise-refs", repo))
+
+
+class Response:
+    def __init__(self, status_code, content=b""):
+        self.status_code = status_code
+        self.content = content
+
+
+class Session:
+    """Serves the ref advertisement of each repository from heads: {url: sha or None}."""
+
+    def __init__(self):
+        self.heads = {}
+        self.requests = []
+
+    def get(self, url, params=None, timeout=None):
+        self.requests.append((url, params))
+        sha = self.heads.get(url.removesuffix("/info/refs").removesuffix(".git"))  # Served both ways, like GitHub
+        if sha is None:
+            return Response(404)
+        return Response(200, pkt_line("# service=git-upload-pack\n") + b"0000"
+                        + pkt_line(f"{sha} HEAD\0multi_ack symref=HEAD:refs/heads/main\n")
+                        + pkt_line(f"{sha} refs/heads/main\n") + b"0000")
+
+
+class Orchestrator:
+    """Stands in for PipelineOrchestrator: every run waits for release, then succeeds if outcome says so."""
+
+    runs = []
+    release = threading.Event()
+    outcome = "success"
+
+    def __init__(self, stages, session=None, trace_id=None):
+        Orchestrator.runs.append(trace_id)
+
+    def run(self, on_stage_done=None):
+        Orchestrator.release.wait(5)
+        result = StageResult("download", Orchestrator.outcome)
+        on_stage_done(result)
+        return {"download": result}
+
+
+@pytest.fixture
+def manager(monkeypatch):
+    Orchestrator.runs = []
+    Orchestrator.release = threading.Event()
+    Orchestrator.outcome = "success"
+    monkeypatch.setattr(jobs, "PipelineOrchestrator", Orchestrator)
+    session = Session()
+    session.heads[URL] = "a" * 40
+    manager = jobs.JobManager(session, ttl_seconds=60)
+    yield manager
+    Orchestrator.release.set()
+    manager._executor.shutdown(wait=True)
+
+
+def wait_finished(job):
+    Orchestrator.release.set()
+    for _ in range(500):
+        if job.finished:
+            return job
+        threading.Event().wait(0.01)
+    raise AssertionError(f"{job.key} did not finish")
+
+
+def test_advertised_refs_of_a_real_repository(tmp_path):
+    work = str(tmp_path / "work")
+    git("init", "-q", "-b", "main", work)
+    git("commit", "-q", "--allow-empty", "-m", "First", cwd=work)
+    git("tag", "v1", cwd=work)
+    head = git("rev-parse", "HEAD", cwd=work).decode().strip()
+
+    refs = jobs.advertised_refs(info_refs(work))
+
+    assert refs["HEAD"] == refs["refs/heads/main"] == refs["refs/tags/v1"] == head
+
+
+def test_resolve_commit_sha_asks_the_git_server():
+    session = Session()
+    session.heads[URL] = "b" * 40
+
+    assert jobs.resolve_commit_sha(session, URL + "/") == "b" * 40
+    assert session.requests == [(URL + "/info/refs", {"service": "git-upload-pack"})]
+    assert jobs.resolve_commit_sha(session, "https://github.com/octo/missing") is None
+
+
+def test_submission_for_a_running_commit_joins_it(manager):
+    first = manager.submit(URL)
+    second = manager.submit(URL + ".git")
+
+    assert second is first
+    assert wait_finished(first).status == "done"
+    assert manager.submit(URL) is first  # Served from cache
+    assert len(Orchestrator.runs) == 1
+
+
+def test_new_commit_starts_a_new_run(manager):
+    first = wait_finished(manager.submit(URL))
+    manager.session.heads[URL] = "c" * 40
+
+    second = manager.submit(URL)
+
+    assert second is not first
+    assert second.key == (jobs.normalize_repo_url(URL), "c" * 40)
+
+
+def test_finished_runs_expire_after_the_ttl(manager):
+    job = wait_finished(manager.submit(URL))
+    job.finished_at -= 61
+
+    assert manager.get(job.key) is job
+    assert wait_finished(manager.submit(URL)) is not job
+    assert len(Orchestrator.runs) == 2
+
+
+def test_failed_run_is_run_again(manager):
+    Orchestrator.outcome = "error"
+    failed = wait_finished(manager.submit(URL))
+    assert failed.status == "failed"
+
+    Orchestrator.outcome = "success"
+    rerun = manager.submit(URL)
+
+    assert rerun is not failed
+    assert wait_finished(rerun).status == "done"
+
+
+def test_unresolved_commit_is_not_reused(manager):
+    url = "https://github.com/octo/unknown"
+    first = wait_finished(manager.submit(url))
+
+    assert first.key == (url, None)
+    assert manager.submit(url) is not first
+
+
+def test_finished_job_always_has_finished_at(manager):
+    job = manager.submit(URL)
+    seen = []
+
+    def watch():
+        while not job.finished:
+            pass
+        seen.append(job.finished_at)
+
+    watcher = threading.Thread(target=watch)
+    watcher.start()
+    wait_finished(job)
+    watcher.join(5)
+    assert seen and seen[0] is not None
+    manager.submit("https://github.com/octo/other")  # Evicts without tripping over the finishing job
@@ -0,0 +1,106 @@
+import os
+import subprocess
+
+import git as gitpython
+import pytest
+
+from conftest import load_function
+
+
+def git(*args, cwd=None):
+    return subprocess.run(["git", "-c", "user.name=test", "-c", "user.email=test@example.com", *args],
+                          cwd=cwd, check=True, capture_output=True, text=True).stdout
+
+
+def commit(work, path, content):
+    with open(os.path.join(work, path), "w") as f:
+        f.write(content)
+    git("add", "-A", cwd=work)
+    git("commit", "-qm", f"Update {path}", cwd=work)
+
+
+@pytest.fixture
+def function_1(gcs_root, tmp_path, monkeypatch):
+    function_1 = load_function("function-1-download")
+    monkeypatch.setattr(function_1, "MIRROR_CACHE", f"dir:{tmp_path / 'mirrors'}")
+    return function_1
+
+
+@pytest.fixture
+def upstream(tmp_path):
+    """A repository served over file://, with a pull request ref like GitHub's."""
+    work, bare = str(tmp_path / "work"), str(tmp_path / "demo.git")
+    git("init", "-q", "-b", "main", work)
+    commit(work, "main.c", "int main(void) { return 0; }\n")
+    git("tag", "v1", cwd=work)
+    git("clone", "-q", "--bare", work, bare)
+    git("checkout", "-qb", "contribution", cwd=work)
+    commit(work, "contribution.c", "int contribution(void) { return 1; }\n")
+    git("push", "-q", bare, "contribution:refs/pull/1/head", cwd=work)
+    git("checkout", "-q", "main", cwd=work)
+    return work, bare
+
+
+def clone(function_1, url, destination):
+    trace = function_1.Trace(None, "test")
+    repo = function_1.clone_with_mirror(url, destination, trace)
+    return repo, {span["name"]: span for span in trace.spans}
+
+
+def test_second_download_fetches_incrementally(function_1, upstream, tmp_path):
+    work, bare = upstream
+    url = f"file://{bare}"
+
+    _, spans = clone(function_1, url, str(tmp_path / "first"))
+    assert spans["restore_mirror"]["restored"] is False
+    assert spans["fetch"]["incremental"] is False
+    assert "store_mirror" in spans
+
+    commit(work, "main.c", "int main(void) { return 42; }\n")
+    git("push", "-q", bare, "main", cwd=work)
+    repo, spans = clone(function_1, url, str(tmp_path / "second"))
+
+    assert spans["restore_mirror"]["restored"] is True
+    assert spans["fetch"] == {**spans["fetch"], "incremental": True, "changed": True}
+    with open(os.path.join(repo.working_dir, "main.c")) as f:
+        assert "return 42" in f.read()
+    assert repo.active_branch.name == "main"
+
+    # Nothing was pushed since: the bundle is not stored again
+    _, spans = clone(function_1, url, str(tmp_path / "third"))
+    assert spans["fetch"] == {**spans["fetch"], "incremental": True, "changed": False}
+    assert "store_mirror" not in spans
+
+
+def test_pull_request_refs_are_not_fetched(function_1, upstream, tmp_path, monkeypatch):
+    _, bare = upstream
+    url = f"file://{bare}"
+    mirror_refs = []
+    clone_from = gitpython.Repo.clone_from
+
+    def record_mirror_refs(source, destination, **kwargs):
+        mirror_refs.extend(git("for-each-ref", "--format=%(refname)", cwd=source).split())
+        return clone_from(source, destination, **kwargs)
+
+    monkeypatch.setattr(gitpython.Repo, "clone_from", record_mirror_refs)
+    clone(function_1, url, str(tmp_path / "clone"))
+
+    assert set(mirror_refs) == {"refs/heads/main", "refs/tags/v1"}
+    bundle = os.path.join(function_1.MIRROR_CACHE[len("dir:"):], function_1.mirror_bundle_name(url))
+    assert {line.split()[1] for line in git("bundle", "list-heads", bundle).splitlines()} == set(mirror_refs)
+
+
+def test_unusable_bundle_falls_back_to_a_full_fetch(function_1, upstream, tmp_path):
+    _, bare = upstream
+    url = f"file://{bare}"
+    clone(function_1, url, str(tmp_path / "first"))
+    bundle = os.path.join(function_1.MIRROR_CACHE[len("dir:"):], function_1.mirror_bundle_name(url))
+    with open(bundle, "wb") as f:
+        f.write(b"not a bundle")
+
+    repo, spans = clone(function_1, url, str(tmp_path / "second"))
+
+    assert spans["restore_mirror"]["restored"] is False
+    assert spans["fetch"]["incremental"] is False
+    assert os.path.isfile(os.path.join(repo.working_dir, "main.c"))
+    git("bundle", "verify", bundle)  # Stored again
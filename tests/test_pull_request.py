@@ -0,0 +1,90 @@
+import pytest
+
+import fake_gcp
+from conftest import load_function
+from fake_github import FakeGitHub
+
+BUCKET = "doxygen-gcp-storage"
+
+
+@pytest.fixture
+def function_5(gcs_root):
+    return load_function("function-5-git-pr")
+
+
+@pytest.fixture
+def fake_github(function_5):
+    fake = FakeGitHub().start()
+    function_5.GITHUB_API_URL = fake.url
+    yield fake
+    fake.stop()
+
+
+def commit(function_5, gcs_root, fake, files):
+    """Commits files, seeded in GCS, to a new branch of octo/demo; returns the commit and the requests made."""
+    fake_gcp.seed_bucket(str(gcs_root), BUCKET, {f"out/{path}": content for path, content in files.items()})
+    bucket = function_5.get_storage_client().bucket(BUCKET)
+    client = function_5.build_github_client("token")
+    repo = client.call(client.github.get_repo, "octo/demo")
+    before = fake.stats()["by_endpoint"]
+    sha = function_5.commit_files_to_branch(client, repo, [(path, bucket.blob(f"out/{path}")) for path in files],
+                                            "docs", "main")
+    after = fake.stats()["by_endpoint"]
+    return sha, {endpoint: after[endpoint] - before.get(endpoint, 0) for endpoint in after
+                 if after[endpoint] != before.get(endpoint, 0)}
+
+
+def test_changed_files_are_committed_in_one_tree_commit_and_ref(function_5, gcs_root, fake_github):
+    repo = fake_github.add_repo("octo", "demo", {"README.md": b"# demo\n"})
+    files = {"src/main.c": b"/** Entry point */\nint main(void) { return 0; }\n", "src/util.c": b"int util;\n"}
+
+    sha, requests = commit(function_5, gcs_root, fake_github, files)
+
+    assert requests == {"branch": 1, "get_tree": 1, "create_blob": 2, "create_tree": 1, "create_commit": 1,
+                        "create_ref": 1}
+    assert repo.refs["refs/heads/docs"] == sha
+    assert repo.commits[sha]["parents"] == [repo.refs["refs/heads/main"]]
+    tree = repo.trees[repo.commits[sha]["tree"]]
+    assert {path: repo.blobs[blob_sha] for path, blob_sha in tree.items()} == {"README.md": b"# demo\n", **files}
+
+
+def test_files_unchanged_on_the_default_branch_are_not_pushed(function_5, gcs_root, fake_github):
+    repo = fake_github.add_repo("octo", "demo", {"README.md": b"# demo\n", "src/main.c": b"int main(void);\n"})
+    main = repo.refs["refs/heads/main"]
+    files = {"README.md": b"# demo\n", "src/main.c": b"int main(void);\n", "src/new.c": b"int added;\n"}
+
+    sha, requests = commit(function_5, gcs_root, fake_github, files)
+
+    assert requests["create_blob"] == 1
+    tree = repo.trees[repo.commits[sha]["tree"]]
+    assert tree["README.md"] == repo.trees[repo.commits[main]["tree"]]["README.md"]
+    assert repo.blobs[tree["src/new.c"]] == b"int added;\n"
+
+
+def test_nothing_is_written_when_no_file_changed(function_5, gcs_root, fake_github):
+    repo = fake_github.add_repo("octo", "demo", {"README.md": b"# demo\n", "src/main.c": b"int main(void);\n"})
+    files = {"README.md": b"# demo\n", "src/main.c": b"int main(void);\n"}
+
+    sha, requests = commit(function_5, gcs_root, fake_github, files)
+
+    assert sha is None
+    assert requests == {"branch": 1, "get_tree": 1}
+    assert list(repo.refs) == ["refs/heads/main"]
+
+
+def test_throttled_commit_still_lands_once(function_5, gcs_root):
+    # Retry-After and X-RateLimit handling of single calls is covered by test_github_client.py
+    fake = FakeGitHub(secondary_every=4, retry_after=0.01).start()
+    function_5.GITHUB_API_URL = fake.url
+    try:
+        repo = fake.add_repo("octo", "demo", {"README.md": b"# demo\n"})
+        files = {f"src/file_{i}.c": f"int file_{i};\n".encode() for i in range(12)}
+
+        sha, requests = commit(function_5, gcs_root, fake, files)
+    finally:
+        fake.stop()
+
+    assert fake.stats()["throttled"] > 0
+    assert (requests["create_tree"], requests["create_commit"], requests["create_ref"]) == (1, 1, 1)
+    assert len(repo.commits) == 2
+    assert set(repo.trees[repo.commits[sha]["tree"]]) == {"README.md", *files}
@@ -0,0 +1,35 @@
+import os
+import sys
+
+from conftest import REPO_ROOT
+
+sys.path.insert(0, os.path.join(REPO_ROOT, "Monolith Runner"))
+
+import pipeline  # noqa: E402
+
+SOURCE = """#include <stdio.h>
+/* Entry point { of the demo */
+struct options {
+    int verbose;
+};
+
+static int parse(const char *arg)
+{
+    return arg[0] == '{';
+}
+
+int main(int argc, char **argv) {
+    const char *brace = "}";
+    return parse(argv[1]);
+}
+"""
+
+
+def test_entry_file_summary_keeps_declarations_and_drops_bodies():
+    summary = pipeline.summarize_for_readme(SOURCE, max_chars=len(SOURCE) - 1)
+
+    assert summary.splitlines() == [
+        "#include <stdio.h>", "/* Entry point { of the demo */", "struct options {", "    int verbose;", "};", "",
+        "static int parse(const char *arg)", "{", "\t...", "}", "", "int main(int argc, char **argv) {", "\t...", "}",
+    ]
+    assert pipeline.summarize_for_readme(SOURCE) == SOURCE  # Short files are kept whole
@@ -0,0 +1,35 @@
+import os
+import sys
+
+import pytest
+
+from conftest import REPO_ROOT
+
+sys.path.insert(0, os.path.join(REPO_ROOT, "Monolith Runner"))
+
+import storage_backends  # noqa: E402
+
+
+def test_backend_missing_a_method_cannot_be_instantiated():
+    class Incomplete(storage_backends.Storage):
+        def list(self, prefix):
+            return []
+
+    with pytest.raises(TypeError, match="open_write"):
+        Incomplete()
+
+
+@pytest.mark.parametrize("backend", ["local", "memory"])
+def test_backends_round_trip(backend, tmp_path):
+    storage = storage_backends.build_storage(backend, str(tmp_path))
+
+    storage.write_text("repo/src/main.c", "int main(void);\n")
+    with storage.open_write("repo/docs.zip") as stream:
+        stream.write(b"zip")
+
+    assert storage.list("repo/") == ["repo/docs.zip", "repo/src/main.c"]
+    assert storage.read_text("repo/src/main.c") == "int main(void);\n"
+    assert storage.read("repo/docs.zip") == b"zip"
+    storage.delete("repo/docs.zip")
+    assert not storage.exists("repo/docs.zip")
+    assert storage.exists("repo/src/main.c")
@@ -0,0 +1,18 @@
+import pytest
+
+from conftest import load_function
+
+
+@pytest.fixture
+def function_1(gcs_root):
+    return load_function("function-1-download")
+
+
+@pytest.mark.parametrize("upload_rules", [["docs/", "!docs/keep.md"], "docs/\n!docs/keep.md\n"])
+def test_request_rules_as_a_list_or_lines(function_1, upload_rules):
+    policy = function_1.UploadPolicy.from_request({"upload_rules": upload_rules})
+
+    assert policy.excluded("docs", is_dir=True)
+    assert not policy.excluded("docs/keep.md")
+    assert not policy.excluded("d")  # Not a rule made of the string's characters
+    assert policy.excluded("main.o")  # The default rules still apply